@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark database access used on every login.
+Compares the old access pattern (stat + connect + close on every call) with the
+long-lived connections of sqlite_database.
+
+Run: `$ python benchmark_database.py --users 1000 --logins 3`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import io
+import time
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime
+from contextlib import redirect_stdout
+import sqlite_database
+from helper_functions import flush_logger
+
+
+def legacy_add_db(db_name, user, last_login, local_port, talon_port, login_node, pid_session, state_session):
+    '''Old add_db access pattern: stat, connect, scan all users, write, close.
+    '''
+
+    if not os.path.isfile(db_name):
+        conn = sqlite3.connect(db_name)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE jupyter_talon
+              (user, first_login, last_login, local_port, talon_port, login_node, count_logins, pid_session , state_session)''')
+    else:
+        conn = sqlite3.connect(db_name)
+        c = conn.cursor()
+    users = list(c.execute('SELECT user FROM jupyter_talon ORDER BY user').fetchall())
+    if (user,) in users:
+        count_logins = (c.execute('SELECT count_logins FROM jupyter_talon WHERE user=?', (user,)).fetchall())[0][0]
+        if state_session == 'running':
+            count_logins += 1
+        c.execute('UPDATE jupyter_talon SET last_login=?, local_port=?, talon_port=?, login_node=?, count_logins=?,\
+                  pid_session=?, state_session=? WHERE user=?',
+                  (last_login, local_port, talon_port, login_node, count_logins, pid_session, state_session, user))
+    else:
+        c.execute('INSERT INTO jupyter_talon VALUES (?,?,?,?,?,?,?,?,?)',
+                  (user, last_login, last_login, local_port, talon_port, login_node, 0, pid_session, state_session))
+    conn.commit()
+    conn.close()
+
+
+def legacy_from_db(db_name, user):
+    '''Old from_db access pattern: stat, connect, scan all users, read, close.
+    '''
+
+    row = None
+    if os.path.isfile(db_name):
+        conn = sqlite3.connect(db_name)
+        c = conn.cursor()
+        users = list(c.execute('SELECT user FROM jupyter_talon ORDER BY user').fetchall())
+        if (user,) in users:
+            row = c.execute('SELECT * FROM jupyter_talon WHERE user=?', (user,)).fetchall()[0]
+        conn.close()
+    return row
+
+
+def run_logins(add, get, db_name, users, logins):
+    '''Replay the database calls of a login for every user.
+    One login: from_db + add_db 'initiated' (routes) + 'initiated' (configure) + 'running' (forward).
+
+    Return:
+        ops: Number of database calls made.
+    '''
+
+    ops = 0
+    for _ in range(logins):
+        for i in range(users):
+            user = 'user%05d' % i
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            get(db_name, user)
+            add(db_name, user, now, 0, 0, 'talon', 0, 'initiated')
+            add(db_name, user, now, 0, 0, 'talon', os.getpid(), 'initiated')
+            add(db_name, user, now, 9000 + i, 8888, 'talon', os.getpid(), 'running')
+            ops += 4
+    return ops
+
+
+def benchmark(name, add, get, users, logins):
+    '''Time one implementation in a fresh temporary directory.
+    '''
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # LOGS AND DATABASE GO TO THE TEMPORARY DIRECTORY
+        os.chdir(tmp_dir)
+        try:
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                ops = run_logins(add, get, 'benchmark.db', users, logins)
+                # INCLUDE WRITING THE LOG LINES
+                flush_logger()
+            elapsed = time.perf_counter() - start
+        finally:
+            sqlite_database.close_connections()
+            os.chdir(cwd)
+    print('%-8s %8d ops %8.2f s %10.1f ops/sec' % (name, ops, elapsed, ops / elapsed))
+    return ops / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark gateway database calls.')
+    parser.add_argument('--users', type=int, default=1000, help='number of distinct users')
+    parser.add_argument('--logins', type=int, default=3, help='logins per user')
+    args = parser.parse_args()
+
+    before = benchmark('before', legacy_add_db, legacy_from_db, args.users, args.logins)
+    after = benchmark('after', sqlite_database.add_db, sqlite_database.from_db, args.users, args.logins)
+    print('speedup  %.1fx' % (after / before))
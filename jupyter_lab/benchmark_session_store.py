@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark session store backends.
+Fills each store with N users, then replays login traffic (get, upserts,
+list ports, list by state) and reports throughput and latency per operation.
+
+Run: `$ python benchmark_session_store.py --users 1000 10000 100000`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+from session_store import SQLiteSessionStore, MemorySessionStore
+from helper_functions import flush_logger
+
+# STORES COMPARED: NAME AND FUNCTION(tmp_dir) RETURNING A NEW STORE
+STORES = [('sqlite', lambda tmp_dir: SQLiteSessionStore(os.path.join(tmp_dir, 'benchmark.db'))),
+          ('memory', lambda tmp_dir: MemorySessionStore()),
+          ('memory+journal', lambda tmp_dir: MemorySessionStore(journal=os.path.join(tmp_dir, 'benchmark.journal')))]
+
+
+def transition(user, state_session, port=0):
+    return {'user': user, 'last_login': int(time.time()), 'local_port': port, 'talon_port': port,
+            'login_node': 'talon', 'pid_session': 1, 'state_session': state_session}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(name, function, count):
+    '''Call function 'count' times.
+
+    Return:
+        Dictionary with operation name, ops/sec, p50 and p99 latency in ms.
+    '''
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return {'op': name, 'ops_sec': count / elapsed,
+            'p50_ms': 1000 * percentile(latencies, 0.50), 'p99_ms': 1000 * percentile(latencies, 0.99)}
+
+
+def benchmark(make_store, users, ops, seed=0):
+    '''Run all operations against one new store with 'users' users.
+
+    Return:
+        List of measure() results.
+    '''
+
+    rng = random.Random(seed)
+    names = ['user%06d' % i for i in range(users)]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # LOGS GO TO THE TEMPORARY DIRECTORY
+        os.chdir(tmp_dir)
+        store = make_store(tmp_dir)
+        store.create()
+        # FILL - ONE BATCH PER 1000 USERS
+        results = [measure('fill', lambda i: store.upsert_many(
+            [transition(user, 'running' if j % 10 == 0 else 'ended', 9000 + j % 1000 if j % 10 == 0 else 0)
+             for j, user in enumerate(names[i * 1000:(i + 1) * 1000])]), (users + 999) // 1000)]
+        results[0]['ops_sec'] *= users / ((users + 999) // 1000)
+        picks = [rng.choice(names) for _ in range(ops)]
+        results.append(measure('get', lambda i: store.get(picks[i]), ops))
+        results.append(measure('upsert', lambda i: store.upsert(
+            **transition(picks[i], ['initiated', 'running', 'ended'][i % 3], 9000 + i % 1000)), ops))
+        # LISTS READ THE WHOLE STATE - FEWER CALLS
+        results.append(measure('list_ports', lambda i: store.list_ports(), max(ops // 100, 10)))
+        results.append(measure('list_by_state', lambda i: store.list_by_state('running'), max(ops // 100, 10)))
+        store.close()
+        # LOG LINES ARE WRITTEN RELATIVE TO THE WORKING DIRECTORY
+        flush_logger()
+        os.chdir(cwd)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark session store backends.')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000], help='users in the store')
+    parser.add_argument('--ops', type=int, default=5000, help='get and upsert calls per run')
+    parser.add_argument('--stores', nargs='+', default=[name for name, _ in STORES], help='stores to compare')
+    args = parser.parse_args()
+
+    print('%-15s %8s %-14s %12s %10s %10s' % ('store', 'users', 'op', 'ops/sec', 'p50 ms', 'p99 ms'))
+    for users in args.users:
+        for name, make_store in STORES:
+            if name not in args.stores:
+                continue
+            for result in benchmark(make_store, users, args.ops):
+                print('%-15s %8d %-14s %12.1f %10.4f %10.4f' % (name, users, result['op'], result['ops_sec'],
+                                                               result['p50_ms'], result['p99_ms']))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Single database writer process.
+Session processes send state transitions over a pipe instead of writing the
+SQLite file themselves. The writer groups everything that arrives within
+'flush_interval' into one transaction.
+
+Every transition gets a sequence number. The writer publishes the highest
+sequence number committed so far, so callers can wait until their writes (or
+all writes) are saved before reading.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import time
+from multiprocessing import Process, Pipe, Lock, Condition, Value, Array
+from helper_functions import logger
+
+# POSITIONS IN THE SHARED METRICS ARRAY
+METRICS = ['received', 'committed', 'failed', 'flushes', 'max_batch', 'flush_seconds',
+           'last_flush_seconds', 'backpressure_waits', 'backpressure_seconds']
+
+
+class DatabaseWriter(object):
+    """
+    Args:
+        db_name: Database name.
+        max_pending: Transitions sent but not committed before senders block.
+        batch_size: Most transitions saved in one transaction.
+        flush_interval: Seconds to wait for more transitions before committing.
+    """
+
+    def __init__(self, db_name, max_pending=10000, batch_size=500, flush_interval=0.05):
+        self.db_name = db_name
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # ONE WAY PIPE. SENDS ARE SERIALIZED BY THE SEQUENCE LOCK SO
+        # TRANSITIONS ARRIVE IN SEQUENCE ORDER.
+        self._reader, self._sender = Pipe(duplex=False)
+        self._sequence = Value('Q', 0)
+        self._committed = Value('Q', 0, lock=False)
+        self._condition = Condition()
+        self._metrics = Array('d', len(METRICS))
+        self._metrics_lock = Lock()
+        self.process = None
+        self.pid = None
+        return
+
+    def start(self):
+        """Start writer process.
+        """
+
+        self.process = Process(target=self._run, name='database_writer', daemon=True)
+        self.process.start()
+        self.pid = self.process.pid
+        logger(user='root', message='DATABASE WRITER STARTED PID %s' % self.pid, level='WARNING')
+        return
+
+    def is_alive(self):
+        """Check writer process from any process forked from the gateway.
+        """
+
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def submit(self, transition, wait=False, timeout=30):
+        """Send one state transition to the writer.
+        Blocks while 'max_pending' transitions are waiting to be committed.
+
+        Args:
+            transition: Dictionary with the add_db arguments.
+            wait: Wait until the transition is committed.
+            timeout: Seconds to wait.
+        Return:
+            sequence: Sequence number of the transition.
+        """
+
+        with self._sequence.get_lock():
+            sequence = self._sequence.value + 1
+            if sequence - self._committed.value > self.max_pending:
+                # BACKPRESSURE - WAIT FOR THE WRITER TO CATCH UP
+                start = time.time()
+                self._wait(sequence - self.max_pending, timeout)
+                self._add_metric('backpressure_waits', 1)
+                self._add_metric('backpressure_seconds', time.time() - start)
+            self._sender.send((sequence, transition))
+            self._sequence.value = sequence
+        if wait:
+            self._wait(sequence, timeout)
+        return sequence
+
+    def flush(self, timeout=None):
+        """Wait until every transition sent so far is committed.
+
+        Return:
+            True if all transitions are committed.
+        """
+
+        return self._wait(self._sequence.value, timeout)
+
+    def stop(self, timeout=10):
+        """Commit pending transitions and stop writer process.
+        """
+
+        if self.is_alive() and self.pid != os.getpid():
+            with self._sequence.get_lock():
+                self._sender.send(None)
+            self.process.join(timeout)
+            logger(user='root', message='DATABASE WRITER STOPPED %s' % self.metrics(), level='WARNING')
+        return
+
+    def metrics(self):
+        """Writer counters.
+
+        Return:
+            Dictionary with flush and backpressure metrics.
+        """
+
+        values = dict(zip(METRICS, self._metrics[:]))
+        values['sent'] = self._sequence.value
+        values['pending'] = self._sequence.value - self._committed.value
+        values['queued'] = self._sequence.value - int(values['received'])
+        values['avg_batch'] = values['committed'] / values['flushes'] if values['flushes'] else 0
+        values['alive'] = self.is_alive()
+        return values
+
+    def _wait(self, sequence, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._committed.value >= sequence, timeout)
+
+    def _add_metric(self, name, value):
+        with self._metrics_lock:
+            self._metrics[METRICS.index(name)] += value
+        return
+
+    def _run(self):
+        """Writer loop. Group transitions and commit them in one transaction.
+        """
+
+        # IMPORT HERE - sqlite_database SENDS ITS WRITES TO THIS MODULE
+        from sqlite_database import add_db_batch, add_db_direct
+
+        running = True
+        while running:
+            try:
+                item = self._reader.recv()
+            except EOFError:
+                break
+            batch = []
+            deadline = time.time() + self.flush_interval
+            # GROUP COMMIT - COLLECT WHAT ARRIVES BEFORE THE DEADLINE
+            while True:
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+                remaining = deadline - time.time()
+                if len(batch) >= self.batch_size or not self._reader.poll(max(remaining, 0)):
+                    break
+                item = self._reader.recv()
+            if not batch:
+                continue
+            self._add_metric('received', len(batch))
+
+            start = time.time()
+            transitions = [transition for _, transition in batch]
+            # SENDERS ALREADY INVALIDATED THE from_db CACHE
+            if not add_db_batch(self.db_name, transitions, invalidate=False):
+                # SAVE ONE BY ONE SO ONE BAD TRANSITION DOES NOT DROP THE BATCH
+                failed = [t for t in transitions if not add_db_direct(self.db_name, invalidate=False, **t)]
+                self._add_metric('failed', len(failed))
+            elapsed = time.time() - start
+
+            with self._metrics_lock:
+                self._metrics[METRICS.index('committed')] += len(batch)
+                self._metrics[METRICS.index('flushes')] += 1
+                self._metrics[METRICS.index('flush_seconds')] += elapsed
+                self._metrics[METRICS.index('last_flush_seconds')] = elapsed
+                if len(batch) > self._metrics[METRICS.index('max_batch')]:
+                    self._metrics[METRICS.index('max_batch')] = len(batch)
+            # ACKNOWLEDGE
+            with self._condition:
+                self._committed.value = batch[-1][0]
+                self._condition.notify_all()
+        return
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 """Extra functions file.
-    logger
+    logger [lines are written in the background by LogWriter, as text or
+        JSON lines - see configure_logger(log_format=...) and log_index.py]
 
 
 (C) 2020 George Mihaila
@@ -11,25 +12,133 @@ email georgemihaila@my.unt.edu
 import sys
 from io import StringIO
 import os
+import json
+import signal
 import time
+import gzip
+import queue
+import shutil
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from multiprocessing.util import Finalize
 import socket
 from contextlib import closing
 
 
-def kill_pid(pid):
+def process_children(pid):
+    """Pids of the child processes of a process [Linux /proc].
+
+    Args:
+        pid: pid of parent process.
+    Return:
+        children: List of pids.
+    """
+
+    children = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return children
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name, 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # FIELDS AFTER THE COMMAND NAME: state ppid ...
+        if int(stat[stat.rindex(')') + 2:].split()[1]) == int(pid):
+            children.append(int(name))
+    return children
+
+
+def same_program(pid):
+    """Check if a process runs the same command line as this process, i.e.
+    it is a gateway process and not an unrelated process that got a reused pid.
+    """
+
+    try:
+        with open('/proc/%s/cmdline' % int(pid), 'rb') as f:
+            cmdline = f.read()
+        with open('/proc/self/cmdline', 'rb') as f:
+            return cmdline == f.read()
+    except (OSError, ValueError):
+        # NO /proc - CANNOT TELL
+        return os.path.isdir('/proc/%s' % pid) or not os.path.isdir('/proc')
+
+
+def kill_pid(pid, timeout=5, gateway_only=True):
     """Kill any running processes based on PID.
+    The process and its children [ssh tunnel] get SIGTERM, then SIGKILL if
+    they are still running after 'timeout' seconds.
 
     Args:
         pid: pid of process that will be killed.
+        timeout: seconds to wait before SIGKILL.
+        gateway_only: only kill gateway processes [see same_program()].
     Return:
         False or True if was killed or not
     """
+
     try:
-        os.kill(int(pid), 0)
+        pid = int(pid)
+    except (TypeError, ValueError):
+        return False
+    # NEVER THIS PROCESS OR A PROCESS GROUP
+    if (pid <= 0) or (pid == os.getpid()):
+        return False
+    if not pid_alive(pid):
         return True
-    except OSError:
+    if gateway_only and not same_program(pid):
         return False
+    pids = [pid] + process_children(pid)
+    for signum in [signal.SIGTERM, signal.SIGKILL]:
+        for target in pids:
+            try:
+                os.kill(target, signum)
+            except OSError:
+                pass
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            # COLLECT OUR OWN CHILDREN [ZOMBIES LOOK ALIVE]
+            for target in pids:
+                try:
+                    os.waitpid(target, os.WNOHANG)
+                except OSError:
+                    pass
+            pids = [target for target in pids if pid_alive(target)]
+            if not pids:
+                return True
+            time.sleep(0.05)
+    return False
+
+
+def pid_alive(pid):
+    """Check if a process exists.
+
+    Args:
+        pid: pid of process.
+    Return:
+        True if the process exists.
+    """
+
+    try:
+        pid = int(pid)
+    except (TypeError, ValueError):
+        return False
+    # 0 AND NEGATIVE pids ARE PROCESS GROUPS
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # EXISTS BUT OWNED BY ANOTHER USER
+        return True
+    return True
 
 
 def find_free_port(min_port=None, max_port=None):
@@ -57,8 +166,348 @@ def find_free_port(min_port=None, max_port=None):
             return s.getsockname()[1]
 
 
-def logger(user, message, level, fname='logs_jupyter_lab', verbose=True, extra_log=True):
-    """Logging function
+class LogFileSink(object):
+    """Append-only log files kept open in a bounded LRU of file handles.
+    Files written with rotate=True are renamed to '<file>.<date>' when they
+    pass 'max_bytes' or 'max_age' seconds and gzip compressed in a background
+    thread. Used only from the LogWriter thread.
+
+    Other processes may write the same file. Every 'check_interval' seconds a
+    handle is checked against the path and reopened if the file was rotated,
+    and rotated files are compressed only after 'compress_delay' seconds.
+
+    Args:
+        max_open: Most open file handles.
+        max_bytes: Rotate a file after this size. 0 to disable.
+        max_age: Rotate a file after this many seconds. 0 to disable.
+    """
+
+    def __init__(self, max_open=256, max_bytes=50 * 1024 * 1024, max_age=7 * 86400,
+                 check_interval=5, compress_delay=30):
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.compress_delay = compress_delay
+        # path -> [file, size, opened time, last check time]
+        self._files = OrderedDict()
+        self._compress_queue = queue.Queue()
+        self._compress_thread = None
+        self.bytes_written = 0
+        self.opened = 0
+        self.evicted = 0
+        self.rotated = 0
+        self.compressed = 0
+        return
+
+    def write(self, path, text, rotate=False):
+        """Append text to path.
+
+        Args:
+            path: File name.
+            text: Text to append.
+            rotate: Rotate the file by size and age.
+        """
+
+        now = time.time()
+        entry = self._files.get(path)
+        if entry is not None and now - entry[3] > self.check_interval:
+            entry[3] = now
+            # FILE ROTATED OR DELETED BY ANOTHER PROCESS
+            try:
+                if os.stat(path).st_ino != os.fstat(entry[0].fileno()).st_ino:
+                    entry = self._close(path)
+            except OSError:
+                entry = self._close(path)
+        if entry is None:
+            entry = self._open(path, now)
+        else:
+            self._files.move_to_end(path)
+        if rotate and ((self.max_bytes and entry[1] >= self.max_bytes) or
+                       (self.max_age and now - entry[2] >= self.max_age)):
+            self._rotate(path)
+            entry = self._open(path, now)
+        entry[0].write(text)
+        size = len(text.encode('utf-8'))
+        entry[1] += size
+        self.bytes_written += size
+        return
+
+    def flush(self):
+        for entry in self._files.values():
+            entry[0].flush()
+        return
+
+    def close(self):
+        for path in list(self._files):
+            self._close(path)
+        return
+
+    def metrics(self):
+        return {'open_files': len(self._files),
+                'bytes_written': self.bytes_written,
+                'opened': self.opened,
+                'evicted': self.evicted,
+                'rotated': self.rotated,
+                'compressed': self.compressed}
+
+    def _open(self, path, now):
+        f = open(path, 'a')
+        # AGE OF AN EXISTING FILE COUNTS FROM ITS LAST CHANGE OF STATUS
+        opened = os.fstat(f.fileno()).st_ctime if f.tell() else now
+        entry = [f, f.tell(), min(opened, now), now]
+        self._files[path] = entry
+        self.opened += 1
+        while len(self._files) > self.max_open:
+            self._close(next(iter(self._files)))
+            self.evicted += 1
+        return entry
+
+    def _close(self, path):
+        entry = self._files.pop(path, None)
+        if entry is not None:
+            entry[0].close()
+        return None
+
+    def _rotate(self, path):
+        self._close(path)
+        rotated_path = '%s.%s' % (path, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        # NEVER REPLACE A FILE ROTATED IN THE SAME SECOND
+        count = 0
+        while os.path.exists(rotated_path) or os.path.exists(rotated_path + '.gz'):
+            count += 1
+            rotated_path = '%s.%s-%d' % (path, datetime.now().strftime('%Y%m%d-%H%M%S'), count)
+        try:
+            os.rename(path, rotated_path)
+        except OSError:
+            return
+        self.rotated += 1
+        if self._compress_thread is None:
+            self._compress_thread = threading.Thread(target=self._compress_run, name='log_compress', daemon=True)
+            self._compress_thread.start()
+        self._compress_queue.put((time.time() + self.compress_delay, rotated_path))
+        return
+
+    def _compress_run(self):
+        while True:
+            ready, path = self._compress_queue.get()
+            time.sleep(max(ready - time.time(), 0))
+            try:
+                with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(path)
+                self.compressed += 1
+            except OSError as e:
+                print('LOG COMPRESS FAILED! %s' % str(e), file=sys.stderr)
+
+
+class LogWriter(object):
+    """Background log writer. logger() puts lines on a bounded queue and a
+    daemon thread writes them in batches, so callers never wait on disk.
+
+    Args:
+        queue_size: Most lines waiting to be written.
+        flush_interval: Seconds between writes when the queue is not full.
+        policy: What logger() does when the queue is full:
+            'drop'  [count and drop the line - 'ERROR' and 'CRITICAL' lines still wait]
+            'block' [wait for space in the queue]
+        max_open_files, max_bytes, max_age: LogFileSink settings. Per user
+            logs are rotated, the main log file is not.
+    """
+
+    def __init__(self, queue_size=10000, flush_interval=0.5, policy='drop', max_open_files=256,
+                 max_bytes=50 * 1024 * 1024, max_age=7 * 86400):
+        assert policy in ['drop', 'block']
+        self.sink = LogFileSink(max_open=max_open_files, max_bytes=max_bytes, max_age=max_age)
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.batches = 0
+        self._users_logs_dir = False
+        self._thread = threading.Thread(target=self._run, name='log_writer', daemon=True)
+        self._thread.start()
+        return
+
+    def put(self, item, important=False):
+        """Queue one log line.
+
+        Args:
+            item: Tuple (line, file_line, fname, user, verbose, extra_log). 'line'
+                is printed, 'file_line' is written to the log files.
+            important: Never drop this line.
+        """
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == 'drop' and not important:
+                self.dropped += 1
+            else:
+                self.blocked += 1
+                self.queue.put(item)
+        return
+
+    def flush(self, timeout=None):
+        """Wait until every queued line is written.
+
+        Return:
+            True if the queue was written before the timeout.
+        """
+
+        if not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Stop taking lines and close log files. Call after flush().
+        """
+
+        self.queue.put(None)
+        self._thread.join(5)
+        return
+
+    def metrics(self):
+        values = {'queued': self.queue.qsize(),
+                  'written': self.written,
+                  'dropped': self.dropped,
+                  'blocked': self.blocked,
+                  'batches': self.batches}
+        values.update(self.sink.metrics())
+        return values
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            batch = [self.queue.get()]
+            # TAKE EVERYTHING QUEUED SO FAR
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print('LOG WRITE FAILED! %s' % str(e), file=sys.stderr)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if None in batch:
+                # close()
+                self.sink.close()
+                return
+
+    def _write(self, batch):
+        """Write a batch of lines. One write per file per batch.
+        """
+
+        files = {}
+        stdout_lines = []
+        for item in batch:
+            if (item is None) or isinstance(item, threading.Event):
+                continue
+            line, file_line, fname, user, verbose, extra_log = item
+            if verbose:
+                stdout_lines.append(line)
+            files.setdefault(fname, []).append(file_line)
+            if extra_log:
+                files.setdefault('users_logs/%s.log' % user, []).append(file_line)
+        if stdout_lines:
+            print('\n'.join(stdout_lines), flush=True)
+        if (not self._users_logs_dir) and any(path.startswith('users_logs/') for path in files):
+            # create if folder does not exist
+            os.makedirs('users_logs', exist_ok=True)
+            self._users_logs_dir = True
+        for path, lines in files.items():
+            self.sink.write(path, '\n'.join(lines) + '\n', rotate=path.startswith('users_logs/'))
+        self.sink.flush()
+        self.written += len(batch)
+        self.batches += 1
+        return
+
+
+# LOG WRITER SETTINGS [SEE configure_logger()]
+_log_settings = {'queue_size': 10000, 'flush_interval': 0.5, 'policy': 'drop',
+                 'max_open_files': 256, 'max_bytes': 50 * 1024 * 1024, 'max_age': 7 * 86400,
+                 'log_format': 'text'}
+# SETTINGS USED BY logger() [NOT PASSED TO LogWriter]
+_LOGGER_ONLY_SETTINGS = ['log_format']
+# LOG WRITER OF THIS PROCESS
+_log_writer = None
+_log_writer_pid = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """Log writer of this process. A process forked from the gateway starts
+    its own writer - the parent's thread does not exist in the child.
+    """
+
+    global _log_writer, _log_writer_pid
+    if _log_writer_pid != os.getpid():
+        with _log_writer_lock:
+            if _log_writer_pid != os.getpid():
+                writer = LogWriter(**{name: value for name, value in _log_settings.items()
+                                      if name not in _LOGGER_ONLY_SETTINGS})
+                # WRITE QUEUED LINES AT EXIT [ALSO IN multiprocessing CHILDREN]
+                Finalize(writer, writer.flush, args=(10,), exitpriority=100)
+                _log_writer, _log_writer_pid = writer, os.getpid()
+    return _log_writer
+
+
+def configure_logger(queue_size=None, flush_interval=None, policy=None, max_open_files=None, max_bytes=None,
+                     max_age=None, log_format=None):
+    """Change log writer settings. Queued lines are written first.
+
+    Args:
+        queue_size: Most lines waiting to be written.
+        flush_interval: Seconds between writes.
+        policy: 'drop' or 'block' when the queue is full.
+        max_open_files: Most log files kept open.
+        max_bytes: Rotate per user logs after this size.
+        max_age: Rotate per user logs after this many seconds.
+        log_format: 'text' ['<date> <user> <level> <message>'] or 'json' [JSON lines].
+    """
+
+    global _log_writer_pid
+    assert log_format in [None, 'text', 'json']
+    for name, value in [('queue_size', queue_size), ('flush_interval', flush_interval), ('policy', policy),
+                        ('max_open_files', max_open_files), ('max_bytes', max_bytes), ('max_age', max_age),
+                        ('log_format', log_format)]:
+        if value is not None:
+            _log_settings[name] = value
+    if _log_writer_pid == os.getpid():
+        _log_writer.flush()
+        _log_writer.close()
+        # NEXT LOG LINE STARTS A WRITER WITH THE NEW SETTINGS
+        _log_writer_pid = None
+    return
+
+
+def flush_logger(timeout=None):
+    """Wait until every queued log line of this process is written.
+    """
+
+    if _log_writer_pid == os.getpid():
+        return _log_writer.flush(timeout)
+    return True
+
+
+def logger_metrics():
+    """Log writer counters of this process.
+    """
+
+    return get_log_writer().metrics()
+
+
+def logger(user, message, level, fname='logs_jupyter_lab', verbose=True, extra_log=True, phase=None,
+           latency=None, local_port=None, remote_port=None):
+    """Logging function. Lines are written by a background thread [see LogWriter].
 
     Args:
       user: user id
@@ -67,6 +516,14 @@ def logger(user, message, level, fname='logs_jupyter_lab', verbose=True, extra_l
       fname: file name to save all logs
       verbose: if print to stdou
       extra_log: create 'logs/' and write individual logs for each user
+      phase: optional session phase ['configure', 'login', 'forward', state of add_db...]
+      latency: optional seconds taken by the phase
+      local_port: optional port on the gateway
+      remote_port: optional port on HPC
+
+    In 'json' log format files get one JSON object per line with 'time',
+    'user', 'level', 'pid', 'message' and the optional fields that are set.
+    Standard output always gets text lines.
 
     Source: https://docs.python.org/2/howto/logging.html
     """
@@ -78,17 +535,16 @@ def logger(user, message, level, fname='logs_jupyter_lab', verbose=True, extra_l
     assert str(user) and str(message)
     # create log line from message and date
     line = '%s %s %s %s' % (time_log, str(user), level, str(message))
-    # print to stdout if veborse
-    if verbose:
-        print(line)
-    # append to main log file
-    with open(fname, 'a') as f:
-        f.write(line + '\n')
-    if extra_log:
-        # create if folder does not exist
-        if os.path.isdir('users_logs') is False:
-            os.mkdir('users_logs')
-        # append to user log file
-        with open('users_logs/%s.log' % user, 'a') as f:
-            f.write(line + '\n')
+    if _log_settings['log_format'] == 'json':
+        record = {'time': time_log, 'user': str(user), 'level': level, 'pid': os.getpid(), 'message': str(message)}
+        for name, value in [('phase', phase), ('latency', latency), ('local_port', local_port),
+                            ('remote_port', remote_port)]:
+            if value is not None:
+                record[name] = round(value, 3) if name == 'latency' else value
+        file_line = json.dumps(record)
+    else:
+        file_line = line
+    # queue line for the log writer
+    get_log_writer().put((line, file_line, fname, str(user), verbose, extra_log),
+                         important=level in ['CRITICAL', 'ERROR'])
     return
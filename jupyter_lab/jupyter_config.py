@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Jupyter settings of every user [jupyter_notebook_config.py on HPC].
+The config is rendered on the gateway from JUPYTER_CONFIG_TEMPLATE and
+identified by the hash of its text. The hash applied for each user is kept in
+the 'user_profiles' table, so the login node only writes the file when the
+template or the user settings changed.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import hashlib
+
+JUPYTER_CONFIG_TEMPLATE = """c.NotebookApp.allow_remote_access = True
+c.MappingKernelManager.cull_busy = False
+c.MappingKernelManager.cull_connected = True
+c.MappingKernelManager.cull_idle_timeout = %(session_length)s
+c.MappingKernelManager.cull_interval = 5
+c.MappingKernelManager.kernel_info_timeout = 60
+c.NotebookApp.shutdown_no_activity_timeout = %(session_length)s
+c.NotebookApp.notebook_dir = '/storage/scratch2/%(user)s/'
+c.MappingKernelManager.root_dir = '/storage/scratch2/%(user)s'
+c.ContentsManager.root_dir = '/storage/scratch2/%(user)s'
+c.NotebookApp.iopub_data_rate_limit = 1e10
+c.NotebookApp.mathjax_config = 'TeX-AMS-MML_HTMLorMML-full,Safe'
+"""
+# JUPYTER SERVER API - ANSWERS WITHOUT LOGIN [READINESS CHECKS]
+JUPYTER_API_REQUEST = b'GET /api HTTP/1.0\r\n\r\n'
+# FIRST LINE OF THE FILE
+CONFIG_HEADER = '# WRITTEN BY THE JUPYTER LAB GATEWAY - CHANGES ARE OVERWRITTEN [VERSION %s]\n'
+
+
+def render_config(user, session_length):
+    '''Render jupyter_notebook_config.py of a user.
+
+    Args:
+        user: User id.
+        session_length: Seconds until idle kernels and server are stopped.
+    Return:
+        text: File content.
+        config_hash: Version of the content [16 hex characters].
+    '''
+
+    body = JUPYTER_CONFIG_TEMPLATE % {'user': user, 'session_length': int(session_length)}
+    config_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]
+    return CONFIG_HEADER % config_hash + body, config_hash
+
+
+def password_hash(user, credential):
+    """Jupyter password hash ['sha1:<salt>:<hash>' like notebook.auth.passwd()],
+    so the password itself never goes to the login node shell. The salt comes
+    from the user id: the same password gives the same hash at every login and
+    jupyter_notebook_config.json is only written when the password changed.
+    """
+
+    salt = hashlib.sha256(('jupyter_lab_gateway:%s' % user).encode('utf-8')).hexdigest()[:12]
+    return 'sha1:%s:%s' % (salt, hashlib.sha1((credential + salt).encode('utf-8')).hexdigest())
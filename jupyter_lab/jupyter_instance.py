@@ -8,14 +8,27 @@ email georgemihaila@my.unt.edu
 """
 
 import os
+import sys
+import json
+import time
+import shlex
+import signal
+import threading
 from datetime import datetime
 import pexpect
 
-from jupyter_lab import app, DATABASE_NAME, START_OPEN_PORT, END_OPEN_PORT
-from helper_functions import logger, find_free_port
-from sqlite_database import add_db
-
-
+from jupyter_lab import app, DATABASE_NAME, TRANSCRIPT_LINES, SESSION_LENGTH, PORT_LEASE_MARGIN, SSH_MASTER, \
+    FAST_PATH, TUNNEL_DAEMON, JUPYTER_START_TIMEOUT, READY_TIMEOUT, WARM_POOL_SOCKET
+from helper_functions import logger
+from sqlite_database import add_db, get_profile, set_config_hash, set_readiness
+from jupyter_config import render_config, password_hash, JUPYTER_API_REQUEST
+from port_allocator import allocate_port, release_port
+from transcript import Transcript
+from ssh_master import SSHMaster, READY_MARKER, READY_COMMAND
+from tunnel_daemon import tunnel_daemon, open_tunnel
+from remote_bootstrap import RESULT_MARKER, BOOTSTRAP_READY, remote_command
+from login_progress import report
+from readiness import probe, record_ready
 
 class JupyterLab(object):
     """
@@ -39,18 +52,79 @@ class JupyterLab(object):
         self.pid = pid
         self.session_length = session_length
         self.timeout = 5
+        # LAST LINES OF REMOTE OUTPUT [SAVED ON FAILURE OR ADMIN REQUEST]
+        self.transcript = Transcript(user, max_lines=TRANSCRIPT_LINES)
+        # LOGGED IN SSHMaster [None - EVERY ssh ASKS FOR THE PASSWORD]
+        self.master = None
+        # LOGIN PROGRESS TOKEN [None - NOBODY FOLLOWS THIS LOGIN]
+        self.token = None
+        self.reported_running = False
+        self.recorded_running = False
         return
 
-    def configure(self,):
-        """Jupyter configure and checking running instances.
-        This function executes following procedures:
-            - Check if user exists.
-            Change path to scratch2.
-            Export enviroment variables (python and conda paths).
-            Run jupyter config command.
+    def record_running(self, local_port, remote_port):
+        """Save the 'running' transition once per session [forward() calls it
+        for every output line], then report 'running'.
+        """
+
+        if not self.recorded_running:
+            self.recorded_running = True
+            # UPDATE USER IN DATABASE
+            add_db(db_name=DATABASE_NAME,
+                   user=self.user,
+                   last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                   local_port=local_port,
+                   talon_port=remote_port,
+                   login_node=self.hostname,
+                   pid_session=self.pid,
+                   state_session='running')
+        self.running(local_port, remote_port, background=True)
+        return
+
+    def running(self, local_port, remote_port, background=False):
+        """Last phase of the login, once per session: wait until jupyter
+        answers on the forwarded port [readiness], record the time-to-ready
+        and report 'running' ['not_ready' if it did not answer in time].
+
+        Args:
+            background: Probe in a thread [forward() keeps reading ssh output].
         """
 
-        logger(user=self.user, message='CHECK IF ANY RUNNING JUPYTER and HASH AND JUPYTER CONFIG', level='INFO')
+        if self.reported_running:
+            return
+        self.reported_running = True
+        if background:
+            threading.Thread(target=self.probe_ready, args=(local_port, remote_port), daemon=True).start()
+        else:
+            self.probe_ready(local_port, remote_port)
+        return
+
+    def probe_ready(self, local_port, remote_port):
+        seconds = probe(local_port, timeout=READY_TIMEOUT)
+        record_ready(DATABASE_NAME, self.user, local_port, remote_port, self.pid, seconds)
+        # NO REDIRECT TO A PORT THAT DOES NOT ANSWER
+        report(DATABASE_NAME, self.token, self.user, 'running' if seconds is not None else 'not_ready', local_port)
+        return
+
+    def fast_path(self, profile):
+        """Skip configure() for a returning user. The readiness profile must
+        show jupyter on this login node, verified within the session length,
+        with the current config - and jupyter must answer on that port now
+        [one 'ssh -W' channel of the master, no remote shell].
+
+        Args:
+            profile: Row from get_profile() or None.
+        Return:
+            remote_port: Port of the running jupyter or None [take the full configure() path].
+        """
+
+        if (self.master is None) or (profile is None) or (not profile['remote_port']):
+            return None
+        if (profile['login_node'] != self.hostname) or (time.time() - profile['verified'] > self.session_length) or \
+                (profile['config_hash'] != render_config(self.user, self.session_length)[1]):
+            return None
+        start = time.time()
+        remote_port = profile['remote_port']
         # UPDATE USER IN DATABASE
         add_db(db_name=DATABASE_NAME,
                user=self.user,
@@ -60,166 +134,111 @@ class JupyterLab(object):
                login_node=self.hostname,
                pid_session=self.pid,
                state_session='initiated')
+        answer = self.master.tcp_request(remote_port, JUPYTER_API_REQUEST)
+        if (answer is None) or (b'"version"' not in answer):
+            logger(user=self.user, message='FAST PATH: NO JUPYTER ON PORT %s' % remote_port, level='WARNING',
+                   phase='verify', latency=time.time() - start, remote_port=remote_port)
+            set_readiness(DATABASE_NAME, self.user, 0, self.hostname)
+            return None
+        set_readiness(DATABASE_NAME, self.user, remote_port, self.hostname)
+        logger(user=self.user, message='FAST PATH: JUPYTER ANSWERED ON PORT %s' % remote_port, level='CRITICAL',
+               phase='verify', latency=time.time() - start, remote_port=remote_port)
+        return remote_port
+
+    def configure(self, start_server=False):
+        """Jupyter configure and checking running instances.
+        Runs remote_bootstrap.py on the login node [one ssh channel, one
+        process] and reads its JSON result. The bootstrap:
+            - Checks scratch2, creates .ipython and the home directory link.
+            - Writes jupyter config and the password hash.
+            - Finds the last running jupyter port or a free port.
+            - Starts jupyter lab if none is running and 'start_server'.
+        """
 
-        child = pexpect.spawn('ssh %s@%s -o StrictHostKeyChecking=no' %
-                              (self.user, self.hostname), encoding='utf-8', timeout=self.timeout, logfile=None)
-        child.expect(['password: '])
-        child.sendline(self.credential)
-
+        start = time.time()
+        logger(user=self.user, message='CHECK IF ANY RUNNING JUPYTER and HASH AND JUPYTER CONFIG', level='INFO',
+               phase='configure')
+        # UPDATE USER IN DATABASE
+        add_db(db_name=DATABASE_NAME,
+               user=self.user,
+               last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               local_port=0,
+               talon_port=0,
+               login_node=self.hostname,
+               pid_session=self.pid,
+               state_session='initiated')
 
-        shell_jupyter_config_path = "python -c \"import os; print('jupyter_config: ',os.path.exists('/storage/scratch2/%s/.jupyter/jupyter_notebook_config.json'))\""%(self.user)
-        shell_free_port = "python -c 'import socket; s=socket.socket(); s.bind((\"\", 0)); print(\"free port:\",s.getsockname()[1])'"
-        # STAUS VARIABLES
-        jupyter_port = None
+        config, config_hash = render_config(self.user, self.session_length)
+        profile = get_profile(DATABASE_NAME, self.user)
+        spec = {'user': self.user,
+                'work_dir': '/storage/scratch2/%s' % self.user,
+                'home_dir': '/home/%s/' % self.user,
+                'config': config,
+                # SAME VERSION AS LAST APPLIED - THE LOGIN NODE ONLY CHECKS THE FILE EXISTS
+                'config_current': (profile is not None) and (profile['config_hash'] == config_hash),
+                'password_hash': password_hash(self.user, self.credential),
+                'start_server': {'jupyter_bin_path': self.jupyter_bin_path, 'python_path': self.python_path,
+                                 'timeout': JUPYTER_START_TIMEOUT, 'warm_pool': WARM_POOL_SOCKET}
+                                if start_server else None}
+        if self.master is not None:
+            # CHANNEL OF THE SSH MASTER - NO PASSWORD
+            command = self.master.command('-o StrictHostKeyChecking=no')
+        else:
+            command = 'ssh %s@%s -o StrictHostKeyChecking=no' % (self.user, self.hostname)
+        command = shlex.split(command) + [remote_command(self.python_path)]
+        # NO ECHO - THE SPEC LINE HAS THE PASSWORD HASH
+        child = pexpect.spawn(command[0], args=command[1:], encoding='utf-8', echo=False, logfile=None,
+                              timeout=self.timeout + (JUPYTER_START_TIMEOUT if start_server else 0))
 
-        # STATE BOOLEAN VARIABLES
-        is_jupyter_config = False
+        # STATE VARIABLES
         is_user = False
-        checking_running_jupyter = False
-        running_jupyter = False
-        configuring_jupyter = False
-
-        # JUPYTER CONFIG FILE
-        allow_remote_access = "sed -i 's/#c.NotebookApp.allow_remote_access = False/c.NotebookApp.allow_remote_access = True/g' .jupyter/jupyter_notebook_config.py"
-        cull_busy = "sed -i 's/#c.MappingKernelManager.cull_busy = False/c.MappingKernelManager.cull_busy = False/g' .jupyter/jupyter_notebook_config.py"
-        cull_connected = "sed -i 's/#c.MappingKernelManager.cull_connected = False/c.MappingKernelManager.cull_connected = True/g' .jupyter/jupyter_notebook_config.py"
-        cull_idle_timeout = "sed -i 's/#c.MappingKernelManager.cull_idle_timeout = 0/c.MappingKernelManager.cull_idle_timeout = %s/g' .jupyter/jupyter_notebook_config.py"%self.session_length
-        cull_interval = "sed -i 's/#c.MappingKernelManager.cull_interval = 300/c.MappingKernelManager.cull_interval = 5/g' .jupyter/jupyter_notebook_config.py"
-        kernel_info_timeout = "sed -i 's/#c.MappingKernelManager.kernel_info_timeout = 60/c.MappingKernelManager.kernel_info_timeout = 60/g' .jupyter/jupyter_notebook_config.py"
-        shutdown_no_activity_timeout = "sed -i 's/#c.NotebookApp.shutdown_no_activity_timeout = 0/c.NotebookApp.shutdown_no_activity_timeout = %s/g' .jupyter/jupyter_notebook_config.py"%self.session_length
-        notebook_dir = "sed -i \"s/#c.NotebookApp.notebook_dir = ''/c.NotebookApp.notebook_dir = '\\/storage\\/scratch2\\/%s\\/'/g\" .jupyter/jupyter_notebook_config.py"%(self.user)
-        map_root_dir = "sed -i \"s/#c.MappingKernelManager.root_dir = ''/c.MappingKernelManager.root_dir = '\\/storage\\/scratch2\\/%s'/g\" .jupyter/jupyter_notebook_config.py"%(self.user)
-        content_root_dir = "sed -i \"s/#c.ContentsManager.root_dir = '\\/'/c.ContentsManager.root_dir = '\\/storage\\/scratch2\\/%s'/g\" .jupyter/jupyter_notebook_config.py"%(self.user)
-        iopub_data_rate_limit = "sed -i 's/#c.NotebookApp.iopub_data_rate_limit = 1000000/c.NotebookApp.iopub_data_rate_limit = 1e10/g' .jupyter/jupyter_notebook_config.py"
-        mathjax_config = "sed -i \"s/#c.NotebookApp.mathjax_config = 'TeX-AMS-MML_HTMLorMML-full,Safe'/c.NotebookApp.mathjax_config = 'TeX-AMS-MML_HTMLorMML-full,Safe'/g\" .jupyter/jupyter_notebook_config.py"
-
-        # LOOP CHECK SHELL
-        while True:
-            try:
-                child.expect('\n')
-                out_line = child.before
-                # ONLY LOG
-                logger(user=self.user, message=str(out_line),
-                       level='INFO', verbose=False)
-
-                # CHECK IF USER EXISTS
-                if "Last login:" in out_line:
-                    # USER EXISTS
-                    is_user = True
-                    logger(user=self.user, message='USER EXISTS!', level='INFO')
-                    # CHANGE PATH
-                    child.sendline("cd /storage/scratch2/%s"%(self.user))
-                    # DEACTIVATE ANY VIRTUALENV
-                    child.sendline('deactivate')
-                    child.sendline('conda deactivate')
-                    # ADD ENVIROMENT VARIABLES
-                    child.sendline('export PATH="$PATH:%s/bin"'%(self.python_path))
-                    child.sendline('export PATH="$PATH:%s/lib"'%(self.python_path))
-                    child.sendline("export IPYTHONDIR=/storage/scratch2/%s/.ipython"%(self.user))
-                    child.sendline("export JUPYTER_CONFIG_DIR=/storage/scratch2/%s/.jupyter"%(self.user))
-                    child.sendline("export JUPYTER_DATA_DIR=/storage/scratch2/%s/.jupyter"%(self.user))
-                    # JUPYTER GENERATE CONFIG .jupyter
-                    child.sendline("%s notebook --generate-config -y"%(self.jupyter_bin_path))
-                    # CREATE .ipyton if not created
-                    child.sendline('mkdir -p .ipython')
-                    # CREATE SYMBOLIK LINK TO HOME DIRECTORY IF NOT EXISTING
-                    child.sendline('test ! -d /storage/scratch2/%s_home_dir && ln -s /home/%s/ %s_home_dir'%(self.user, self.user, self.user))
-                    logger(user=self.user, message='TRY TO CREATE jupyter_notebook_config.py', level='INFO')
-                    # CLEAN BASH HISTORY
-                    child.sendline('history -c')
-                    # CHECK IF jupyter_notebook_config.json CREATED with
-                    child.sendline(shell_jupyter_config_path)
-
-                # CHECK IF JUPYTER CONFIG EXISTS. KNOW THAT USER EXISTS
-                if ('Writing default config to:' in out_line) and is_user:
-                    # SET PASSWORD
-                    # CHANGE jupyter_notebook_config.py
-                    is_jupyter_config = True
-                    logger(user=self.user, message='CREATED jupyter_notebook_config.py!', level='CRITICAL')
-                    # CREATE JUPYTER PASSWORD
-                    child.sendline("%s notebook password"%(self.jupyter_bin_path))
-                    child.expect("Enter password:")
-                    child.sendline(self.credential)
-                    child.expect("Verify password:")
+        password_sent = False
+        result = None
+        try:
+            while True:
+                index = child.expect(['password: ', '\n'])
+                if index == 0:
+                    if password_sent:
+                        # ASKED AGAIN - WRONG PASSWORD
+                        logger(user=self.user, message='LOGIN DENIED!', level='ERROR', phase='login')
+                        break
                     child.sendline(self.credential)
-                    # CLEAN BASH HISTORY
-                    child.sendline('history -c')
-
-                # CHANGE jupyter_notebook_config.py. KNOW THAT JUPYTER PASSWORD IS SET.
-                if ('Wrote hashed password to' in out_line) and is_jupyter_config:
-                    logger(user=self.user, message='JUPYTER PASSWORD IS SET!', level='CRITICAL')
-                    # ALLOW REMOTE ACCESS
-                    child.sendline(allow_remote_access)
-                    # CONFIG FILE jupyter_config.py
-                    child.sendline(cull_busy)
-                    child.sendline(cull_connected)
-                    child.sendline(cull_idle_timeout)
-                    child.sendline(cull_interval)
-                    child.sendline(kernel_info_timeout)
-                    child.sendline(shutdown_no_activity_timeout)
-                    child.sendline(notebook_dir)
-                    child.sendline(map_root_dir)
-                    child.sendline(content_root_dir)
-                    child.sendline(iopub_data_rate_limit)
-                    child.sendline(mathjax_config)
-                    logger(user=self.user, message='CONFIGURED jupyter_notebook_config.py!', level='CRITICAL')
-                    # CLEAN BASH HISTORY
-                    child.sendline('history -c')
-                    # GRAB UNUSED PORT ON HPC
-                    child.sendline('history -c && %s'%(shell_free_port))
-
-                # GRAB FREE PORT [IN CASE OF NO RUNNING JUPYTER]
-                if ("('free port:'," in out_line):
-                    jupyter_port = (out_line.split(",")[1].split(")")[0])
-                    logger(user=self.user, message='FOUND FREE PORT: %s'%jupyter_port,level='CRITICAL')
-                    # GRAB LAST PORT OF RUNNING NOTEBOOK IF EXISTS
-                    child.sendline('history -c && %s notebook list'%(self.jupyter_bin_path))
-
-                # SEE RUNNING JUPYTER PORTS
-                if ('Currently running servers:' in out_line):
-                    # LOOKING FOR RUNNING JUPYTER INSTANCES
-                    logger(user=self.user, message='LOOKING FOR RUNNING SERVERS',level='CRITICAL')
-                    checking_running_jupyter = True
-
-                # GRAB LAST RUNNING JUPYTER. KNOW THAT USERS EXISTS, COFIGURE SET AND LOOKING FOR JUPYTER
-                if ("http://" in out_line) and checking_running_jupyter:
-                    # GRAB LAST RUNNING JUPYTER PORT
-                    logger(user=self.user, message='GRAB LAST RUNNING JUPYTER NOTEBOOK PORT', level='INFO')
-                    jupyter_port = (out_line.split(":")[2].split("/")[0])
-                    # FOUND RUNNING JUPYTER
-                    running_jupyter = True
-                    # STOP LOOKING FOR RUNNING JUPYTER NOTEBOOKS SERVERS
-                    checking_running_jupyter = False
-                    logger(user=self.user, message='jupyter_port %s' %
-                           jupyter_port, level='CRITICAL')
-                    # CLEAN BASH HISTORY
-                    child.sendline('history -c')
-                    child.close(force=True)
-                    return is_user, running_jupyter, jupyter_port
-
-                # CHECK IF JUPYTER CONFIG NOT EXISTS. KNOW THAT USER EXISTS.
-                if ("('jupyter_config: ', False)" in out_line) and is_user:
-                    # JUPYTER CONFIG NOT EXISTS AND USER EXISTS
-                    logger(user=self.user, message='JUPYTER FAILED TO CREATE CONFIG FILE!',level='ERROR')
-                    logger(user=self.user, message='FUNCTION ENDED!', level='ERROR')
-                    # CLEAN BASH HISTORY
-                    child.sendline('history -c')
-                    child.close(force=True)
+                    password_sent = True
+                    continue
+                out_line = child.before.strip()
+                if out_line.startswith(RESULT_MARKER):
+                    result = json.loads(out_line[len(RESULT_MARKER):])
                     break
-
-
-            except:
-                logger(user=self.user, message='jupyter_port %s' %
-                       jupyter_port, level='CRITICAL')
-                logger(user=self.user, message="FUNCTION 'configure()' ENDED!", level='WARNING')
-                # CLEAN BASH HISTORY
-                child.sendline('history -c')
-                child.close(force=True)
-                break
-
-        if jupyter_port is None:
-            logger(user=self.user, message='NO RUNNING JUPYTER NOTEBOOK', level='WARNING')
-        return is_user, running_jupyter, jupyter_port
+                # ONLY KEEP IN TRANSCRIPT
+                self.transcript.append(out_line)
+                # BOOTSTRAP STARTED - USER EXISTS
+                if (BOOTSTRAP_READY in out_line) and not is_user:
+                    is_user = True
+                    logger(user=self.user, message='USER EXISTS!', level='INFO', phase='login',
+                           latency=time.time() - start)
+                    child.sendline(json.dumps(spec))
+        except Exception as e:
+            logger(user=self.user, message="FUNCTION 'configure()' ENDED! %s" % type(e).__name__, level='WARNING')
+        child.close(force=True)
+
+        if (result is None) or (not result.get('ok')):
+            logger(user=self.user, message='BOOTSTRAP FAILED! %s' % (result or {}).get('error'), level='ERROR',
+                   phase='configure', latency=time.time() - start)
+            if is_user:
+                self.transcript.persist('configure failed')
+            return is_user, False, None
+        if not spec['config_current']:
+            set_config_hash(DATABASE_NAME, self.user, config_hash)
+        # RUNNING JUPYTER IS THE NEXT FAST PATH [A NEW ONE IS RECORDED BY forward()]
+        set_readiness(DATABASE_NAME, self.user, result['port'] if result['running'] else 0, self.hostname)
+        if result.get('error'):
+            logger(user=self.user, message='BOOTSTRAP: %s' % result['error'], level='ERROR', phase='configure')
+        logger(user=self.user,
+               message='jupyter_port %s RUNNING %s STARTED %s WARM %s CONFIG %s %s [BOOTSTRAP %ss]' %
+               (result['port'], result['running'], result.get('started'), result.get('warm'), config_hash,
+                'WRITTEN' if result['config_written'] else 'UNCHANGED', result.get('seconds')),
+               level='CRITICAL', phase='configure', latency=time.time() - start, remote_port=result['port'])
+        return is_user, result['running'], result['port']
 
 
 
@@ -241,6 +260,7 @@ class JupyterLab(object):
         except:
             logger(user=self.user, message='INVALID REMOTE PORT!', level='ERROR')
             logger(user=self.user, message="FUNCTION 'forward()' ENDED!", level='ERROR')
+            report(DATABASE_NAME, self.token, self.user, 'failed', 'ended None')
             # UPDATE USER IN DATABASE
             add_db(db_name=DATABASE_NAME,
                    user=self.user,
@@ -252,29 +272,39 @@ class JupyterLab(object):
                    state_session='ended')
             return
 
-        logger(user=self.user, message='FREE LOCAL PORT: %s'%local_port, level='INFO')
-        child = pexpect.spawn('ssh -L 0.0.0.0:%s:127.0.0.1:%s  %s@%s -o StrictHostKeyChecking=no' %
-                              (local_port, remote_port, self.user, self.hostname), encoding='utf-8', timeout=self.session_length, logfile=None)
-        child.expect(['password: '])
-        child.sendline(self.credential)
-        # login staus variables
-        first_line = False
+        start = time.time()
+        logger(user=self.user, message='FREE LOCAL PORT: %s'%local_port, level='INFO', phase='login',
+               local_port=local_port, remote_port=remote_port)
+        if self.master is not None:
+            # FORWARD AS A CHANNEL OF THE SSH MASTER - NO PASSWORD
+            child = pexpect.spawn(self.master.command('-L 0.0.0.0:%s:127.0.0.1:%s -o StrictHostKeyChecking=no' %
+                                                      (local_port, remote_port)),
+                                  encoding='utf-8', timeout=self.session_length, logfile=None)
+            child.sendline(READY_COMMAND)
+        else:
+            child = pexpect.spawn('ssh -L 0.0.0.0:%s:127.0.0.1:%s  %s@%s -o StrictHostKeyChecking=no' %
+                                  (local_port, remote_port, self.user, self.hostname), encoding='utf-8', timeout=self.session_length, logfile=None)
+            child.expect(['password: '])
+            child.sendline(self.credential)
+        # login staus variables [MASTER IS ALREADY LOGGED IN - WAIT FOR READY_MARKER]
+        first_line = self.master is not None
         is_logged = False
         # LOOP CHECK SHELL
         while True:
             try:
                 child.expect('\n')
                 out_line = child.before
-                logger(user=self.user, message=str(out_line), level='INFO', verbose=False)
+                self.transcript.append(out_line)
 
                 # FIRST LINE OF THE LOGIN
                 if (" " in out_line) and not first_line:
                     first_line = True
 
                 # LOGIN IS SUCCESSFULL
-                if ("Last login:" in out_line) and first_line:
+                if (("Last login:" in out_line) or (READY_MARKER in out_line)) and first_line and not is_logged:
                     is_logged = True
-                    logger(user=self.user, message='LOGIN TO HPC SUCCESSFULL! STARTING JUPYTER...', level='CRITICAL')
+                    logger(user=self.user, message='LOGIN TO HPC SUCCESSFULL! STARTING JUPYTER...', level='CRITICAL',
+                           phase='login', latency=time.time() - start)
                     # CHANGE PATH
                     child.sendline("cd /storage/scratch2/%s"%(self.user))
                     # DEACTIVATE ANY VIRTUALENV
@@ -289,40 +319,31 @@ class JupyterLab(object):
                     # CLEAN BASH HISTORY
                     child.sendline('history -c')
                     if running_instance is False:
+                        report(DATABASE_NAME, self.token, self.user, 'starting')
                         # NEED NEW JUPYTER INSTANCE [MAKE SURE TO KEEP WATCHING OUTPUT]
                         child.sendline("nohup %s lab --no-browser --ip=0.0.0.0 --port=%s &> .jupyter_lab.log & tail -f .jupyter_lab.log"%(self.jupyter_bin_path, remote_port))
 
-                # JUPYTER PORT FORWARDED
-                if (running_instance is True) and (is_logged is True):
+                # JUPYTER PORT FORWARDED [ONCE - THIS LOOP RUNS FOR EVERY OUTPUT LINE]
+                if (running_instance is True) and (is_logged is True) and (self.recorded_running is False):
                     logger(user=self.user, message='JUPYTER FORWARDED. LOCAL PORT: %s REMOTE PORT: %s'%
-                            (local_port, remote_port), level='CRITICAL')
-                    # UPDATE USER IN DATABASE
-                    add_db(db_name=DATABASE_NAME,
-                           user=self.user,
-                           last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                           local_port=local_port,
-                           talon_port=remote_port,
-                           login_node=self.hostname,
-                           pid_session=self.pid,
-                           state_session='running')
+                            (local_port, remote_port), level='CRITICAL', phase='forward',
+                           latency=time.time() - start, local_port=local_port, remote_port=remote_port)
+                    self.record_running(local_port, remote_port)
 
                 # JUPYTER STARTED SUCCESSFULLY
                 if ('The Jupyter Notebook is running at' in out_line) and (is_logged is True):
                     logger(user=self.user, message='JUPYTER STARTED SUCCESSFULLY. LOCAL PORT: %s REMOTE PORT: %s'%
-                            (local_port, remote_port), level='CRITICAL')
-                    # UPDATE USER IN DATABASE
-                    add_db(db_name=DATABASE_NAME,
-                           user=self.user,
-                           last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                           local_port=local_port,
-                           talon_port=remote_port,
-                           login_node=self.hostname,
-                           pid_session=self.pid,
-                           state_session='running')
-
-                # LOGIN FAILED
-                if ("Last login:" not in out_line) and first_line and not is_logged:
-                    logger(user=self.user, message='LOGIN FAILED!', level='ERROR')
+                            (local_port, remote_port), level='CRITICAL', phase='forward',
+                           latency=time.time() - start, local_port=local_port, remote_port=remote_port)
+                    set_readiness(DATABASE_NAME, self.user, remote_port, self.hostname)
+                    self.record_running(local_port, remote_port)
+
+                # LOGIN FAILED [NOT WITH THE MASTER - LINES BEFORE READY_MARKER ARE EXPECTED]
+                if ("Last login:" not in out_line) and first_line and not is_logged and (self.master is None):
+                    logger(user=self.user, message='LOGIN FAILED!', level='ERROR', phase='login',
+                           latency=time.time() - start)
+                    self.transcript.persist('login failed')
+                    report(DATABASE_NAME, self.token, self.user, 'failed', 'ended None')
                     # UPDATE USER IN DATABASE
                     add_db(db_name=DATABASE_NAME,
                            user=self.user,
@@ -337,8 +358,14 @@ class JupyterLab(object):
                     child.close(force=True)
                     break
 
-            except:
-                logger(user=self.user, message='forward_port ENDED', level='WARNING')
+            except Exception as e:
+                logger(user=self.user, message='forward_port ENDED', level='WARNING', phase='forward',
+                       latency=time.time() - start, local_port=local_port, remote_port=remote_port)
+                # SESSION LENGTH REACHED IS NOT A FAILURE
+                if not isinstance(e, pexpect.TIMEOUT):
+                    self.transcript.persist('forward ended: %s' % type(e).__name__)
+                if not self.reported_running:
+                    report(DATABASE_NAME, self.token, self.user, 'failed', 'ended None')
                 # UPDATE USER IN DATABASE
                 add_db(db_name=DATABASE_NAME,
                        user=self.user,
@@ -355,17 +382,27 @@ class JupyterLab(object):
         return
 
 
-def jupyter_run(conn, user, credential, hostname, python_path, jupyter_bin_path, session_length):
+def jupyter_run(conn, user, credential, hostname, python_path, jupyter_bin_path, session_length, token=None):
     """Functions wrapper for python multiprocessing.
 
     Args:
-        conn: Multi-process connection.
+        conn: Multi-process connection [None - nobody waits for the answer].
         _euid: User id.
         _pass: Password for login to HPC.
         hostname: Hostname of HPC.
         session_timeout: Seconds until end session.
+        token: Login progress token [login_progress].
     """
 
+    def answer(message):
+        # SEND MESSAGE TO MASTER PROCESS
+        if conn is not None:
+            conn.send(message)
+            conn.close()
+        if not message.startswith('running'):
+            report(DATABASE_NAME, token, user, 'failed', message)
+        return
+
     try:
         session_length = int(session_length)
     except:
@@ -378,29 +415,77 @@ def jupyter_run(conn, user, credential, hostname, python_path, jupyter_bin_path,
                login_node=hostname,
                pid_session=0,
                state_session='ended')
-        # SEND MESSAGE TO MASTER PROCESS
-        conn.send('ended 0')
-        conn.close()
+        answer('ended 0')
         return
 
     pid = os.getpid()
     # CREATE INSTANCE
     jupyter_instance = JupyterLab(user, credential, hostname, python_path, jupyter_bin_path, pid, session_length)
-    # CHECK CONFIGURATION
-    user_exists, running_jupyter, jupyter_port = jupyter_instance.configure()
-
-    # GRAB FREE LOCAL PORT
-    free_port = find_free_port(min_port=START_OPEN_PORT, max_port=END_OPEN_PORT)
+    jupyter_instance.token = token
+    # ADMIN CAN ASK FOR THE TRANSCRIPT OF THIS SESSION WITH SIGUSR1
+    jupyter_instance.transcript.persist_on_signal()
+    # kill_pid() [NEW LOGIN OR REAPER] - EXIT THROUGH finally TO RELEASE THE PORT
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # ONE SSH LOGIN FOR configure() AND forward()
+    master = SSHMaster(user, credential, hostname)
+    report(DATABASE_NAME, token, user, 'authenticating')
+    master_state = master.start() if SSH_MASTER else 'failed'
+    if master_state == 'ready':
+        jupyter_instance.master = master
+    try:
+        # FORWARD WITH THE TUNNEL DAEMON [JUPYTER IS STARTED BY THE BOOTSTRAP, THIS PROCESS EXITS]
+        use_daemon = TUNNEL_DAEMON and (tunnel_daemon() is not None)
+        # CHECK CONFIGURATION [NOT NEEDED IF THE LOGIN WAS DENIED OR JUPYTER IS KNOWN TO RUN]
+        remote_port = None
+        if master_state != 'denied':
+            report(DATABASE_NAME, token, user, 'configuring')
+        if FAST_PATH and (master_state == 'ready'):
+            remote_port = jupyter_instance.fast_path(get_profile(DATABASE_NAME, user))
+        if master_state == 'denied':
+            user_exists, running_jupyter, jupyter_port = False, False, None
+        elif remote_port is not None:
+            user_exists, running_jupyter, jupyter_port = True, True, remote_port
+        else:
+            if use_daemon:
+                report(DATABASE_NAME, token, user, 'starting')
+            user_exists, running_jupyter, jupyter_port = jupyter_instance.configure(start_server=use_daemon)
+
+        free_port = None
+        if user_exists is True:
+            if jupyter_port is not None:
+                report(DATABASE_NAME, token, user, 'forwarding')
+                # LEASE FREE LOCAL PORT
+                free_port = allocate_port(db_name=DATABASE_NAME, user=user, pid=pid,
+                                          max_age=SESSION_LENGTH + PORT_LEASE_MARGIN)
+            if (jupyter_port is not None) and (free_port is not None) and use_daemon and running_jupyter and \
+                    open_tunnel(user, credential, hostname, free_port, jupyter_port, session_length, pid):
+                # THE DAEMON HOLDS THE TUNNEL, THE PORT LEASE AND THE SESSION
+                answer('running %s'%free_port)
+                jupyter_instance.running(free_port, jupyter_port)
+            elif (jupyter_port is not None) and (free_port is not None):
+                answer('running %s'%free_port)
+                try:
+                    # FORWARD JUPYTER INSTANCE
+                    jupyter_instance.forward(local_port=free_port, remote_port=jupyter_port,
+                                             running_instance=running_jupyter)
+                finally:
+                    # SESSION ENDED - PORT BACK TO THE POOL
+                    release_port(db_name=DATABASE_NAME, port=free_port, pid=pid)
+            else:
+                logger(user=user, message='USER %s WAS NOT ABLE TO GET JUPYTER PORT [MAYBE NOT RUNNING OR FREE PORT]!'%user, level='ERROR')
+                # UPDATE USER IN DATABASE
+                add_db(db_name=DATABASE_NAME,
+                       user=user,
+                       last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       local_port=0,
+                       talon_port=0,
+                       login_node=hostname,
+                       pid_session=0,
+                       state_session='ended')
+                answer('ended None')
 
-    if user_exists is True:
-        if jupyter_port is not None:
-            # SEND MESSAGE TO MASTER PROCESS
-            conn.send('running %s'%free_port)
-            conn.close()
-            # FORWARD JUPYTER INSTANCE
-            jupyter_instance.forward(local_port=free_port, remote_port=jupyter_port, running_instance=running_jupyter)
         else:
-            logger(user=user, message='USER %s WAS NOT ABLE TO GET JUPYTER PORT [MAYBE NOT RUNNING OR FREE PORT]!'%user, level='ERROR')
+            logger(user=user, message='USER %s DOES NOT EXIST!'%user, level='ERROR')
             # UPDATE USER IN DATABASE
             add_db(db_name=DATABASE_NAME,
                    user=user,
@@ -410,22 +495,9 @@ def jupyter_run(conn, user, credential, hostname, python_path, jupyter_bin_path,
                    login_node=hostname,
                    pid_session=0,
                    state_session='ended')
-            # SEND MESSAGE TO MASTER PROCESS
-            conn.send('ended None')
-            conn.close()
-
-    else:
-        logger(user=user, message='USER %s DOES NOT EXIST!'%user, level='ERROR')
-        # UPDATE USER IN DATABASE
-        add_db(db_name=DATABASE_NAME,
-               user=user,
-               last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-               local_port=0,
-               talon_port=0,
-               login_node=hostname,
-               pid_session=0,
-               state_session='ended')
-        # SEND MESSAGE TO MASTER PROCESS
-        conn.send('ended %s'%free_port)
-        conn.close()
+            # ANY PORT BUT 'None' MEANS INVALID CREDENTIALS
+            answer('ended 0')
+    finally:
+        # CLOSE THE SSH MASTER AND ALL ITS CHANNELS
+        master.stop()
     return
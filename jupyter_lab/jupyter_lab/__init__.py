@@ -10,7 +10,13 @@ email georgemihaila@my.unt.edu
 import os
 import sys
 from flask import Flask
-from sqlite_database import create_db
+from helper_functions import configure_logger
+from sqlite_database import create_db, start_writer
+from session_history import start_compaction
+from port_allocator import setup_pool
+from session_reaper import reap_sessions, start_reaper
+from tunnel_daemon import start_tunnel_daemon
+from prewarm import start_prewarm
 
 # ENVIROMENT VARIABLES
 START_OPEN_PORT = 9000
@@ -20,6 +26,41 @@ HOSTNAME = 'vis.acs.unt.edu'
 PYTHON_PATH = '/cm/shared/utils/PYTHON/3.6.5'
 JUPYTER_BIN_PATH = '/cm/shared/utils/PYTHON/3.6.5/bin/jupyter'
 SESSION_LENGTH = 7200 # 2 hours
+SSH_MASTER = True # ONE SSH LOGIN PER SESSION [configure AND forward ARE CHANNELS OF IT]
+TUNNEL_DAEMON = True # ALL PORT FORWARDS IN ONE asyncssh PROCESS [ssh -L PER SESSION IF asyncssh IS MISSING]
+ORCHESTRATOR = True # LOGINS RUN AS COROUTINES IN THE TUNNEL DAEMON [NO PROCESS FORKED PER LOGIN]
+JUPYTER_START_TIMEOUT = 60 # SECONDS TO WAIT FOR A NEW JUPYTER [STARTED BY THE BOOTSTRAP FOR THE TUNNEL DAEMON]
+WARM_POOL_SOCKET = '/var/run/jupyter_warm_pool.sock' # warm_pool.py ON THE LOGIN NODE [None - ALWAYS COLD START]
+WARM_POOL_SIZE = 4 # PARKED PROCESSES OF THE WARM POOL OUTSIDE PREDICTED WINDOWS [warm_pool.py --size]
+WARM_POOL_PATH = '/opt/jupyter_gateway/warm_pool.py' # warm_pool.py ON THE LOGIN NODE
+PREWARM = True # PREDICT LOGINS FROM THE LOGIN HISTORY AND GROW THE WARM POOL AHEAD OF THEM
+PREWARM_ACCOUNT = None # 'account@login node' WITH AN ssh KEY TO RESIZE THE WARM POOL [None - PREDICT AND REPORT ONLY]
+PREWARM_INTERVAL = 300 # SECONDS BETWEEN PREDICTIONS
+PREWARM_WINDOW = 1800 # SECONDS OF THE WEEKLY WINDOW PREDICTED
+PREWARM_WEEKS = 4 # WEEKS OF LOGIN HISTORY USED [KEEP UNDER EVENTS_RETENTION_DAYS]
+PREWARM_MIN_WEEKS = 2 # WEEKS WITH A LOGIN IN THE SAME WINDOW TO PREDICT A USER
+PREWARM_MAX = 20 # MOST SPECULATIVE JUPYTER PROCESSES ADDED TO THE WARM POOL
+READY_TIMEOUT = 30 # SECONDS TO PROBE A FORWARDED PORT UNTIL JUPYTER ANSWERS [THE BROWSER IS SENT THERE AFTER]
+FAST_PATH = True # RETURNING USERS WITH A VERIFIED RUNNING JUPYTER SKIP configure [NEEDS SSH_MASTER]
+PORT_LEASE_MARGIN = 600 # SECONDS A LOCAL PORT LEASE IS KEPT AFTER SESSION_LENGTH
+REAPER_INTERVAL = 10 # SECONDS BETWEEN CHECKS OF SESSION PROCESSES, TUNNELS AND PORTS
+INITIATED_TIMEOUT = 300 # SECONDS A SESSION CAN STAY 'initiated' WITHOUT A PROCESS
+DATABASE_WRITER = True # ONE PROCESS WRITES ALL SESSION STATE TO THE DATABASE
+EVENTS_RETENTION_DAYS = 30 # RAW SESSION EVENTS KEPT BEFORE ROLLING INTO HOURLY AGGREGATES
+EVENTS_MAX_ROWS = 1000000 # MOST RAW SESSION EVENTS KEPT
+LOG_QUEUE_SIZE = 10000 # MOST LOG LINES WAITING TO BE WRITTEN
+LOG_FLUSH_INTERVAL = 0.5 # SECONDS BETWEEN LOG WRITES
+LOG_QUEUE_POLICY = 'drop' # 'drop' OR 'block' WHEN THE LOG QUEUE IS FULL
+LOG_MAX_OPEN_FILES = 256 # MOST LOG FILES KEPT OPEN
+LOG_MAX_BYTES = 50 * 1024 * 1024 # ROTATE A USER LOG AFTER 50MB
+LOG_MAX_AGE = 7 * 86400 # ROTATE A USER LOG AFTER 7 DAYS
+LOG_FORMAT = 'text' # 'text' OR 'json' [JSON LINES, SEE log_index.py]
+TRANSCRIPT_LINES = 500 # LAST LINES OF REMOTE OUTPUT KEPT IN MEMORY PER SESSION
+ADMIN_IPS = ['127.0.0.1'] # CLIENTS ALLOWED ON /admin ROUTES
+
+# LOG WRITER
+configure_logger(queue_size=LOG_QUEUE_SIZE, flush_interval=LOG_FLUSH_INTERVAL, policy=LOG_QUEUE_POLICY,
+                 max_open_files=LOG_MAX_OPEN_FILES, max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE, log_format=LOG_FORMAT)
 
 # CHECK DATABASE
 if create_db(db_name=DATABASE_NAME):
@@ -28,6 +69,34 @@ else:
     print(' * Database failed!\nQuit app...',  file=sys.stderr)
     sys.exit()
 
+# LOCAL PORT POOL [RECLAIMS PORTS OF SESSIONS THAT DID NOT SURVIVE A RESTART]
+print(' * Local ports in pool: %d' % setup_pool(db_name=DATABASE_NAME, min_port=START_OPEN_PORT,
+                                                max_port=END_OPEN_PORT, max_age=SESSION_LENGTH + PORT_LEASE_MARGIN))
+
+# START DATABASE WRITER [BEFORE ANY SESSION PROCESS IS FORKED]
+if DATABASE_WRITER:
+    start_writer(db_name=DATABASE_NAME)
+
+# TUNNEL DAEMON [AFTER THE WRITER - IT SAVES SESSION STATE THROUGH IT]
+if TUNNEL_DAEMON:
+    print(' * Tunnel daemon: %s' % ('ready' if start_tunnel_daemon(db_name=DATABASE_NAME) else 'not started'))
+
+# END SESSIONS LEFT BY A PREVIOUS RUN, THEN KEEP CHECKING
+print(' * Sessions reaped: %s' % reap_sessions(db_name=DATABASE_NAME, initiated_timeout=INITIATED_TIMEOUT,
+                                                max_age=SESSION_LENGTH + PORT_LEASE_MARGIN))
+start_reaper(db_name=DATABASE_NAME, interval=REAPER_INTERVAL, initiated_timeout=INITIATED_TIMEOUT,
+             max_age=SESSION_LENGTH + PORT_LEASE_MARGIN)
+
+# PREDICTED LOGINS [AFTER THE REAPER - SESSIONS LEFT RUNNING ARE ENDED]
+if PREWARM:
+    start_prewarm(db_name=DATABASE_NAME, hostname=HOSTNAME, session_length=SESSION_LENGTH,
+                  interval=PREWARM_INTERVAL, window=PREWARM_WINDOW, weeks=PREWARM_WEEKS, min_weeks=PREWARM_MIN_WEEKS, max_prewarm=PREWARM_MAX,
+                  pool_size=WARM_POOL_SIZE, account=PREWARM_ACCOUNT, python_path=PYTHON_PATH,
+                  pool_path=WARM_POOL_PATH, pool_socket=WARM_POOL_SOCKET)
+
+# COMPACT SESSION EVENTS HISTORY EVERY HOUR
+start_compaction(db_name=DATABASE_NAME, retention_days=EVENTS_RETENTION_DAYS, max_events=EVENTS_MAX_ROWS)
+
 # FLASK APP
 app = Flask(__name__)
 from jupyter_lab import routes
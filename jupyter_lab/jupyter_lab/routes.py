@@ -7,16 +7,88 @@ Start the server with the 'run()' method
 email georgemihaila@my.unt.edu
 """
 
+import os
 import time
+import signal
 from datetime import datetime
-from multiprocessing import Process, Pipe
-from flask import render_template, redirect, url_for, request
+from multiprocessing import Process
+from flask import render_template, redirect, url_for, request, jsonify, abort, Response, stream_with_context
 # LOCAL IMPORTS
-from jupyter_lab import app, DATABASE_NAME, HOSTNAME, PYTHON_PATH, JUPYTER_BIN_PATH, SESSION_LENGTH
-from helper_functions import logger,kill_pid
-from sqlite_database import from_db, add_db
+from jupyter_lab import app, DATABASE_NAME, HOSTNAME, PYTHON_PATH, JUPYTER_BIN_PATH, SESSION_LENGTH, ADMIN_IPS, \
+    ORCHESTRATOR, FAST_PATH, JUPYTER_START_TIMEOUT, PORT_LEASE_MARGIN, READY_TIMEOUT, \
+    WARM_POOL_SOCKET
+from helper_functions import logger, kill_pid, pid_alive, logger_metrics
+from sqlite_database import from_db, add_db, writer_metrics, cache_metrics
 from jupyter_instance import jupyter_run
+from usage_stats import usage_summary
+from transcript import transcript_path
+from port_allocator import port_metrics
+from session_reaper import reaper_metrics
+from tunnel_daemon import tunnel_daemon, close_tunnel, tunnel_metrics, login_session, daemon_socket
+from prewarm import prewarm_metrics, precision_report
+from login_progress import new_token, report, progress, FINAL_PHASES
 
+# SECONDS ONE /progress/<token>/events RESPONSE STAYS OPEN [THE BROWSER RECONNECTS]
+PROGRESS_STREAM_SECONDS = 30
+# SECONDS BETWEEN PROGRESS CHECKS OF AN OPEN STREAM
+PROGRESS_POLL_INTERVAL = 0.25
+# PAGE TEXT OF FAILED LOGINS
+LOGIN_ERRORS = {'ended 0': 'Invalid Credentials. Please try again.',
+                'ended None': 'Server error! Please report to HPC-Admin!'}
+
+
+def fail_session(user_id, token):
+    '''End a login that could not be started, so the user is not left 'initiated'.
+    '''
+
+    add_db(db_name=DATABASE_NAME,
+           user=user_id,
+           last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+           local_port=0,
+           talon_port=0,
+           login_node=HOSTNAME,
+           pid_session=0,
+           state_session='ended')
+    report(DATABASE_NAME, token, user_id, 'failed', 'ended None')
+    return
+
+
+def start_session(user_id, user_credential):
+    '''Start the login of a user without waiting for it.
+    With ORCHESTRATOR and a running tunnel daemon the login is one message to
+    the daemon [no process is forked]; otherwise a session process runs
+    jupyter_run(). Both report the phases of the login under the returned
+    token [login_progress], the browser follows them on /progress/<token>.
+
+    Return:
+        token: Login progress token.
+    '''
+
+    token = new_token()
+    report(DATABASE_NAME, token, user_id, 'queued')
+    if ORCHESTRATOR and (tunnel_daemon() is not None):
+        if login_session(user_id, user_credential, HOSTNAME, PYTHON_PATH, JUPYTER_BIN_PATH, SESSION_LENGTH,
+                         wait=False, token=token, start_timeout=JUPYTER_START_TIMEOUT, fast_path=FAST_PATH,
+                         lease_max_age=SESSION_LENGTH + PORT_LEASE_MARGIN, ready_timeout=READY_TIMEOUT,
+                         warm_pool=WARM_POOL_SOCKET) is not None:
+            # DAEMON DID NOT TAKE THE LOGIN
+            fail_session(user_id, token)
+        return token
+    # SEPARATE PYTHON PROCESS [NOBODY WAITS ON A PIPE]
+    python_process = Process(target=jupyter_run, args=(None,
+                                                        user_id, user_credential,
+                                                        HOSTNAME,
+                                                        PYTHON_PATH,
+                                                        JUPYTER_BIN_PATH,
+                                                        SESSION_LENGTH,
+                                                        token))
+    try:
+        python_process.start()
+    except Exception as e:
+        logger(user=user_id, message='SESSION PROCESS NOT STARTED! %s: %s' % (type(e).__name__, str(e)),
+               level='ERROR')
+        fail_session(user_id, token)
+    return token
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -56,38 +128,9 @@ def home():
                    pid_session=0,
                    state_session='initiated')
 
-            # SEPARATE PYTHON PROCESS
-            # CREATE SEPARATE PROCESS PIPELINE COMMUNICATION
-            parent_conn, child_conn = Pipe()
-            # START SEPARATE PYTHON PROCESS
-            python_process = Process(target=jupyter_run, args=(parent_conn,
-                                                                user_id, user_credential,
-                                                                HOSTNAME,
-                                                                PYTHON_PATH,
-                                                                JUPYTER_BIN_PATH,
-                                                                SESSION_LENGTH))
-            python_process.start()
-
-            # expect communication from instance pipe communicaiton
-            process_message = child_conn.recv()
-            state_session, jupyter_port = process_message.split()
-
-            # CHECK SESSION STATE
-            if state_session == 'ended':
-                if jupyter_port == 'None':
-                    # CONNECTION FAILED
-                    logger(user=user_id, message='SERVER ERROR!', level='ERROR')
-                    return render_template('login.html', error='Server error! Please report to HPC-Admin!')
-                else:
-                    # CONNECTION FAILED
-                    logger(user=user_id, message='INVALID CREDENTIAL', level='ERROR')
-                    return render_template('login.html', error='Invalid Credentials. Please try again.')
-            else:
-                # CONNECTION SUCCESSFULL
-                ide_link = "http://jupyterlab.hpc.unt.edu:%s"%(jupyter_port)
-                time.sleep(5)
-                logger(user=user_id, message='FORWARDING LOGIN PAGE TO JUPYTER LAB!', level='INFO')
-                return redirect(ide_link)
+            # LOGIN IN THE ORCHESTRATOR OR A SEPARATE PYTHON PROCESS - FOLLOWED ON THE PROGRESS PAGE
+            token = start_session(user_id, user_credential)
+            return redirect(url_for('login_progress_page', token=token))
 
 
         # USER IN PROCESS OF LOGGING IN
@@ -99,7 +142,10 @@ def home():
         # JUPYTER SESSION RUNNING OR ENDED
         elif (user_log['state_session'] == 'running') or (user_log['state_session'] == 'ended'):
             # KILL PREVIOUS PID IF EXISTING
-            if user_log['pid_session']!=0: kill_pid(pid=user_log['pid_session'])
+            if user_log['pid_session'] and (daemon_socket(user_log['pid_session']) is not None):
+                # TUNNEL HELD BY THE TUNNEL DAEMON OF ANY GATEWAY WORKER - CLOSE IT, NEVER KILL THE DAEMON
+                close_tunnel(user_id, pid=user_log['pid_session'])
+            elif user_log['pid_session']!=0: kill_pid(pid=user_log['pid_session'])
             # UPDATE USER IN DATABASE
             add_db(db_name=DATABASE_NAME,
                    user=user_id,
@@ -110,38 +156,103 @@ def home():
                    pid_session=0,
                    state_session='initiated')
 
-            # SEPARATE PYTHON PROCESS
-            # CREATE SEPARATE PROCESS PIPELINE COMMUNICATION
-            parent_conn, child_conn = Pipe()
-            # START SEPARATE PYTHON PROCESS
-            python_process = Process(target=jupyter_run, args=(parent_conn,
-                                                                user_id, user_credential,
-                                                                HOSTNAME,
-                                                                PYTHON_PATH,
-                                                                JUPYTER_BIN_PATH,
-                                                                SESSION_LENGTH))
-            python_process.start()
-
-            # expect communication from instance pipe communicaiton
-            process_message = child_conn.recv()
-            state_session, jupyter_port = process_message.split()
-
-            # CHECK SESSION STATE
-            if state_session == 'ended':
-                if jupyter_port == 'None':
-                    # CONNECTION FAILED
-                    logger(user=user_id, message='SERVER ERROR!', level='ERROR')
-                    return render_template('login.html', error='Server error! Please report to HPC-Admin!')
-                else:
-                    # CONNECTION FAILED
-                    logger(user=user_id, message='INVALID CREDENTIAL', level='ERROR')
-                    return render_template('login.html', error='Invalid Credentials. Please try again.')
-            else:
-                # CONNECTION SUCCESSFULL
-                ide_link = "http://jupyterlab.hpc.unt.edu:%s"%(jupyter_port)
-                time.sleep(5)
-                logger(user=user_id, message='FORWARDING LOGIN PAGE TO JUPYTER LAB!', level='INFO')
-                return redirect(ide_link)
+            # LOGIN IN THE ORCHESTRATOR OR A SEPARATE PYTHON PROCESS - FOLLOWED ON THE PROGRESS PAGE
+            token = start_session(user_id, user_credential)
+            return redirect(url_for('login_progress_page', token=token))
 
 
     return render_template('login.html', login='login')
+
+
+@app.route('/progress/<token>', methods=['GET'])
+def login_progress_page(token):
+    '''Page following a login started by home() [see progress_events()].
+    '''
+
+    if not progress(DATABASE_NAME, token):
+        abort(404)
+    return render_template('login.html', progress_token=token,
+                           progress_events=url_for('progress_events', token=token))
+
+
+@app.route('/progress/<token>/events', methods=['GET'])
+def progress_events(token):
+    '''Phases of a login as server-sent events. Every event id is the phase
+    sequence number, so a reconnecting browser [Last-Event-ID] only gets new
+    phases. The stream ends after the last phase or PROGRESS_STREAM_SECONDS.
+    Events 'running' and 'not_ready' have the jupyter link, events 'failed'
+    the error text.
+    '''
+
+    after = request.headers.get('Last-Event-ID', default=0, type=int)
+    if not progress(DATABASE_NAME, token):
+        abort(404)
+
+    def events(after):
+        deadline = time.time() + PROGRESS_STREAM_SECONDS
+        while time.time() < deadline:
+            for phase in progress(DATABASE_NAME, token, after=after):
+                after = phase['seq']
+                if phase['phase'] in ['running', 'not_ready']:
+                    data = "http://jupyterlab.hpc.unt.edu:%s" % phase['detail']
+                elif phase['phase'] == 'failed':
+                    data = LOGIN_ERRORS.get(phase['detail'], LOGIN_ERRORS['ended None'])
+                else:
+                    data = phase['detail']
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (phase['seq'], phase['phase'], data)
+                if phase['phase'] in FINAL_PHASES:
+                    return
+            time.sleep(PROGRESS_POLL_INTERVAL)
+
+    # NO PROXY BUFFERING - EVERY PHASE IS SENT WHEN REPORTED
+    return Response(stream_with_context(events(after)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''Gateway metrics in JSON format.
+    '''
+
+    return jsonify({'database_writer': writer_metrics(),
+                    'session_cache': cache_metrics(),
+                    'logger': logger_metrics(),
+                    'ports': port_metrics(DATABASE_NAME),
+                    'reaper': reaper_metrics(),
+                    'tunnels': tunnel_metrics(),
+                    'prewarm': dict(prewarm_metrics(), precision=precision_report(DATABASE_NAME))})
+
+
+@app.route('/usage', methods=['GET'])
+def usage():
+    '''Usage aggregates in JSON format. Optional 'days' and 'hours' arguments.
+    '''
+
+    days = request.args.get('days', default=7, type=int)
+    hours = request.args.get('hours', default=24, type=int)
+    return jsonify(usage_summary(DATABASE_NAME, days=min(days, 366), hours=min(hours, 24 * 31)))
+
+
+@app.route('/admin/transcript/<user>', methods=['GET'])
+def admin_transcript(user):
+    '''Last lines of remote output of a user session as plain text.
+    A running session is asked to save its transcript first [SIGUSR1].
+    Only for clients in ADMIN_IPS.
+    '''
+
+    if str(request.remote_addr) not in ADMIN_IPS:
+        abort(403)
+    logger(user='root', message='TRANSCRIPT REQUESTED user: %s ip: %s' % (user, request.remote_addr), level='WARNING')
+    path = transcript_path(user)
+    user_log = from_db(db_name=DATABASE_NAME, user=user)
+    if (user_log is not None) and (user_log['pid_session'] != 0) and pid_alive(user_log['pid_session']):
+        saved = os.path.getmtime(path) if os.path.isfile(path) else 0
+        os.kill(int(user_log['pid_session']), signal.SIGUSR1)
+        # WAIT FOR THE SESSION PROCESS TO WRITE IT
+        deadline = time.time() + 2
+        while (time.time() < deadline) and ((os.path.getmtime(path) if os.path.isfile(path) else 0) == saved):
+            time.sleep(0.05)
+    if not os.path.isfile(path):
+        abort(404)
+    with open(path, 'r') as f:
+        return Response(f.read(), mimetype='text/plain')
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Sidecar index for log files written by logger().
+The log file is split in chunks of CHUNK_BYTES and time in blocks of
+BLOCK_SECONDS. '<log file>.idx' (SQLite) keeps one row per user, time block
+and chunk holding lines of that user and time, so a query reads only those
+chunks instead of the whole file. Indexing is incremental: only lines added
+since the last run are read, and the index is rebuilt if the log file was
+replaced or truncated.
+
+Works with text lines ('<date> <user> <level> <message>') and JSON lines
+(configure_logger(log_format='json')). 'phase' and 'latency' are only known
+for JSON lines.
+
+Run: `$ python log_index.py logs_jupyter_lab --user euid --start '2020-10-01 09:00' --end '2020-10-01 10:00' --level ERROR`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+BLOCK_SECONDS = 3600
+CHUNK_BYTES = 64 * 1024
+# LINES READ BETWEEN INDEX COMMITS
+INDEX_BATCH_BYTES = 16 * 1024 * 1024
+
+SQL_CREATE_BLOCKS = '''CREATE TABLE IF NOT EXISTS log_blocks
+                  (user TEXT NOT NULL,
+                   block INTEGER NOT NULL,
+                   chunk INTEGER NOT NULL,
+                   PRIMARY KEY (user, block, chunk)) WITHOUT ROWID'''
+SQL_CREATE_BLOCKS_INDEX = 'CREATE INDEX IF NOT EXISTS log_blocks_block ON log_blocks (block, chunk)'
+# WHERE INDEXING STOPPED AND WHICH FILE WAS INDEXED
+SQL_CREATE_STATE = '''CREATE TABLE IF NOT EXISTS log_index_state
+                  (id INTEGER PRIMARY KEY CHECK (id = 0),
+                   inode INTEGER NOT NULL,
+                   offset INTEGER NOT NULL,
+                   block_seconds INTEGER NOT NULL,
+                   chunk_bytes INTEGER NOT NULL)'''
+SQL_SELECT_STATE = 'SELECT inode, offset, block_seconds, chunk_bytes FROM log_index_state WHERE id = 0'
+SQL_SAVE_STATE = '''INSERT INTO log_index_state (id, inode, offset, block_seconds, chunk_bytes) VALUES (0, ?, ?, ?, ?)
+                  ON CONFLICT (id) DO UPDATE SET inode=excluded.inode, offset=excluded.offset,
+                         block_seconds=excluded.block_seconds, chunk_bytes=excluded.chunk_bytes'''
+SQL_INSERT_BLOCK = 'INSERT INTO log_blocks (user, block, chunk) VALUES (?, ?, ?) ON CONFLICT DO NOTHING'
+SQL_USER_CHUNKS = 'SELECT DISTINCT chunk FROM log_blocks WHERE user = ? AND block >= ? AND block <= ? ORDER BY chunk'
+SQL_ALL_CHUNKS = 'SELECT DISTINCT chunk FROM log_blocks WHERE block >= ? AND block <= ? ORDER BY chunk'
+
+
+def parse_line(line, _times={}):
+    '''Parse one log line.
+
+    Args:
+        line: Text line or JSON line without the new line.
+    Return:
+        record: Dictionary with 'time' (epoch seconds), 'user', 'level',
+            'message' and for JSON lines the other logged fields. None if the
+            line is not a log line [e.g. a multi line message].
+    '''
+
+    try:
+        if line.startswith('{'):
+            record = json.loads(line)
+            time_log = record['time']
+        else:
+            time_log = line[:19]
+            user, level, message = (line[20:].split(' ', 2) + [''])[:3]
+            record = {'user': user, 'level': level, 'message': message}
+        epoch = _times.get(time_log)
+        if epoch is None:
+            epoch = time.mktime(time.strptime(time_log, '%Y-%m-%d %H:%M:%S'))
+            if len(_times) > 100000:
+                _times.clear()
+            _times[time_log] = epoch
+    except (ValueError, KeyError, TypeError):
+        return None
+    record['time'] = epoch
+    return record
+
+
+def open_index(log_path, index_path=None):
+    '''Open or create the index of a log file.
+
+    Return:
+        conn: sqlite3 connection to '<log_path>.idx' or 'index_path'.
+    '''
+
+    conn = sqlite3.connect(index_path or log_path + '.idx', isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(SQL_CREATE_BLOCKS)
+    conn.execute(SQL_CREATE_BLOCKS_INDEX)
+    conn.execute(SQL_CREATE_STATE)
+    return conn
+
+
+def update_index(log_path, conn, block_seconds=BLOCK_SECONDS, chunk_bytes=CHUNK_BYTES):
+    '''Index lines added to the log file since the last update.
+
+    Args:
+        log_path: Log file name.
+        conn: Connection from open_index().
+        block_seconds: Seconds in one time block.
+        chunk_bytes: Bytes in one file chunk.
+    Return:
+        Number of bytes indexed.
+    '''
+
+    stat = os.stat(log_path)
+    state = conn.execute(SQL_SELECT_STATE).fetchone()
+    offset = 0
+    if state is not None:
+        inode, offset, old_block_seconds, old_chunk_bytes = state
+        if (inode != stat.st_ino) or (offset > stat.st_size) or \
+                ((old_block_seconds, old_chunk_bytes) != (block_seconds, chunk_bytes)):
+            # LOG FILE REPLACED, TRUNCATED OR NEW SETTINGS - START OVER
+            conn.execute('DELETE FROM log_blocks')
+            offset = 0
+    first_offset = start = offset
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            rows = set()
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'):
+                    # LINE STILL BEING WRITTEN
+                    break
+                record = parse_line(raw_line.decode('utf-8', 'replace').rstrip('\n'))
+                if record is not None:
+                    rows.add((str(record['user']), int(record['time'] // block_seconds), offset // chunk_bytes))
+                offset += len(raw_line)
+                if offset - start >= INDEX_BATCH_BYTES:
+                    break
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(SQL_INSERT_BLOCK, rows)
+            conn.execute(SQL_SAVE_STATE, (stat.st_ino, offset, block_seconds, chunk_bytes))
+            conn.execute('COMMIT')
+            if offset - start < INDEX_BATCH_BYTES:
+                break
+            start = offset
+            f.seek(offset)
+    return offset - first_offset
+
+
+def read_chunks(f, chunks, chunk_bytes):
+    '''Lines starting in the given chunks. Adjacent chunks are read in one pass.
+
+    Args:
+        f: Log file opened in binary mode.
+        chunks: Sorted chunk numbers.
+        chunk_bytes: Bytes in one chunk.
+    '''
+
+    ranges = []
+    for chunk in chunks:
+        if ranges and ranges[-1][1] == chunk:
+            ranges[-1][1] = chunk + 1
+        else:
+            ranges.append([chunk, chunk + 1])
+    for first, end in ranges:
+        if first:
+            # SKIP THE END OF A LINE STARTED IN THE PREVIOUS CHUNK
+            f.seek(first * chunk_bytes - 1)
+            f.readline()
+        else:
+            f.seek(0)
+        while f.tell() < end * chunk_bytes:
+            raw_line = f.readline()
+            if not raw_line.endswith(b'\n'):
+                break
+            yield raw_line.decode('utf-8', 'replace').rstrip('\n')
+
+
+def query(log_path, user=None, start=None, end=None, levels=None, phase=None, update=True, index_path=None,
+          block_seconds=BLOCK_SECONDS, chunk_bytes=CHUNK_BYTES):
+    '''Log records matching all given filters, in file order.
+
+    Args:
+        log_path: Log file name.
+        user: User id.
+        start: Epoch seconds, inclusive.
+        end: Epoch seconds, exclusive.
+        levels: List of levels, e.g. ['ERROR', 'CRITICAL'].
+        phase: Phase logged with the line [JSON lines only].
+        update: Index new lines first.
+    Return:
+        Generator of parse_line() records.
+    '''
+
+    conn = open_index(log_path, index_path)
+    try:
+        if update:
+            update_index(log_path, conn, block_seconds=block_seconds, chunk_bytes=chunk_bytes)
+        first_block = 0 if start is None else int(start // block_seconds)
+        last_block = 2 ** 62 if end is None else int(end // block_seconds)
+        if user is None:
+            chunks = [chunk for (chunk,) in conn.execute(SQL_ALL_CHUNKS, (first_block, last_block))]
+        else:
+            chunks = [chunk for (chunk,) in conn.execute(SQL_USER_CHUNKS, (str(user), first_block, last_block))]
+    finally:
+        conn.close()
+    with open(log_path, 'rb') as f:
+        for line in read_chunks(f, chunks, chunk_bytes):
+            record = parse_line(line)
+            if (record is None) or \
+                    ((user is not None) and (str(record['user']) != str(user))) or \
+                    ((start is not None) and (record['time'] < start)) or \
+                    ((end is not None) and (record['time'] >= end)) or \
+                    ((levels is not None) and (record['level'] not in levels)) or \
+                    ((phase is not None) and (record.get('phase') != phase)):
+                continue
+            yield record
+
+
+def parse_date(value):
+    '''Epoch seconds from '%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S' or epoch seconds.
+    '''
+
+    for date_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, date_format))
+        except ValueError:
+            continue
+    return float(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index and query gateway log files.')
+    parser.add_argument('log', help='log file, e.g. logs_jupyter_lab or users_logs/<user>.log')
+    parser.add_argument('--user', help='user id')
+    parser.add_argument('--start', type=parse_date, help="from date, e.g. '2020-10-01 09:00'")
+    parser.add_argument('--end', type=parse_date, help="to date, e.g. '2020-10-01 10:00'")
+    parser.add_argument('--level', nargs='+', help='levels, e.g. ERROR CRITICAL')
+    parser.add_argument('--phase', help='phase [JSON lines only]')
+    parser.add_argument('--index-only', action='store_true', help='update the index and exit')
+    parser.add_argument('--json', action='store_true', help='print JSON lines')
+    args = parser.parse_args()
+
+    if args.index_only:
+        conn = open_index(args.log)
+        print('INDEXED %d BYTES' % update_index(args.log, conn))
+        conn.close()
+        sys.exit()
+    for record in query(args.log, user=args.user, start=args.start, end=args.end, levels=args.level,
+                        phase=args.phase):
+        if args.json:
+            print(json.dumps(record))
+        else:
+            print('%s %s %s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time'])),
+                                   record['user'], record['level'], record['message']))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Login progress.
+A login returns right away with a token; the session process or the session
+orchestrator reports each phase of the login under that token and the
+browser follows them from '/progress/<token>/events' [server-sent events].
+
+Phases in order: 'queued', 'authenticating', 'configuring', 'starting',
+'forwarding', then 'running' [detail: local port], 'not_ready' [jupyter did
+not answer on the local port in time, detail: local port] or 'failed'
+[detail: the session process message, 'ended 0' or 'ended None'].
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import time
+import secrets
+from helper_functions import logger
+from sqlite_database import get_connection
+
+SQL_REPORT = '''INSERT INTO login_progress (token, seq, user, phase, detail, time)
+                  SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM login_progress WHERE token = ?'''
+SQL_PROGRESS = 'SELECT seq, phase, detail, time FROM login_progress WHERE token = ? AND seq > ? ORDER BY seq'
+SQL_CLEAR = 'DELETE FROM login_progress WHERE time < ?'
+
+PHASES = ['queued', 'authenticating', 'configuring', 'starting', 'forwarding', 'running', 'not_ready',
+          'failed']
+# LAST PHASE OF A LOGIN
+FINAL_PHASES = ['running', 'not_ready', 'failed']
+
+
+def new_token():
+    return secrets.token_hex(16)
+
+
+def report(db_name, token, user, phase, detail=''):
+    '''Record a phase of a login. Does nothing without a token.
+
+    Args:
+        db_name: Database name.
+        token: Login token from new_token() or None.
+        user: User id.
+        phase: One of PHASES.
+        detail: Text shown with the phase.
+    '''
+
+    if token is None:
+        return
+    try:
+        get_connection(db_name).execute(SQL_REPORT, (token, str(user), phase, str(detail), time.time(), token))
+    except Exception as e:
+        logger(user=user, message='login_progress report FAILED! %s' % str(e), level='ERROR')
+    return
+
+
+def progress(db_name, token, after=0):
+    '''Phases of a login reported after sequence number 'after'.
+
+    Return:
+        List of dictionaries with 'seq', 'phase', 'detail' and 'time'.
+    '''
+
+    rows = get_connection(db_name).execute(SQL_PROGRESS, (token, int(after))).fetchall()
+    return [{k: v for k, v in zip(['seq', 'phase', 'detail', 'time'], row)} for row in rows]
+
+
+def clear_progress(db_name, max_age=86400):
+    '''Remove progress of logins older than 'max_age' seconds.
+
+    Return:
+        Number of rows removed.
+    '''
+
+    return get_connection(db_name).execute(SQL_CLEAR, (time.time() - max_age,)).rowcount
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local port allocator.
+Ports between START_OPEN_PORT and END_OPEN_PORT are rows of the 'port_pool'
+table. A free port has pid 0; free ports are a free list ordered by release
+time, so allocation is one indexed lookup and one update in a write
+transaction - two sessions never get the same port. A leased port belongs to
+the session process 'pid' and goes back to the pool when the session calls
+release_port(), or when reclaim_ports() finds the process gone or the lease
+older than the session length.
+
+Allocation latency and pool usage are served with port_metrics().
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import time
+import socket
+from multiprocessing import Lock, Array
+from contextlib import closing
+from helper_functions import logger, pid_alive
+from sqlite_database import get_connection, transaction
+
+SQL_FILL_POOL = 'INSERT INTO port_pool (port) VALUES (?) ON CONFLICT (port) DO NOTHING'
+SQL_TRIM_POOL = 'DELETE FROM port_pool WHERE pid = 0 AND (port < ? OR port >= ?)'
+# PORTS OF RUNNING SESSIONS STARTED BEFORE THE POOL EXISTED
+SQL_ADOPT_RUNNING = '''UPDATE port_pool SET
+                  pid=(SELECT pid_session FROM jupyter_talon WHERE local_port = port_pool.port
+                       AND state_session = 'running' AND pid_session != 0 LIMIT 1),
+                  user=(SELECT user FROM jupyter_talon WHERE local_port = port_pool.port
+                        AND state_session = 'running' AND pid_session != 0 LIMIT 1),
+                  leased=?
+                  WHERE pid = 0 AND port IN (SELECT local_port FROM jupyter_talon
+                                             WHERE state_session = 'running' AND pid_session != 0)'''
+SQL_FREE_PORT = 'SELECT port FROM port_pool WHERE pid = 0 ORDER BY released LIMIT 1'
+SQL_LEASE_PORT = 'UPDATE port_pool SET pid=?, user=?, leased=? WHERE port=?'
+SQL_RELEASE_PORT = 'UPDATE port_pool SET pid=0, user=NULL, leased=NULL, released=? WHERE port=? AND pid=?'
+SQL_TRANSFER_PORT = 'UPDATE port_pool SET pid=? WHERE port=? AND pid=?'
+SQL_SELECT_LEASES = 'SELECT port, pid, leased FROM port_pool WHERE pid != 0'
+SQL_POOL_COUNTS = 'SELECT COUNT(*), COALESCE(SUM(pid != 0), 0) FROM port_pool'
+
+# PORTS USED OUTSIDE THE POOL GO BEHIND PORTS RELEASED IN THE NEXT HOUR
+QUARANTINE_SECONDS = 3600
+
+# POSITIONS IN THE SHARED METRICS ARRAY
+METRICS = ['allocations', 'allocation_seconds', 'max_allocation_seconds', 'exhausted', 'bind_conflicts',
+           'releases', 'reclaimed']
+
+# CREATED ON IMPORT IN THE GATEWAY PROCESS - SHARED WITH ALL SESSION PROCESSES
+_metrics = Array('d', len(METRICS))
+_metrics_lock = Lock()
+
+
+def _add_metric(name, value):
+    with _metrics_lock:
+        _metrics[METRICS.index(name)] += value
+    return
+
+
+def port_bindable(port):
+    '''Check that no process outside the pool listens on the port.
+    Uses SO_REUSEADDR like ssh, so ports in TIME_WAIT are bindable.
+    '''
+
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError:
+            return False
+    return True
+
+
+def setup_pool(db_name, min_port, max_port, max_age=None):
+    '''Fill port_pool with ports [min_port, max_port). Free ports outside the
+    range are removed. Ports of running sessions are leased to their session
+    process, then dead leases are reclaimed.
+
+    Args:
+        db_name: Database name.
+        min_port: First port.
+        max_port: Port after the last one.
+        max_age: Seconds after which any lease is reclaimed [see reclaim_ports()].
+    Return:
+        Number of ports in the pool.
+    '''
+
+    conn = get_connection(db_name)
+    with transaction(conn):
+        conn.executemany(SQL_FILL_POOL, [(port,) for port in range(min_port, max_port)])
+        conn.execute(SQL_TRIM_POOL, (min_port, max_port))
+        conn.execute(SQL_ADOPT_RUNNING, (int(time.time()),))
+    reclaim_ports(db_name, max_age=max_age)
+    return conn.execute(SQL_POOL_COUNTS).fetchone()[0]
+
+
+def allocate_port(db_name, user, pid, max_age=None, attempts=10):
+    '''Lease a free local port to a session process.
+
+    Args:
+        db_name: Database name.
+        user: User id.
+        pid: Session process holding the lease.
+        max_age: Seconds after which any lease is reclaimed when the pool is empty.
+        attempts: Ports tried when ports are taken by processes outside the pool.
+    Return:
+        port: Leased port or None if no port is free.
+    '''
+
+    start = time.time()
+    conn = get_connection(db_name)
+    reclaimed = False
+    tried = set()
+    for _ in range(attempts):
+        with transaction(conn):
+            row = conn.execute(SQL_FREE_PORT).fetchone()
+            if (row is not None) and (row[0] in tried):
+                # ONLY PORTS USED OUTSIDE THE POOL ARE LEFT
+                row = None
+            if row is not None:
+                conn.execute(SQL_LEASE_PORT, (pid, str(user), int(time.time()), row[0]))
+        if row is None:
+            if reclaimed or not reclaim_ports(db_name, max_age=max_age):
+                break
+            # TRY AGAIN WITH RECLAIMED PORTS
+            reclaimed = True
+            continue
+        port = row[0]
+        if port_bindable(port):
+            elapsed = time.time() - start
+            with _metrics_lock:
+                _metrics[METRICS.index('allocations')] += 1
+                _metrics[METRICS.index('allocation_seconds')] += elapsed
+                if elapsed > _metrics[METRICS.index('max_allocation_seconds')]:
+                    _metrics[METRICS.index('max_allocation_seconds')] = elapsed
+            logger(user=user, message='LEASED LOCAL PORT %s TO PID %s' % (port, pid), level='INFO',
+                   latency=elapsed, local_port=port)
+            return port
+        # USED OUTSIDE THE POOL - BACK TO THE END OF THE FREE LIST
+        tried.add(port)
+        _add_metric('bind_conflicts', 1)
+        logger(user=user, message='LOCAL PORT %s IN USE OUTSIDE THE POOL!' % port, level='WARNING')
+        conn.execute(SQL_RELEASE_PORT, (int(time.time()) + QUARANTINE_SECONDS, port, pid))
+    _add_metric('exhausted', 1)
+    logger(user=user, message='NO FREE LOCAL PORT!', level='ERROR')
+    return None
+
+
+def release_port(db_name, port, pid):
+    '''Give a leased port back to the pool. Does nothing if 'pid' does not
+    hold the lease [e.g. it was already reclaimed].
+
+    Return:
+        True if the port was released.
+    '''
+
+    try:
+        released = get_connection(db_name).execute(SQL_RELEASE_PORT, (int(time.time()), port, pid)).rowcount
+    except Exception as e:
+        logger(user='root', message='release_port FAILED! %s' % str(e), level='ERROR')
+        return False
+    if released:
+        _add_metric('releases', 1)
+    return bool(released)
+
+
+def transfer_port(db_name, port, pid, new_pid):
+    '''Move a lease from 'pid' to 'new_pid' [e.g. a session handing its
+    tunnel to the tunnel daemon]. The lease time is kept.
+
+    Return:
+        True if the lease was moved.
+    '''
+
+    try:
+        moved = get_connection(db_name).execute(SQL_TRANSFER_PORT, (new_pid, port, pid)).rowcount
+    except Exception as e:
+        logger(user='root', message='transfer_port FAILED! %s' % str(e), level='ERROR')
+        return False
+    return bool(moved)
+
+
+def reclaim_ports(db_name, max_age=None):
+    '''Release leases of session processes that do not exist anymore, and
+    leases older than 'max_age' seconds.
+
+    Return:
+        Number of ports reclaimed.
+    '''
+
+    conn = get_connection(db_name)
+    now = int(time.time())
+    stale = [(now, port, pid) for port, pid, leased in conn.execute(SQL_SELECT_LEASES).fetchall()
+             if (not pid_alive(pid)) or ((max_age is not None) and (now - (leased or 0) > max_age))]
+    if not stale:
+        return 0
+    with transaction(conn):
+        reclaimed = sum(conn.execute(SQL_RELEASE_PORT, params).rowcount for params in stale)
+    _add_metric('reclaimed', reclaimed)
+    logger(user='root', message='RECLAIMED %d LOCAL PORTS' % reclaimed, level='WARNING')
+    return reclaimed
+
+
+def port_metrics(db_name):
+    '''Allocation latency and pool usage.
+
+    Return:
+        Dictionary of metrics.
+    '''
+
+    values = dict(zip(METRICS, _metrics[:]))
+    values['avg_allocation_seconds'] = values['allocation_seconds'] / values['allocations'] \
+        if values['allocations'] else 0
+    size, leased = get_connection(db_name).execute(SQL_POOL_COUNTS).fetchone()
+    values['pool_size'] = size
+    values['leased'] = leased
+    values['free'] = size - leased
+    values['utilization'] = leased / size if size else 0
+    return values
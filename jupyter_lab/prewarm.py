@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Predictive pre-warm from the login history.
+Logins follow class schedules, so a user who logged in during the same hour of
+the week in at least 'min_weeks' of the last 'weeks' weeks [session_events]
+is predicted to log in again in the next window. For every predicted user the
+gateway checks what the login will need without touching HPC [no credentials
+are kept]: a user whose readiness profile shows a running jupyter with the
+current config takes the fast path, any other user needs a jupyter started
+('cold'). Before the window the warm pool of the login node [warm_pool.py] is
+grown to its base size plus the predicted cold starts, at most 'max_prewarm'
+more. The grown size is kept until the window is over [the pool covers the
+current and the next window] and goes back to the base size when neither has
+predictions.
+
+Predictions are kept in 'prewarm_predictions' and scored once their window is
+over, precision_report() is the share of predicted users who logged in.
+
+Run: `$ python prewarm.py --report` or `$ python prewarm.py --predict`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from helper_functions import logger
+from sqlite_database import get_connection, transaction, get_profile
+from jupyter_config import render_config
+
+WEEK = 7 * 86400
+# USERS WITH LOGINS IN THE SAME WEEKLY WINDOW [?1 START, ?2 LENGTH] OF THE LAST ?3 WEEKS, NOT RUNNING NOW.
+# weeks: DIFFERENT WEEKS WITH A LOGIN IN THE WINDOW
+SQL_PREDICT = '''SELECT e.user, COUNT(DISTINCT CAST((?1 - e.timestamp + ?2) / 604800 AS INTEGER)) AS weeks,
+                         COUNT(*) AS logins, COALESCE(MAX(t.count_logins), 0) AS count_logins
+                  FROM session_events e LEFT JOIN jupyter_talon t ON t.user = e.user
+                  WHERE e.hour >= ?4 AND e.phase = 'initiated' AND e.timestamp >= ?1 - ?3 * 604800
+                        AND e.timestamp < ?1
+                        AND ((CAST(e.timestamp AS INTEGER) - ?1) % 604800 + 604800) % 604800 < ?2
+                        AND COALESCE(t.state_session, 'ended') != 'running'
+                  GROUP BY e.user HAVING weeks >= ?5
+                  ORDER BY weeks DESC, logins DESC, count_logins DESC, e.user'''
+SQL_INSERT_PREDICTION = '''INSERT OR IGNORE INTO prewarm_predictions (window_start, user, window_seconds, weeks, cold)
+                  VALUES (?,?,?,?,?)'''
+SQL_WINDOW_PREDICTED = 'SELECT 1 FROM prewarm_predictions WHERE window_start = ? LIMIT 1'
+SQL_WINDOW_COLD = 'SELECT COALESCE(SUM(cold), 0) FROM prewarm_predictions WHERE window_start = ?'
+# HIT: THE USER STARTED A LOGIN IN THE WINDOW
+SQL_SCORE = '''UPDATE prewarm_predictions SET hit = EXISTS (SELECT 1 FROM session_events e
+                         WHERE e.user = prewarm_predictions.user AND e.phase = 'initiated'
+                         AND e.timestamp >= window_start AND e.timestamp < window_start + window_seconds)
+                  WHERE hit IS NULL AND window_start + window_seconds <= ?'''
+SQL_DELETE_PREDICTIONS = 'DELETE FROM prewarm_predictions WHERE window_start < ?'
+SQL_PRECISION = '''SELECT COUNT(DISTINCT window_start), COUNT(*), COALESCE(SUM(hit), 0),
+                         COALESCE(SUM(cold), 0), COALESCE(SUM(cold * hit), 0)
+                  FROM prewarm_predictions WHERE hit IS NOT NULL AND window_start >= ?'''
+# LOGINS DURING SCORED WINDOWS [RECALL]
+SQL_WINDOW_LOGINS = '''SELECT COUNT(*) FROM (SELECT DISTINCT w.window_start, e.user
+                  FROM (SELECT DISTINCT window_start, window_seconds FROM prewarm_predictions
+                        WHERE hit IS NOT NULL AND window_start >= ?) w
+                  JOIN session_events e ON e.phase = 'initiated' AND e.timestamp >= w.window_start
+                       AND e.timestamp < w.window_start + w.window_seconds)'''
+
+# COUNTERS OF THE SCHEDULER OF THIS PROCESS
+_metrics = {'runs': 0, 'windows': 0, 'predicted': 0, 'cold': 0, 'pool_resizes': 0, 'resize_failures': 0,
+            'pool_target': 0, 'last_window': 0, 'last_run': 0}
+
+
+def predict(db_name, window_start, window=1800, weeks=4, min_weeks=2):
+    '''Users expected to log in during [window_start, window_start + window).
+
+    Return:
+        List of dictionaries with 'user', 'weeks', 'logins' and 'count_logins', most likely first.
+    '''
+
+    rows = get_connection(db_name).execute(SQL_PREDICT, (int(window_start), int(window), int(weeks),
+                                                         (int(window_start) - weeks * WEEK) // 3600,
+                                                         int(min_weeks))).fetchall()
+    return [{k: v for k, v in zip(['user', 'weeks', 'logins', 'count_logins'], row)} for row in rows]
+
+
+def needs_start(db_name, user, hostname, session_length, now=None):
+    '''False if the next login of 'user' should take the fast path [see
+    JupyterLab.fast_path()], so no jupyter has to be started for it.
+    '''
+
+    profile = get_profile(db_name, user)
+    now = time.time() if now is None else now
+    return (profile is None) or (not profile['remote_port']) or (profile['login_node'] != hostname) or \
+        (now - profile['verified'] > session_length) or \
+        (profile['config_hash'] != render_config(user, session_length)[1])
+
+
+def score_predictions(db_name, now=None, keep_days=90):
+    '''Mark predictions of finished windows as hits or misses and delete old ones.
+
+    Return:
+        Number of predictions scored.
+    '''
+
+    now = time.time() if now is None else now
+    conn = get_connection(db_name)
+    with transaction(conn):
+        scored = conn.execute(SQL_SCORE, (now,)).rowcount
+        conn.execute(SQL_DELETE_PREDICTIONS, (now - keep_days * 86400,))
+    return scored
+
+
+def plan_window(db_name, hostname, session_length, now=None, window=1800, weeks=4, min_weeks=2, max_prewarm=20):
+    '''Predict the next window once and record the predictions.
+
+    Args:
+        max_prewarm: Most predicted users kept [cap of speculative starts].
+    Return:
+        Dictionary with 'window_start', 'predicted', 'cold' and 'users', or
+        None if the next window was already planned.
+    '''
+
+    now = time.time() if now is None else now
+    window_start = (int(now) // window + 1) * window
+    conn = get_connection(db_name)
+    if conn.execute(SQL_WINDOW_PREDICTED, (window_start,)).fetchone():
+        return None
+    users = predict(db_name, window_start, window=window, weeks=weeks, min_weeks=min_weeks)[:max_prewarm]
+    for prediction in users:
+        prediction['cold'] = needs_start(db_name, prediction['user'], hostname, session_length, now=now)
+    with transaction(conn):
+        conn.executemany(SQL_INSERT_PREDICTION, [(window_start, p['user'], window, p['weeks'], int(p['cold']))
+                                                 for p in users])
+    return {'window_start': window_start, 'predicted': len(users), 'cold': sum(p['cold'] for p in users),
+            'users': users}
+
+
+def window_cold(db_name, window_start):
+    '''Predicted cold starts of the window starting at 'window_start'.
+    '''
+
+    return get_connection(db_name).execute(SQL_WINDOW_COLD, (int(window_start),)).fetchone()[0]
+
+
+def resize_pool(account, python_path, pool_path, pool_socket, size, timeout=30):
+    '''Set the parked processes of the warm pool on the login node.
+
+    Args:
+        account: 'user@login node' with an ssh key allowed to resize the pool.
+        pool_path: warm_pool.py on the login node.
+    Return:
+        True if the pool took the new size.
+    '''
+
+    command = ['ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', account,
+               '%s/bin/python3 %s --socket %s --resize %d' % (python_path, pool_path, pool_socket, size)]
+    try:
+        return subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=timeout).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def run_prewarm(db_name, hostname, session_length, window=1800, weeks=4, min_weeks=2, max_prewarm=20,
+                pool_size=4, account=None, python_path=None, pool_path=None, pool_socket=None):
+    '''One scheduler pass: score finished windows, plan the next one and size the warm pool
+    for the predictions of the current and the next window.
+
+    Return:
+        plan: See plan_window() [None - the next window was planned before].
+    '''
+
+    now = time.time()
+    _metrics['runs'] += 1
+    _metrics['last_run'] = now
+    score_predictions(db_name)
+    plan = plan_window(db_name, hostname, session_length, now=now, window=window, weeks=weeks,
+                       min_weeks=min_weeks, max_prewarm=max_prewarm)
+    if (plan is not None) and (plan['window_start'] == _metrics['last_window']):
+        plan = None
+    # USERS PREDICTED FOR THE CURRENT WINDOW ARRIVE NOW - KEEP THEIR PROCESSES PARKED UNTIL IT IS OVER
+    current_start = int(now) // window * window
+    target = pool_size + min(max(window_cold(db_name, current_start), window_cold(db_name, current_start + window)),
+                             max_prewarm)
+    if plan is not None:
+        _metrics['last_window'] = plan['window_start']
+        _metrics['windows'] += 1
+        _metrics['predicted'] += plan['predicted']
+        _metrics['cold'] += plan['cold']
+        logger(user='root', message='PREWARM WINDOW %s: %d PREDICTED, %d COLD, POOL %d' %
+               (time.strftime('%Y-%m-%d %H:%M', time.localtime(plan['window_start'])), plan['predicted'],
+                plan['cold'], target), level='INFO', phase='prewarm')
+    if (account is not None) and (target != _metrics['pool_target']):
+        if resize_pool(account, python_path, pool_path, pool_socket, target):
+            _metrics['pool_resizes'] += 1
+            _metrics['pool_target'] = target
+        else:
+            _metrics['resize_failures'] += 1
+            logger(user='root', message='PREWARM: WARM POOL RESIZE TO %d FAILED!' % target, level='ERROR')
+    return plan
+
+
+def start_prewarm(db_name, hostname, session_length, interval=300, **kwargs):
+    '''Run run_prewarm() every 'interval' seconds in a daemon thread.
+
+    Args:
+        kwargs: run_prewarm() options.
+    Return:
+        thread: Scheduler thread.
+    '''
+
+    def run():
+        while True:
+            try:
+                run_prewarm(db_name, hostname, session_length, **kwargs)
+            except Exception as e:
+                logger(user='root', message='run_prewarm FAILED! %s' % str(e), level='ERROR')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+def precision_report(db_name, days=7):
+    '''Quality of the predictions of windows finished in the last 'days' days.
+
+    Return:
+        Dictionary with 'windows', 'predicted', 'hits', 'precision' [hits /
+        predicted], 'cold', 'cold_hits', 'logins' [users who logged in during
+        those windows] and 'recall' [hits / logins].
+    '''
+
+    conn = get_connection(db_name)
+    since = time.time() - days * 86400
+    windows, predicted, hits, cold, cold_hits = conn.execute(SQL_PRECISION, (since,)).fetchone()
+    logins = conn.execute(SQL_WINDOW_LOGINS, (since,)).fetchone()[0]
+    return {'windows': windows,
+            'predicted': predicted,
+            'hits': hits,
+            'precision': hits / predicted if predicted else 0,
+            'cold': cold,
+            'cold_hits': cold_hits,
+            'logins': logins,
+            'recall': hits / logins if logins else 0}
+
+
+def prewarm_metrics():
+    '''Scheduler counters of this process.
+    '''
+
+    return dict(_metrics)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predicted logins and prediction precision.')
+    parser.add_argument('--db', default='database_jupyter_lab.db', help='database file')
+    parser.add_argument('--days', type=int, default=7, help='days of windows in the report')
+    parser.add_argument('--report', action='store_true', help='print prediction precision')
+    parser.add_argument('--predict', action='store_true', help='print users predicted for the next window')
+    parser.add_argument('--window', type=int, default=1800, help='window seconds')
+    parser.add_argument('--weeks', type=int, default=4, help='weeks of history')
+    parser.add_argument('--min-weeks', type=int, default=2, help='weeks with a login in the window')
+    args = parser.parse_args()
+
+    if args.predict:
+        window_start = (int(time.time()) // args.window + 1) * args.window
+        json.dump(predict(args.db, window_start, window=args.window, weeks=args.weeks, min_weeks=args.min_weeks),
+                  sys.stdout, indent=2)
+        print()
+    if args.report or not args.predict:
+        score_predictions(args.db)
+        json.dump(precision_report(args.db, days=args.days), sys.stdout, indent=2)
+        print()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Provision the jupyter settings of a cohort of users ahead of a workshop.
+Runs remote_bootstrap.py for every user on the login node, as that user
+[`sudo -n -u <user>` from an admin account with an ssh key], with the config
+of the gateway: scratch directory checks, .jupyter, .ipython, the home
+directory link and jupyter_notebook_config.py. The config hash applied is
+saved in 'user_profiles', so the live login of a provisioned user only checks
+the file exists. The password is set by the login itself.
+
+At most '--jobs' users are provisioned at once. Every finished user is
+appended to the '--state' file [JSON lines], so a run started again with the
+same file skips users already provisioned with the current config.
+
+Run: `$ python provision_cohort.py --account admin@vis.acs.unt.edu --jobs 8 --state workshop.state users.txt`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from helper_functions import flush_logger
+from sqlite_database import create_db, set_config_hash
+from jupyter_config import render_config
+from remote_bootstrap import RESULT_MARKER, remote_command
+
+# USER NAMES PASSED TO THE REMOTE SHELL
+USER_PATTERN = re.compile(r'^[a-z_][a-z0-9_.-]*$')
+
+
+def read_users(paths):
+    '''User ids from files with one user per line ['#' comments, '-' for stdin], in order, without repeats.
+    '''
+
+    users = []
+    for path in paths:
+        f = sys.stdin if path == '-' else open(path, 'r')
+        try:
+            for line in f:
+                user = line.split('#')[0].strip()
+                if user and (user not in users):
+                    users.append(user)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    return users
+
+
+def read_state(state_path):
+    '''Last result of every user in the state file.
+    '''
+
+    state = {}
+    try:
+        with open(state_path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    state[result['user']] = result
+                except (ValueError, KeyError):
+                    # LINE CUT BY AN INTERRUPTED RUN
+                    continue
+    except (IOError, OSError):
+        pass
+    return state
+
+
+def provision_user(user, account, python_path, session_length, timeout=120):
+    '''Run the bootstrap for one user.
+
+    Return:
+        Dictionary with 'user', 'ok', 'error', 'config_hash', 'config_written' and 'seconds'.
+    '''
+
+    start = time.time()
+    config, config_hash = render_config(user, session_length)
+    result = {'user': user, 'ok': False, 'error': None, 'config_hash': config_hash, 'config_written': False,
+              'seconds': 0}
+    if not USER_PATTERN.match(user):
+        result['error'] = 'INVALID USER NAME'
+        return result
+    spec = {'user': user,
+            'work_dir': '/storage/scratch2/%s' % user,
+            'home_dir': '/home/%s/' % user,
+            'config': config,
+            'config_current': False,
+            'password_hash': None,
+            'start_server': None}
+    command = ['ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', account,
+               'sudo -n -u %s %s' % (user, remote_command(python_path))]
+    try:
+        process = subprocess.run(command, input=json.dumps(spec) + '\n', stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True, timeout=timeout)
+        answer = None
+        for line in process.stdout.splitlines():
+            if line.startswith(RESULT_MARKER):
+                answer = json.loads(line[len(RESULT_MARKER):])
+        if answer is None:
+            # LAST LINE OF ssh OR sudo ERRORS
+            errors = process.stderr.strip().splitlines() or ['NO RESULT [EXIT %s]' % process.returncode]
+            result['error'] = errors[-1]
+        elif not answer.get('ok'):
+            result['error'] = answer.get('error')
+        else:
+            result['ok'] = True
+            result['config_written'] = answer['config_written']
+    except subprocess.TimeoutExpired:
+        result['error'] = 'TIMEOUT AFTER %ss' % timeout
+    except (OSError, ValueError) as e:
+        result['error'] = '%s: %s' % (type(e).__name__, str(e))
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def provision_cohort(users, account, db_name, python_path, session_length, jobs=8, state_path=None, timeout=120,
+                     progress=None):
+    '''Provision users with at most 'jobs' at once.
+
+    Args:
+        state_path: JSON lines of finished users [resume]. None - provision all.
+        progress: Function called with every result.
+    Return:
+        Summary dictionary, see print_summary().
+    '''
+
+    start = time.time()
+    state = read_state(state_path) if state_path else {}
+    todo, skipped = [], []
+    for user in users:
+        done = state.get(user)
+        if done and done.get('ok') and (done.get('config_hash') == render_config(user, session_length)[1]):
+            skipped.append(user)
+        else:
+            todo.append(user)
+    lock = threading.Lock()
+    results = []
+
+    def run(user):
+        result = provision_user(user, account, python_path, session_length, timeout=timeout)
+        if result['ok']:
+            # THE LIVE LOGIN FINDS THIS CONFIG CURRENT
+            set_config_hash(db_name, user, result['config_hash'])
+        with lock:
+            results.append(result)
+            if state_path:
+                with open(state_path, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+            if progress is not None:
+                progress(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(run, todo))
+
+    seconds = sorted(r['seconds'] for r in results)
+    return {'users': len(users),
+            'skipped': len(skipped),
+            'provisioned': sum(r['ok'] for r in results),
+            'config_written': sum(r['ok'] and r['config_written'] for r in results),
+            'failed': [{'user': r['user'], 'error': r['error']} for r in results if not r['ok']],
+            'median_seconds': seconds[len(seconds) // 2] if seconds else 0,
+            'max_seconds': seconds[-1] if seconds else 0,
+            'seconds': round(time.time() - start, 3)}
+
+
+def print_summary(summary):
+    print('USERS: %d  SKIPPED [ALREADY PROVISIONED]: %d  PROVISIONED: %d  CONFIG WRITTEN: %d  FAILED: %d' %
+          (summary['users'], summary['skipped'], summary['provisioned'], summary['config_written'],
+           len(summary['failed'])))
+    print('SECONDS PER USER: MEDIAN %.1f  MAX %.1f  TOTAL %.1f' %
+          (summary['median_seconds'], summary['max_seconds'], summary['seconds']))
+    for failure in summary['failed']:
+        print('FAILED %s: %s' % (failure['user'], failure['error']))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Provision jupyter settings of a cohort of users.')
+    parser.add_argument('users', nargs='+', help="files with one user per line ['-' for stdin]")
+    parser.add_argument('--account', required=True, help='admin account@login node allowed to sudo to users')
+    parser.add_argument('--db', default='database_jupyter_lab.db', help='database file')
+    parser.add_argument('--python-path', default='/cm/shared/utils/PYTHON/3.6.5', help='python on HPC')
+    parser.add_argument('--session-length', type=int, default=7200, help='SESSION_LENGTH of the gateway')
+    parser.add_argument('--jobs', type=int, default=8, help='users provisioned at once')
+    parser.add_argument('--timeout', type=int, default=120, help='seconds per user')
+    parser.add_argument('--state', help='state file to resume an interrupted run')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    if not create_db(db_name=args.db):
+        sys.exit(1)
+    cohort = read_users(args.users)
+    summary = provision_cohort(cohort, args.account, args.db, args.python_path, args.session_length,
+                               jobs=args.jobs, state_path=args.state, timeout=args.timeout,
+                               progress=None if args.json else
+                               lambda r: print('%s %s %ss' % (r['user'], 'OK' if r['ok'] else r['error'],
+                                                              r['seconds'])))
+    flush_logger()
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_summary(summary)
+    sys.exit(1 if summary['failed'] else 0)
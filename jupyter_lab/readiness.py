@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Readiness prober: is jupyter usable behind a forwarded local port.
+Sends HEAD requests to the gateway port, waiting 'initial_delay' seconds
+after the first miss and twice as long after each next one [up to
+'max_delay'], until jupyter answers with any HTTP status line. A tunnel that
+is up before jupyter listens closes the connection without an answer.
+
+Time-to-ready [seconds from the 'initiated' event of the login] is recorded as
+a 'ready' event in 'session_events', so it is rolled into the hourly
+aggregates with the session states.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import time
+import socket
+import asyncio
+from helper_functions import logger
+from sqlite_database import get_connection, SQL_INSERT_EVENT
+
+# ANY PAGE WORKS - JUPYTER ANSWERS '/' WITH A REDIRECT
+PROBE_REQUEST = b'HEAD / HTTP/1.0\r\n\r\n'
+
+
+def is_answer(data):
+    return data.startswith(b'HTTP/')
+
+
+def probe(port, host='127.0.0.1', timeout=30, initial_delay=0.05, max_delay=1.0, request_timeout=2):
+    '''Wait until jupyter answers on host:port.
+
+    Args:
+        port: Forwarded local port.
+        timeout: Seconds to keep trying.
+        initial_delay: Seconds to wait after the first miss.
+        max_delay: Most seconds between two requests.
+        request_timeout: Seconds to wait for one answer.
+    Return:
+        seconds: Seconds until jupyter answered or None if it did not within 'timeout'.
+    '''
+
+    start = time.time()
+    delay = initial_delay
+    while True:
+        try:
+            with socket.create_connection((host, int(port)), timeout=request_timeout) as sock:
+                sock.sendall(PROBE_REQUEST)
+                if is_answer(sock.recv(16)):
+                    return time.time() - start
+        except (socket.error, socket.timeout):
+            pass
+        if time.time() + delay - start > timeout:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+async def async_probe(port, host='127.0.0.1', timeout=30, initial_delay=0.05, max_delay=1.0, request_timeout=2):
+    '''probe() for the event loop of the tunnel daemon.
+    '''
+
+    start = time.time()
+    delay = initial_delay
+    while True:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), request_timeout)
+            try:
+                writer.write(PROBE_REQUEST)
+                if is_answer(await asyncio.wait_for(reader.read(16), request_timeout)):
+                    return time.time() - start
+            finally:
+                writer.close()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        if time.time() + delay - start > timeout:
+            return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def record_ready(db_name, user, local_port, remote_port, pid, seconds):
+    '''Record that the session of 'user' answers on 'local_port'.
+
+    Args:
+        seconds: Seconds the prober waited [None - not ready in time, nothing recorded].
+    '''
+
+    if seconds is None:
+        logger(user=user, message='JUPYTER NOT READY ON LOCAL PORT %s!' % local_port, level='WARNING',
+               phase='ready', local_port=local_port, remote_port=remote_port)
+        return
+    logger(user=user, message='JUPYTER READY ON LOCAL PORT %s [PROBED %.3fs]' % (local_port, seconds),
+           level='INFO', phase='ready', latency=seconds, local_port=local_port, remote_port=remote_port)
+    try:
+        get_connection(db_name).execute(SQL_INSERT_EVENT, (str(user), 'ready', time.time(), int(local_port),
+                                                           int(remote_port), int(pid)))
+    except Exception as e:
+        logger(user=user, message='record_ready FAILED! %s' % str(e), level='ERROR')
+    return
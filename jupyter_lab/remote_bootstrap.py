@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Remote bootstrap run on the HPC login node once per login.
+The gateway runs this file with the HPC python [PYTHON_PATH, Python 3.6 - no
+gateway imports, no f-strings] over ssh, sends one JSON spec line on stdin
+after BOOTSTRAP_READY and reads back one JSON result line starting with
+RESULT_MARKER. It does all that configure() used to type line by line:
+    - check the user scratch directory
+    - create .ipython and the home directory link
+    - write jupyter_notebook_config.py if it is not current
+    - set the jupyter password hash
+    - find a running jupyter server or a free port
+    - start jupyter lab if asked [start_server], from the warm pool
+      [warm_pool.py] when there is one
+
+Spec: {"user", "work_dir", "home_dir", "config", "config_current", "password_hash"}
+    config: text of jupyter_notebook_config.py [None - leave it].
+    config_current: The gateway already applied this config - only write it
+        if the file is missing.
+    password_hash: 'sha1:<salt>:<hash>' [None - leave it].
+    start_server: {"jupyter_bin_path", "python_path", "timeout", "warm_pool"}
+        to start jupyter lab when none is running [None - the gateway starts
+        it]. warm_pool: Unix socket of the warm pool [None - no pool].
+Result: {"ok", "error", "running", "started", "warm", "port", "config_written", "seconds"}
+
+Run by hand: `$ echo '{"user": "euid", ...}' | python remote_bootstrap.py`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import base64
+import socket
+import subprocess
+
+# PRINTED WHEN THE SCRIPT WAITS FOR THE SPEC [THE LOGIN WORKED]
+BOOTSTRAP_READY = 'BOOTSTRAP_READY'
+# PREFIX OF THE RESULT LINE
+RESULT_MARKER = 'BOOTSTRAP_RESULT '
+# GATEWAY SIDE: RUN THIS FILE WITH THE HPC PYTHON [SOURCE SENT AS AN ARGUMENT - NOTHING TO INSTALL ON HPC]
+REMOTE_COMMAND = "%s/bin/python3 -c 'import base64,sys; exec(base64.b64decode(sys.argv[1]))' %s"
+
+
+def write_if_changed(path, text):
+    '''Write a file atomically if its content is different.
+
+    Return:
+        True if the file was written.
+    '''
+
+    try:
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return False
+    except (IOError, OSError):
+        pass
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+    return True
+
+
+def set_password(config_dir, password_hash):
+    '''Save password hash like `jupyter notebook password`.
+
+    Return:
+        True if the file was written.
+    '''
+
+    path = os.path.join(config_dir, 'jupyter_notebook_config.json')
+    settings = {}
+    try:
+        with open(path, 'r') as f:
+            settings = json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+    if settings.get('NotebookApp', {}).get('password') == password_hash:
+        # SAME PASSWORD - KEEP THE FILE AS IT IS
+        return False
+    settings.setdefault('NotebookApp', {})['password'] = password_hash
+    return write_if_changed(path, json.dumps(settings, indent=2))
+
+
+def running_server(runtime_dir, pid=None):
+    '''Port of the last started jupyter server still running, like
+    `jupyter notebook list` [reads the runtime files of the servers].
+
+    Args:
+        runtime_dir: Jupyter runtime directory.
+        pid: Only the server with this pid.
+    '''
+
+    servers = []
+    for path in glob.glob(os.path.join(runtime_dir, 'nbserver-*.json')) + \
+            glob.glob(os.path.join(runtime_dir, 'jpserver-*.json')):
+        try:
+            with open(path, 'r') as f:
+                server = json.load(f)
+            if (pid is not None) and (int(server['pid']) != pid):
+                continue
+            os.kill(int(server['pid']), 0)
+        except (IOError, OSError, ValueError, KeyError):
+            # STOPPED SERVER OR FILE BEING WRITTEN
+            continue
+        servers.append((os.path.getmtime(path), int(server['port'])))
+    return max(servers)[1] if servers else None
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def warm_start(pool_socket, work_dir, port, env, timeout=5):
+    '''Ask the warm pool for a jupyter lab with imports already done.
+
+    Return:
+        pid: Process id of the server or None [no pool, pool empty or refused].
+    '''
+
+    if (not pool_socket) or (not os.path.exists(pool_socket)):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(pool_socket)
+        sock.sendall((json.dumps({'cmd': 'start', 'work_dir': work_dir, 'port': port, 'env': env}) +
+                      '\n').encode('utf-8'))
+        answer = json.loads(sock.makefile('r').readline())
+    except (IOError, OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+    return answer.get('pid') if answer.get('ok') else None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def start_server(work_dir, port, jupyter_bin_path, python_path, timeout, warm_pool=None):
+    '''Start jupyter lab in the background [like `nohup jupyter lab ... &`]
+    and wait for its runtime file.
+
+    Return:
+        port: Port jupyter listens on [it moves to the next port if 'port'
+            is taken] or None if it did not start within 'timeout' seconds.
+        warm: True if the server came from the warm pool.
+    '''
+
+    config_dir = os.path.join(work_dir, '.jupyter')
+    env = dict(os.environ)
+    env['PATH'] = '%s:%s/bin:%s/lib' % (env.get('PATH', ''), python_path, python_path)
+    env['IPYTHONDIR'] = os.path.join(work_dir, '.ipython')
+    env['JUPYTER_CONFIG_DIR'] = config_dir
+    env['JUPYTER_DATA_DIR'] = config_dir
+    pid = warm_start(warm_pool, work_dir, port, env)
+    warm = pid is not None
+    if warm:
+        alive = lambda: pid_alive(pid)
+    else:
+        with open(os.path.join(work_dir, '.jupyter_lab.log'), 'wb') as log:
+            process = subprocess.Popen([jupyter_bin_path, 'lab', '--no-browser', '--ip=0.0.0.0',
+                                        '--port=%d' % port], stdin=subprocess.DEVNULL, stdout=log,
+                                       stderr=subprocess.STDOUT, cwd=work_dir, env=env, start_new_session=True)
+        pid = process.pid
+        alive = lambda: process.poll() is None
+    deadline = time.time() + timeout
+    while (time.time() < deadline) and alive():
+        # RUNTIME FILE IS WRITTEN ONCE THE SERVER LISTENS
+        started = running_server(os.path.join(config_dir, 'runtime'), pid=pid)
+        if started is not None:
+            return started, warm
+        time.sleep(0.1 if warm else 0.25)
+    return None, warm
+
+
+def bootstrap(spec):
+    '''Prepare the user environment.
+
+    Args:
+        spec: Dictionary, see module docstring.
+    Return:
+        result: Dictionary, see module docstring.
+    '''
+
+    start = time.time()
+    result = {'ok': False, 'error': None, 'running': False, 'started': False, 'warm': False, 'port': None,
+              'config_written': False}
+    work_dir = spec['work_dir']
+    if not os.path.isdir(work_dir):
+        result['error'] = 'NO DIRECTORY %s' % work_dir
+        return result
+    os.chdir(work_dir)
+    config_dir = os.path.join(work_dir, '.jupyter')
+    for path in [config_dir, os.path.join(work_dir, '.ipython')]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    # LINK TO HOME DIRECTORY IF NOT EXISTING
+    home_link = os.path.join(work_dir, '%s_home_dir' % spec['user'])
+    if spec.get('home_dir') and not os.path.lexists(home_link):
+        os.symlink(spec['home_dir'], home_link)
+    config_path = os.path.join(config_dir, 'jupyter_notebook_config.py')
+    if (spec.get('config') is not None) and not (spec.get('config_current') and os.path.exists(config_path)):
+        # ONE ATOMIC WRITE [NOTHING TOUCHED WHEN THE GATEWAY SAYS IT IS CURRENT]
+        result['config_written'] = write_if_changed(config_path, spec['config'])
+    if spec.get('password_hash') is not None:
+        set_password(config_dir, spec['password_hash'])
+    # JUPYTER_DATA_DIR IS .jupyter - SERVERS WRITE THEIR RUNTIME FILES IN .jupyter/runtime
+    port = running_server(os.path.join(config_dir, 'runtime'))
+    result['running'] = port is not None
+    result['port'] = port if port is not None else free_port()
+    server = spec.get('start_server')
+    if (server is not None) and (not result['running']):
+        port, result['warm'] = start_server(work_dir, result['port'], server['jupyter_bin_path'],
+                                            server['python_path'], server.get('timeout', 60), server.get('warm_pool'))
+        if port is None:
+            result['error'] = 'JUPYTER DID NOT START [SEE .jupyter_lab.log]'
+        else:
+            result['running'], result['started'], result['port'] = True, True, port
+    result['ok'] = True
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def remote_command(python_path):
+    '''Gateway side: remote command line that runs this file.
+
+    Args:
+        python_path: Python installation on HPC [PYTHON_PATH].
+    '''
+
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return REMOTE_COMMAND % (python_path, base64.b64encode(f.read()).decode('ascii'))
+
+
+def main():
+    sys.stdout.write(BOOTSTRAP_READY + '\n')
+    sys.stdout.flush()
+    try:
+        result = bootstrap(json.loads(sys.stdin.readline()))
+    except Exception as e:
+        result = {'ok': False, 'error': '%s: %s' % (type(e).__name__, str(e))}
+    sys.stdout.write(RESULT_MARKER + json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process cache of session rows read with from_db.
+Rows are kept by user with a time to live and least recently used eviction.
+
+Session processes forked from the gateway write state for their user while
+the web process reads it. Every user hashes to a generation counter in shared
+memory that add_db increments on each write, so a cached row is dropped in
+every process as soon as any process changes that user.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from multiprocessing import Array
+
+# RETURNED BY get() WHEN THE USER IS NOT CACHED
+MISS = object()
+
+
+class SessionCache(object):
+    """
+    Args:
+        max_size: Most users kept in the cache.
+        ttl: Seconds a cached row is used before it is read again.
+        buckets: Number of shared generation counters.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, buckets=4096):
+        self.max_size = max_size
+        self.ttl = ttl
+        # CREATED BEFORE FORK - SHARED WITH ALL SESSION PROCESSES
+        self._generations = Array('Q', buckets)
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidated = 0
+        return
+
+    def _bucket(self, user):
+        return zlib.crc32(str(user).encode('utf-8')) % len(self._generations)
+
+    def generation(self, user):
+        """Current generation of the user. Read it before reading the
+        database and pass it to put().
+        """
+
+        return self._generations[self._bucket(user)]
+
+    def get(self, user):
+        """Cached row of user.
+
+        Return:
+            row: Row dictionary, None for unknown user or MISS.
+        """
+
+        now = time.time()
+        generation = self.generation(user)
+        with self._lock:
+            entry = self._rows.get(user)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            expires, entry_generation, row = entry
+            if (expires < now) or (entry_generation != generation):
+                del self._rows[user]
+                self.expired += 1
+                self.misses += 1
+                return MISS
+            self._rows.move_to_end(user)
+            self.hits += 1
+        return None if row is None else dict(row)
+
+    def put(self, user, row, generation):
+        """Cache row read from the database.
+
+        Args:
+            user: User id.
+            row: Row dictionary or None.
+            generation: generation(user) from before the database read.
+        """
+
+        with self._lock:
+            self._rows[user] = (time.time() + self.ttl, generation, None if row is None else dict(row))
+            self._rows.move_to_end(user)
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+                self.evicted += 1
+        return
+
+    def invalidate(self, user):
+        """Drop cached row of user in every process. Call after writing the user.
+        """
+
+        bucket = self._bucket(user)
+        with self._generations.get_lock():
+            self._generations[bucket] += 1
+        with self._lock:
+            if self._rows.pop(user, None) is not None:
+                self.invalidated += 1
+        return
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+        return
+
+    def metrics(self):
+        """Cache counters of this process.
+
+        Return:
+            Dictionary with hit and miss counters.
+        """
+
+        total = self.hits + self.misses
+        return {'size': len(self._rows),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'invalidated': self.invalidated}
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Session event history.
+add_db appends every state transition to the 'session_events' table. This
+module keeps that table bounded: events older than the retention are rolled
+into 'session_events_hourly' (one row per hour and phase) and deleted, oldest
+hours first, also whenever the table grows past 'max_events' rows.
+
+Run: `$ python session_history.py --hours 24` [events and durations per hour and phase]
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from helper_functions import logger
+from sqlite_database import get_connection, transaction
+from usage_stats import prune_daily_users
+
+# ROLL EVENTS OF HOURS [?, ?) INTO HOURLY AGGREGATES. 'users' OF AN HOUR
+# COMPACTED IN TWO PASSES IS AN UPPER BOUND.
+SQL_ROLLUP_EVENTS = '''INSERT INTO session_events_hourly (hour, phase, events, users, total_duration, max_duration,
+                                                    durations)
+                  SELECT hour, phase, COUNT(*), COUNT(DISTINCT user), COALESCE(SUM(duration), 0), MAX(duration),
+                         COUNT(duration)
+                  FROM session_events WHERE hour >= ? AND hour < ? GROUP BY hour, phase
+                  ON CONFLICT (hour, phase) DO UPDATE SET events=events + excluded.events,
+                         users=users + excluded.users,
+                         durations=durations + excluded.durations,
+                         total_duration=total_duration + excluded.total_duration,
+                         max_duration=MAX(COALESCE(max_duration, excluded.max_duration),
+                                          COALESCE(excluded.max_duration, max_duration))'''
+SQL_DELETE_EVENTS = 'DELETE FROM session_events WHERE hour >= ? AND hour < ?'
+SQL_OLDEST_HOUR = 'SELECT MIN(hour) FROM session_events'
+# ROWS IN session_events WITHOUT A FULL COUNT [ids ONLY GROW]
+SQL_EVENTS_ESTIMATE = 'SELECT COALESCE(MAX(id) - MIN(id) + 1, 0) FROM session_events'
+# EVENTS PER HOUR AND PHASE FROM RAW EVENTS AND AGGREGATES
+# durations: EVENTS WITH A duration [THE AVERAGE IS OVER THOSE ONLY]
+SQL_HOURLY_SUMMARY = '''SELECT hour, phase, SUM(events), SUM(users), SUM(total_duration), MAX(max_duration),
+                         SUM(durations) FROM
+                  (SELECT hour, phase, COUNT(*) AS events, COUNT(DISTINCT user) AS users,
+                          COALESCE(SUM(duration), 0) AS total_duration, MAX(duration) AS max_duration,
+                          COUNT(duration) AS durations
+                   FROM session_events WHERE hour >= ? AND hour < ? GROUP BY hour, phase
+                   UNION ALL
+                   SELECT hour, phase, events, users, total_duration, max_duration, durations
+                   FROM session_events_hourly WHERE hour >= ? AND hour < ?)
+                  GROUP BY hour, phase ORDER BY hour, phase'''
+
+
+def compact_hours(conn, start_hour, end_hour):
+    '''Roll events of hours [start_hour, end_hour) into aggregates and delete them.
+
+    Return:
+        Number of events deleted.
+    '''
+
+    with transaction(conn):
+        conn.execute(SQL_ROLLUP_EVENTS, (start_hour, end_hour))
+        deleted = conn.execute(SQL_DELETE_EVENTS, (start_hour, end_hour)).rowcount
+    return deleted
+
+
+def compact_events(db_name, retention_days=30, max_events=1000000, chunk_hours=24):
+    '''Compact session_events. Events older than 'retention_days' are rolled
+    into hourly aggregates, then the oldest hours are rolled up until the table
+    holds at most 'max_events' rows. Every chunk of hours is its own short
+    transaction so state writes are not held up. Deleted pages are reused by
+    new events, so the database file stops growing.
+
+    Args:
+        db_name: Database name.
+        retention_days: Days of raw events to keep.
+        max_events: Most raw events to keep.
+        chunk_hours: Hours compacted per transaction.
+    Return:
+        compacted: Number of events rolled into aggregates.
+    '''
+
+    conn = get_connection(db_name)
+    compacted = 0
+    cutoff_hour = int(time.time() // 3600) - retention_days * 24
+    oldest_hour = conn.execute(SQL_OLDEST_HOUR).fetchone()[0]
+    # RETENTION
+    while (oldest_hour is not None) and (oldest_hour < cutoff_hour):
+        end_hour = min(oldest_hour + chunk_hours, cutoff_hour)
+        compacted += compact_hours(conn, oldest_hour, end_hour)
+        oldest_hour = conn.execute(SQL_OLDEST_HOUR).fetchone()[0]
+    # BOUNDED SIZE - ONE HOUR AT A TIME
+    while (oldest_hour is not None) and (conn.execute(SQL_EVENTS_ESTIMATE).fetchone()[0] > max_events):
+        compacted += compact_hours(conn, oldest_hour, oldest_hour + 1)
+        oldest_hour = conn.execute(SQL_OLDEST_HOUR).fetchone()[0]
+    if compacted:
+        logger(user='root', message='COMPACTED %d SESSION EVENTS' % compacted, level='INFO')
+    return compacted
+
+
+def start_compaction(db_name, interval=3600, retention_days=30, max_events=1000000):
+    '''Run compact_events() now and every 'interval' seconds in a daemon thread.
+    Also drops the per user rows behind daily active users after the retention.
+
+    Return:
+        thread: Compaction thread.
+    '''
+
+    def run():
+        while True:
+            try:
+                compact_events(db_name, retention_days=retention_days, max_events=max_events)
+                prune_daily_users(db_name, keep_days=retention_days)
+            except Exception as e:
+                logger(user='root', message='compact_events FAILED! %s' % str(e), level='ERROR')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='session_events_compaction', daemon=True)
+    thread.start()
+    return thread
+
+
+def hourly_summary(db_name, start, end):
+    '''Events per hour and phase between two dates, from raw events and
+    compacted aggregates.
+
+    Args:
+        db_name: Database name.
+        start: Epoch seconds.
+        end: Epoch seconds.
+    Return:
+        rows: List of dictionaries with 'hour' (epoch seconds), 'phase',
+            'events', 'users', 'avg_duration' and 'max_duration'.
+    '''
+
+    start_hour, end_hour = int(start // 3600), int(end // 3600) + 1
+    rows = get_connection(db_name).execute(SQL_HOURLY_SUMMARY, (start_hour, end_hour, start_hour, end_hour))
+    return [{'hour': hour * 3600,
+             'phase': phase,
+             'events': events,
+             'users': users,
+             'avg_duration': total_duration / durations if durations else None,
+             'max_duration': max_duration}
+            for hour, phase, events, users, total_duration, max_duration, durations in rows]
+
+
+def print_hourly(rows):
+    '''Print hourly_summary() rows as a text table.
+    '''
+
+    print('HOUR              PHASE       events  users  avg_duration  max_duration')
+    for row in rows:
+        print('  %s %-10s %6d %6d %13s %13s' %
+              (time.strftime('%Y-%m-%d %H:00', time.localtime(row['hour'])), row['phase'], row['events'],
+               row['users'], '-' if row['avg_duration'] is None else '%.1f' % row['avg_duration'],
+               '-' if row['max_duration'] is None else '%.1f' % row['max_duration']))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Session events per hour and phase.')
+    parser.add_argument('--db', default='database_jupyter_lab.db', help='database file')
+    parser.add_argument('--hours', type=int, default=24, help='hours back from now')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    now = time.time()
+    rows = hourly_summary(args.db, now - args.hours * 3600, now)
+    if args.json:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    else:
+        print_hourly(rows)
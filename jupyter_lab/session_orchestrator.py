@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Session orchestrator: logins of all users as coroutines of one event loop.
+Runs inside the tunnel daemon process [tunnel_daemon]. A login is one
+message on the daemon control socket ('login'); the web request waits for the
+answer instead of forking a session process. Each login is driven on one
+asyncssh connection, which is the connection the tunnel uses afterwards:
+    - log in [wrong credentials end here]
+    - fast path: jupyter of the readiness profile answers on its port
+    - otherwise remote_bootstrap.py [config, running jupyter or start one,
+      from the warm pool of the login node if there is one]
+    - lease a local port and open the tunnel
+    - probe the tunnel until jupyter answers [readiness]
+Database calls run in the default thread pool of the loop, so hundreds of
+logins in progress use a few threads.
+
+Answers are the messages of the session processes: 'running <local port>',
+'ended 0' [invalid credentials] or 'ended None' [server error].
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import json
+import time
+import asyncio
+import functools
+from datetime import datetime
+from helper_functions import logger
+from sqlite_database import add_db, get_profile, set_config_hash, set_readiness
+from port_allocator import allocate_port, release_port
+from jupyter_config import render_config, password_hash, JUPYTER_API_REQUEST
+from remote_bootstrap import RESULT_MARKER, remote_command
+from login_progress import report
+from readiness import async_probe, record_ready
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+class SessionOrchestrator(object):
+    """
+    Args:
+        daemon: TunnelDaemon running the event loop [tunnels and database name].
+        max_logins: Most logins talking to HPC at once. More wait their turn.
+        probe_timeout: Seconds to wait for jupyter to answer on the fast path.
+    """
+
+    def __init__(self, daemon, max_logins=200, probe_timeout=5):
+        self.daemon = daemon
+        self.db_name = daemon.db_name
+        self.probe_timeout = probe_timeout
+        self._slots = asyncio.Semaphore(max_logins)
+        self.metrics = {'logins': 0, 'running': 0, 'denied': 0, 'failed': 0, 'fast_path': 0, 'in_progress': 0,
+                        'login_seconds': 0, 'max_login_seconds': 0, 'ready_seconds': 0, 'max_ready_seconds': 0,
+                        'not_ready': 0, 'warm_starts': 0, 'cold_starts': 0}
+        return
+
+    async def _db(self, function, *args, **kwargs):
+        # BLOCKING DATABASE CALL IN THE THREAD POOL
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    async def login(self, user, credential, hostname, python_path, jupyter_bin_path, session_length,
+                    start_timeout=60, fast_path=True, lease_max_age=None, token=None, ready_timeout=30,
+                    warm_pool=None):
+        """Log in a user, start or find jupyter and open the tunnel.
+        Phases are reported under 'token' [login_progress].
+
+        Return:
+            message: 'running <local port>', 'ended 0' or 'ended None'.
+        """
+
+        start = time.time()
+        self.metrics['logins'] += 1
+        self.metrics['in_progress'] += 1
+        try:
+            async with self._slots:
+                message = await self._login(user, credential, hostname, python_path, jupyter_bin_path,
+                                            int(session_length), start_timeout, fast_path, lease_max_age, token,
+                                            ready_timeout, warm_pool)
+        except Exception as e:
+            logger(user=user, message='LOGIN FAILED! %s: %s' % (type(e).__name__, str(e)), level='ERROR')
+            message = 'ended None'
+        finally:
+            self.metrics['in_progress'] -= 1
+        elapsed = time.time() - start
+        if message.startswith('running'):
+            self.metrics['running'] += 1
+        else:
+            self.metrics['denied' if message == 'ended 0' else 'failed'] += 1
+        self.metrics['login_seconds'] += elapsed
+        self.metrics['max_login_seconds'] = max(self.metrics['max_login_seconds'], elapsed)
+        if not message.startswith('running'):
+            # 'running' OR 'not_ready' WAS REPORTED BY _login() AFTER THE PROBE
+            await self._db(report, self.db_name, token, user, 'failed', message)
+            # UPDATE USER IN DATABASE
+            await self._db(add_db,
+                           db_name=self.db_name,
+                           user=user,
+                           last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                           local_port=0,
+                           talon_port=0,
+                           login_node=hostname,
+                           pid_session=0,
+                           state_session='ended')
+        return message
+
+    async def _login(self, user, credential, hostname, python_path, jupyter_bin_path, session_length,
+                     start_timeout, fast_path, lease_max_age, token, ready_timeout, warm_pool):
+        start = time.time()
+        # UPDATE USER IN DATABASE [THE DAEMON DRIVES THIS SESSION]
+        await self._db(add_db,
+                       db_name=self.db_name,
+                       user=user,
+                       last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       local_port=0,
+                       talon_port=0,
+                       login_node=hostname,
+                       pid_session=os.getpid(),
+                       state_session='initiated')
+        await self._db(report, self.db_name, token, user, 'authenticating')
+        try:
+            connection = await self.daemon._connect(user, credential, hostname)
+        except asyncssh.PermissionDenied:
+            logger(user=user, message='LOGIN DENIED!', level='ERROR', phase='login', latency=time.time() - start)
+            return 'ended 0'
+        logger(user=user, message='USER EXISTS!', level='INFO', phase='login', latency=time.time() - start)
+
+        local_port = None
+        try:
+            await self._db(report, self.db_name, token, user, 'configuring')
+            config, config_hash = render_config(user, session_length)
+            profile = await self._db(get_profile, self.db_name, user)
+            remote_port = None
+            if fast_path:
+                remote_port = await self._fast_path(connection, user, hostname, profile, config_hash,
+                                                    session_length)
+            if remote_port is None:
+                await self._db(report, self.db_name, token, user, 'starting')
+                remote_port = await self._bootstrap(connection, user, credential, hostname, python_path,
+                                                    jupyter_bin_path, config, config_hash, profile, start_timeout,
+                                                    warm_pool)
+            if remote_port is None:
+                connection.close()
+                return 'ended None'
+            await self._db(report, self.db_name, token, user, 'forwarding')
+            local_port = await self._db(allocate_port, db_name=self.db_name, user=user, pid=os.getpid(),
+                                        max_age=lease_max_age)
+            if local_port is None:
+                connection.close()
+                return 'ended None'
+            answer = await self.daemon._open(user, None, hostname, local_port, remote_port, session_length,
+                                             os.getpid(), connection=connection)
+        except BaseException:
+            connection.close()
+            if local_port is not None:
+                await self._db(release_port, self.db_name, local_port, os.getpid())
+            raise
+        if not answer['ok']:
+            await self._db(release_port, self.db_name, local_port, os.getpid())
+            return 'ended None'
+        # ANSWER ONCE THE BROWSER CAN USE IT
+        seconds = await async_probe(local_port, timeout=ready_timeout)
+        if seconds is None:
+            self.metrics['not_ready'] += 1
+        else:
+            self.metrics['ready_seconds'] += seconds
+            self.metrics['max_ready_seconds'] = max(self.metrics['max_ready_seconds'], seconds)
+        await self._db(record_ready, self.db_name, user, local_port, remote_port, os.getpid(), seconds)
+        # NO REDIRECT TO A PORT THAT DOES NOT ANSWER [THE SESSION IS KEPT]
+        await self._db(report, self.db_name, token, user, 'running' if seconds is not None else 'not_ready',
+                       local_port)
+        return 'running %s' % local_port
+
+    async def _fast_path(self, connection, user, hostname, profile, config_hash, session_length):
+        """Port of the jupyter in the readiness profile if it answers now [see JupyterLab.fast_path()].
+        """
+
+        if (profile is None) or (not profile['remote_port']) or (profile['login_node'] != hostname) or \
+                (time.time() - profile['verified'] > session_length) or (profile['config_hash'] != config_hash):
+            return None
+        start = time.time()
+        remote_port = profile['remote_port']
+        answer = b''
+        try:
+            reader, writer = await connection.open_connection('127.0.0.1', remote_port)
+            writer.write(JUPYTER_API_REQUEST)
+            answer = await asyncio.wait_for(reader.read(), self.probe_timeout)
+            writer.close()
+        except Exception:
+            pass
+        if b'"version"' not in answer:
+            logger(user=user, message='FAST PATH: NO JUPYTER ON PORT %s' % remote_port, level='WARNING',
+                   phase='verify', latency=time.time() - start, remote_port=remote_port)
+            await self._db(set_readiness, self.db_name, user, 0, hostname)
+            return None
+        await self._db(set_readiness, self.db_name, user, remote_port, hostname)
+        self.metrics['fast_path'] += 1
+        logger(user=user, message='FAST PATH: JUPYTER ANSWERED ON PORT %s' % remote_port, level='CRITICAL',
+               phase='verify', latency=time.time() - start, remote_port=remote_port)
+        return remote_port
+
+    async def _bootstrap(self, connection, user, credential, hostname, python_path, jupyter_bin_path, config,
+                         config_hash, profile, start_timeout, warm_pool=None):
+        """Run remote_bootstrap.py [see JupyterLab.configure()] and start jupyter if none is running.
+
+        Return:
+            remote_port: Port of the running jupyter or None.
+        """
+
+        start = time.time()
+        spec = {'user': user,
+                'work_dir': '/storage/scratch2/%s' % user,
+                'home_dir': '/home/%s/' % user,
+                'config': config,
+                'config_current': (profile is not None) and (profile['config_hash'] == config_hash),
+                'password_hash': password_hash(user, credential),
+                'start_server': {'jupyter_bin_path': jupyter_bin_path, 'python_path': python_path,
+                                 'timeout': start_timeout, 'warm_pool': warm_pool}}
+        process = await connection.run(remote_command(python_path), input=json.dumps(spec) + '\n',
+                                       timeout=start_timeout + 30)
+        result = None
+        for line in (process.stdout or '').splitlines():
+            if line.startswith(RESULT_MARKER):
+                result = json.loads(line[len(RESULT_MARKER):])
+        if (result is None) or (not result.get('ok')) or (not result.get('running')):
+            logger(user=user, message='BOOTSTRAP FAILED! %s %s' % ((result or {}).get('error'),
+                                                                    (process.stderr or '')[-500:]),
+                   level='ERROR', phase='configure', latency=time.time() - start)
+            return None
+        if result['started']:
+            self.metrics['warm_starts' if result.get('warm') else 'cold_starts'] += 1
+        if not spec['config_current']:
+            await self._db(set_config_hash, self.db_name, user, config_hash)
+        await self._db(set_readiness, self.db_name, user, result['port'], hostname)
+        logger(user=user, message='jupyter_port %s STARTED %s WARM %s CONFIG %s %s [BOOTSTRAP %ss]' %
+               (result['port'], result['started'], result.get('warm'), config_hash,
+                'WRITTEN' if result['config_written'] else 'UNCHANGED', result.get('seconds')),
+               level='CRITICAL', phase='configure', latency=time.time() - start, remote_port=result['port'])
+        return result['port']
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Session reaper.
+Brings session rows, session processes, ssh tunnels and local ports back in
+agreement, at gateway start and every few seconds after:
+    - 'initiated' or 'running' sessions whose process is gone are set 'ended'.
+    - 'initiated' sessions without a process for too long are set 'ended'.
+    - ssh tunnels ('ssh -L 0.0.0.0:<port>:...') not owned by the session
+      process holding the lease of <port> are killed.
+    - ssh masters [ssh_master] whose session process is gone are killed.
+    - port leases of dead processes are reclaimed [port_allocator].
+    - progress of logins older than a day is removed [login_progress].
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import time
+import threading
+from helper_functions import logger, pid_alive, kill_pid, same_program
+from sqlite_database import get_connection, add_db, from_db
+from port_allocator import reclaim_ports
+from login_progress import clear_progress
+from ssh_master import CONTROL_DIR
+
+# ACTIVE SESSIONS, ONE PAGE AT A TIME [KEYSET ON user]
+SQL_ACTIVE_SESSIONS = '''SELECT user, login_node, pid_session, state_session, last_login FROM jupyter_talon
+                  WHERE state_session IN ('initiated', 'running') AND user > ? ORDER BY user LIMIT ?'''
+# pid 0 FOR FREE PORTS
+SQL_PORT_LEASES = 'SELECT port, pid FROM port_pool'
+
+# COUNTERS OF THE REAPER OF THIS PROCESS
+_metrics = {'runs': 0, 'sessions_checked': 0, 'sessions_ended': 0, 'tunnels_killed': 0, 'masters_killed': 0,
+            'ports_reclaimed': 0, 'last_run_seconds': 0, 'last_run': 0}
+
+
+def find_ssh():
+    '''ssh processes of this user on the gateway [Linux /proc].
+
+    Return:
+        List of (pid, ppid, arguments).
+    '''
+
+    processes = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return processes
+    uid = os.getuid()
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            if os.stat('/proc/%s' % name).st_uid != uid:
+                continue
+            with open('/proc/%s/cmdline' % name, 'rb') as f:
+                args = f.read().decode('utf-8', 'replace').split('\0')
+            if os.path.basename(args[0]) != 'ssh':
+                continue
+            with open('/proc/%s/stat' % name, 'r') as f:
+                stat = f.read()
+            processes.append((int(name), int(stat[stat.rindex(')') + 2:].split()[1]), args))
+        except (OSError, ValueError, IndexError):
+            # PROCESS ENDED WHILE READING
+            continue
+    return processes
+
+
+def find_tunnels(processes=None):
+    '''ssh tunnels ('ssh -L 0.0.0.0:<port>:...') of this user on the gateway.
+
+    Return:
+        List of (pid, ppid, local port).
+    '''
+
+    tunnels = []
+    for pid, ppid, args in find_ssh() if processes is None else processes:
+        if '-L' not in args[:-1]:
+            continue
+        forward = args[args.index('-L') + 1].split(':')
+        if (len(forward) == 4) and (forward[0] == '0.0.0.0') and forward[1].isdigit():
+            tunnels.append((pid, ppid, int(forward[1])))
+    return tunnels
+
+
+def find_masters(processes=None):
+    '''ssh masters started by ssh_master.SSHMaster.
+
+    Return:
+        List of (pid, ppid).
+    '''
+
+    return [(pid, ppid) for pid, ppid, args in (find_ssh() if processes is None else processes)
+            if ('-M' in args) and ('-S' in args[:-1]) and
+            (os.path.dirname(args[args.index('-S') + 1]) == CONTROL_DIR)]
+
+
+def reap_sessions(db_name, initiated_timeout=300, max_age=None, batch_size=500):
+    '''One reconciliation pass.
+
+    Args:
+        db_name: Database name.
+        initiated_timeout: Seconds a session can stay 'initiated' without a process.
+        max_age: Seconds after which any port lease is reclaimed.
+        batch_size: Sessions read per query.
+    Return:
+        Dictionary with 'checked', 'ended', 'tunnels_killed', 'masters_killed' and 'ports_reclaimed'.
+    '''
+
+    start = time.time()
+    conn = get_connection(db_name)
+    checked, ended = 0, 0
+    last_user = ''
+    while True:
+        rows = conn.execute(SQL_ACTIVE_SESSIONS, (last_user, batch_size)).fetchall()
+        for user, login_node, pid_session, state_session, last_login in rows:
+            checked += 1
+            if pid_session:
+                dead = not pid_alive(pid_session)
+            else:
+                # NO PROCESS YET - THE WEB PROCESS IS STARTING ONE
+                dead = start - (last_login or 0) > initiated_timeout
+            if dead:
+                # READ AGAIN WITH TRANSITIONS STILL QUEUED IN THE DATABASE WRITER
+                row = from_db(db_name=db_name, user=user)
+                dead = (row is not None) and (row['pid_session'] == pid_session) and \
+                    (row['state_session'] == state_session)
+            if dead:
+                logger(user=user, message="SESSION PID %s GONE, STATE '%s' SET TO 'ended'" %
+                       (pid_session, state_session), level='WARNING', phase='reaper')
+                add_db(db_name=db_name,
+                       user=user,
+                       last_login=int(start),
+                       local_port=0,
+                       talon_port=0,
+                       login_node=login_node,
+                       pid_session=0,
+                       state_session='ended')
+                ended += 1
+        if len(rows) < batch_size:
+            break
+        last_user = rows[-1][0]
+
+    # TUNNELS ON POOL PORTS NOT OWNED BY THE SESSION HOLDING THE PORT
+    leases = dict(conn.execute(SQL_PORT_LEASES).fetchall())
+    processes = find_ssh()
+    tunnels_killed = 0
+    for pid, ppid, port in find_tunnels(processes):
+        if (port in leases) and (leases[port] != ppid):
+            logger(user='root', message='KILLING ORPHAN TUNNEL PID %s PORT %s' % (pid, port), level='WARNING',
+                   phase='reaper', local_port=port)
+            tunnels_killed += int(kill_pid(pid, timeout=2, gateway_only=False))
+
+    # MASTERS WHOSE SESSION PROCESS IS GONE [REPARENTED]
+    masters_killed = 0
+    for pid, ppid in find_masters(processes):
+        if not same_program(ppid):
+            logger(user='root', message='KILLING ORPHAN SSH MASTER PID %s' % pid, level='WARNING', phase='reaper')
+            masters_killed += int(kill_pid(pid, timeout=2, gateway_only=False))
+
+    ports_reclaimed = reclaim_ports(db_name, max_age=max_age)
+    clear_progress(db_name)
+    elapsed = time.time() - start
+    _metrics['runs'] += 1
+    _metrics['sessions_checked'] += checked
+    _metrics['sessions_ended'] += ended
+    _metrics['tunnels_killed'] += tunnels_killed
+    _metrics['masters_killed'] += masters_killed
+    _metrics['ports_reclaimed'] += ports_reclaimed
+    _metrics['last_run_seconds'] = elapsed
+    _metrics['last_run'] = int(start)
+    return {'checked': checked, 'ended': ended, 'tunnels_killed': tunnels_killed, 'masters_killed': masters_killed,
+            'ports_reclaimed': ports_reclaimed}
+
+
+def start_reaper(db_name, interval=10, initiated_timeout=300, max_age=None):
+    '''Run reap_sessions() every 'interval' seconds in a daemon thread.
+
+    Return:
+        thread: Reaper thread.
+    '''
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reap_sessions(db_name, initiated_timeout=initiated_timeout, max_age=max_age)
+            except Exception as e:
+                logger(user='root', message='reap_sessions FAILED! %s' % str(e), level='ERROR')
+
+    thread = threading.Thread(target=run, name='session_reaper', daemon=True)
+    thread.start()
+    return thread
+
+
+def reaper_metrics():
+    '''Reaper counters of this process.
+    '''
+
+    return dict(_metrics)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Session store backends.
+SessionStore is the storage interface used by the gateway for session state:
+create, upsert, get, list ports and list users by state.
+
+    SQLiteSessionStore: tuned SQLite file [same tables as sqlite_database].
+    MemorySessionStore: plain dictionaries, with an optional append-only
+        journal replayed at start for crash recovery.
+
+open_store('sqlite:///database_jupyter_lab.db') or open_store('memory://')
+builds a store from a URL. sqlite_database.use_store() makes add_db, from_db
+and get_ports use a store, e.g. to run the gateway in memory for load tests.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import abc
+import json
+import time
+from sqlite_database import get_connection, close_connections, transaction, transition_params, SESSION_STATES, \
+    SQL_UPSERT_USER, SQL_INSERT_EVENT, SQL_SELECT_USER
+
+# COLUMNS OF A SESSION ROW [SAME ORDER AS SQL_SELECT_USER]
+ROW_COLUMNS = ['first_login', 'last_login', 'local_port', 'talon_port',
+               'login_node', 'count_logins', 'pid_session', 'state_session']
+
+SQL_SELECT_USED_PORTS = 'SELECT local_port FROM jupyter_talon WHERE local_port != 0'
+SQL_SELECT_BY_STATE = 'SELECT user FROM jupyter_talon WHERE state_session=?'
+
+
+class SessionStore(abc.ABC):
+    """Storage interface for session state.
+    Transitions use the add_db arguments: user, last_login, local_port,
+    talon_port, login_node, pid_session, state_session and optional timestamp.
+    """
+
+    @abc.abstractmethod
+    def create(self):
+        """Create storage if it does not exist.
+        """
+
+    @abc.abstractmethod
+    def upsert(self, user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+               timestamp=None):
+        """Save one state transition.
+        """
+
+    def upsert_many(self, transitions):
+        """Save a list of transition dictionaries in order.
+        """
+        for transition in transitions:
+            self.upsert(**transition)
+        return
+
+    @abc.abstractmethod
+    def get(self, user):
+        """Session row of user.
+
+        Return:
+            Dictionary with ROW_COLUMNS or None.
+        """
+
+    @abc.abstractmethod
+    def list_ports(self):
+        """Local ports used by sessions.
+
+        Return:
+            List of ports different from 0.
+        """
+
+    @abc.abstractmethod
+    def list_by_state(self, state_session):
+        """Users in a state.
+
+        Return:
+            List of user ids.
+        """
+
+    def close(self):
+        return
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Args:
+        db_name: Database file name.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        return
+
+    def create(self):
+        get_connection(self.db_name)
+        return
+
+    def upsert(self, user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+               timestamp=None):
+        params, event = transition_params(user, last_login, local_port, talon_port, login_node, pid_session,
+                                          state_session, timestamp)
+        conn = get_connection(self.db_name)
+        with transaction(conn):
+            conn.execute(SQL_UPSERT_USER, params)
+            conn.execute(SQL_INSERT_EVENT, event)
+        return
+
+    def upsert_many(self, transitions):
+        if not transitions:
+            return
+        params, events = zip(*[transition_params(**transition) for transition in transitions])
+        conn = get_connection(self.db_name)
+        with transaction(conn):
+            conn.executemany(SQL_UPSERT_USER, params)
+            conn.executemany(SQL_INSERT_EVENT, events)
+        return
+
+    def get(self, user):
+        values = get_connection(self.db_name).execute(SQL_SELECT_USER, (user,)).fetchone()
+        return None if values is None else dict(zip(ROW_COLUMNS, values))
+
+    def list_ports(self):
+        return [port for (port,) in get_connection(self.db_name).execute(SQL_SELECT_USED_PORTS)]
+
+    def list_by_state(self, state_session):
+        return [user for (user,) in get_connection(self.db_name).execute(SQL_SELECT_BY_STATE, (state_session,))]
+
+    def close(self):
+        close_connections()
+        return
+
+
+class MemorySessionStore(SessionStore):
+    """Session state in dictionaries. Rows are immutable tuples replaced with
+    a single dictionary assignment, so readers never take a lock and never see
+    a half written row. Writes are expected from one thread [the gateway web
+    process or the database writer].
+
+    Args:
+        journal: Optional file name. Every transition is appended as one JSON
+            line and the file is replayed by create().
+        sync: Journal durability: 'none' [OS buffers], 'flush' [flush every
+            write] or 'fsync' [fsync every write].
+    """
+
+    def __init__(self, journal=None, sync='flush'):
+        assert sync in ['none', 'flush', 'fsync']
+        self.journal = journal
+        self.sync = sync
+        self._rows = {}
+        self._ports = {}
+        self._states = {state: {} for state in SESSION_STATES}
+        self._journal_file = None
+        return
+
+    def create(self):
+        if self.journal is not None and self._journal_file is None:
+            torn = False
+            if os.path.isfile(self.journal):
+                torn = self._replay()
+            self._journal_file = open(self.journal, 'a')
+            if torn:
+                # END THE TORN LINE SO NEW TRANSITIONS START ON THEIR OWN LINE
+                self._journal_file.write('\n')
+        return
+
+    def _replay(self):
+        """Apply transitions saved in the journal. A torn last line from a
+        crash is skipped.
+
+        Return:
+            True if the journal does not end with a new line.
+        """
+
+        line = '\n'
+        with open(self.journal, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'row' in record:
+                    # ROW SAVED BY checkpoint()
+                    self._restore(record['user'], tuple(record['row']))
+                else:
+                    self._apply(**record)
+        return not line.endswith('\n')
+
+    def _restore(self, user, values):
+        old = self._rows.get(user)
+        if old is not None and old[7] != values[7]:
+            self._states[old[7]].pop(user, None)
+        self._rows[user] = values
+        self._states[values[7]][user] = True
+        if values[2]:
+            self._ports[user] = values[2]
+        else:
+            self._ports.pop(user, None)
+        return
+
+    def _apply(self, user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+               timestamp=None):
+        (user, first_login, last_login, local_port, talon_port, login_node, pid_session, state_session), _ = \
+            transition_params(user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+                              timestamp)
+        old = self._rows.get(user)
+        if old is None:
+            count_logins = 0
+        else:
+            first_login = old[0]
+            # SAME RULE AS SQL_UPSERT_USER
+            count_logins = old[5] + int(state_session == 'running' and old[7] != 'running')
+        self._restore(user, (first_login, last_login, local_port, talon_port, login_node, count_logins,
+                             pid_session, state_session))
+        return
+
+    def upsert(self, user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+               timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self._apply(user, last_login, local_port, talon_port, login_node, pid_session, state_session, timestamp)
+        if self._journal_file is not None:
+            self._journal_file.write(json.dumps({'user': user, 'last_login': last_login, 'local_port': local_port,
+                                                 'talon_port': talon_port, 'login_node': login_node,
+                                                 'pid_session': pid_session, 'state_session': state_session,
+                                                 'timestamp': timestamp}) + '\n')
+            self._sync()
+        return
+
+    def upsert_many(self, transitions):
+        # ONE JOURNAL SYNC FOR THE WHOLE BATCH
+        sync, self.sync = self.sync, 'none'
+        try:
+            for transition in transitions:
+                self.upsert(**transition)
+        finally:
+            self.sync = sync
+        self._sync()
+        return
+
+    def _sync(self):
+        if self._journal_file is not None and self.sync != 'none':
+            self._journal_file.flush()
+            if self.sync == 'fsync':
+                os.fsync(self._journal_file.fileno())
+        return
+
+    def get(self, user):
+        values = self._rows.get(user)
+        return None if values is None else dict(zip(ROW_COLUMNS, values))
+
+    def list_ports(self):
+        return list(self._ports.values())
+
+    def list_by_state(self, state_session):
+        # CHECK ROWS - THE STATE INDEX IS UPDATED AFTER THE ROW
+        return [user for user in list(self._states[state_session])
+                if self._rows.get(user, (None,) * 8)[7] == state_session]
+
+    def checkpoint(self):
+        """Rewrite the journal with one line per user so replay stays short.
+        """
+
+        if self.journal is None:
+            return
+        tmp_journal = self.journal + '.tmp'
+        with open(tmp_journal, 'w') as f:
+            for user, values in list(self._rows.items()):
+                f.write(json.dumps({'user': user, 'row': values}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal_file is not None:
+            self._journal_file.close()
+        os.replace(tmp_journal, self.journal)
+        self._journal_file = open(self.journal, 'a')
+        return
+
+    def close(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        return
+
+
+def open_store(url):
+    '''Create store from URL.
+
+    Args:
+        url: 'sqlite:///<db file>', 'memory://' or 'memory:///<journal file>'.
+    Return:
+        store: SessionStore instance after create().
+    '''
+
+    if url.startswith('sqlite:///'):
+        store = SQLiteSessionStore(url[len('sqlite:///'):])
+    elif url.startswith('memory://'):
+        store = MemorySessionStore(journal=url[len('memory:///'):] or None)
+    else:
+        raise ValueError('unknown session store %s' % url)
+    store.create()
+    return store
@@ -4,6 +4,11 @@
 """Python Flask Server to automate Jupyter Lab port forward on HPC cluster.
 Start the server with the 'run()' method
 
+Database connections are kept open for the life of each process (and thread)
+instead of being opened and closed on every call. Each connection runs in WAL
+mode with a busy timeout so concurrent session processes wait for the write
+lock instead of failing with 'database is locked'.
+
 (C) 2020 George Mihaila
 email georgemihaila@my.unt.edu
 """
@@ -11,11 +16,444 @@ import sys
 from io import StringIO
 import os
 import time
-from datetime import datetime
+import atexit
+import threading
 import sqlite3
 import socket
-from contextlib import closing
+from contextlib import closing, contextmanager
 from helper_functions import logger
+from database_writer import DatabaseWriter
+from session_cache import SessionCache, MISS
+
+# SECONDS TO WAIT FOR A LOCKED DATABASE BEFORE FAILING
+BUSY_TIMEOUT = 30
+# NUMBER OF PREPARED STATEMENTS KEPT BY EACH CONNECTION
+CACHED_STATEMENTS = 64
+# PRAGMAS RUN ONCE ON EVERY NEW CONNECTION
+PRAGMAS = ['PRAGMA journal_mode=WAL',
+           'PRAGMA synchronous=NORMAL',
+           'PRAGMA temp_store=MEMORY',
+           'PRAGMA cache_size=-8000',
+           'PRAGMA busy_timeout=%d' % (BUSY_TIMEOUT * 1000)]
+
+# VERSION OF THE DATABASE SCHEMA [STORED IN 'PRAGMA user_version']
+SCHEMA_VERSION = 9
+# VALID VALUES OF state_session
+SESSION_STATES = ('initiated', 'running', 'ended')
+
+# SQL STATEMENTS [CONSTANT STRINGS SO SQLITE REUSES THE PREPARED STATEMENTS]
+SQL_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS jupyter_talon
+                  (user TEXT NOT NULL PRIMARY KEY,
+                   first_login INTEGER NOT NULL DEFAULT 0,
+                   last_login INTEGER NOT NULL DEFAULT 0,
+                   local_port INTEGER NOT NULL DEFAULT 0,
+                   talon_port INTEGER NOT NULL DEFAULT 0,
+                   login_node TEXT NOT NULL DEFAULT '',
+                   count_logins INTEGER NOT NULL DEFAULT 0,
+                   pid_session INTEGER NOT NULL DEFAULT 0,
+                   state_session TEXT NOT NULL DEFAULT 'ended'
+                        CHECK (state_session IN ('initiated', 'running', 'ended'))) WITHOUT ROWID'''
+SQL_CREATE_INDEXES = ['CREATE INDEX IF NOT EXISTS jupyter_talon_state ON jupyter_talon (state_session)',
+                      'CREATE INDEX IF NOT EXISTS jupyter_talon_local_port ON jupyter_talon (local_port)']
+# COPY ROWS OF THE ORIGINAL UNTYPED TABLE [DATES WERE LOCAL TIME STRINGS]
+SQL_MIGRATE_UNTYPED = '''INSERT OR REPLACE INTO jupyter_talon
+                  SELECT CAST(user AS TEXT),
+                         COALESCE(CAST(strftime('%s', first_login, 'utc') AS INTEGER), 0),
+                         COALESCE(CAST(strftime('%s', last_login, 'utc') AS INTEGER), 0),
+                         COALESCE(CAST(local_port AS INTEGER), 0),
+                         COALESCE(CAST(talon_port AS INTEGER), 0),
+                         COALESCE(NULLIF(CAST(login_node AS TEXT), '0'), ''),
+                         COALESCE(CAST(count_logins AS INTEGER), 0),
+                         COALESCE(CAST(pid_session AS INTEGER), 0),
+                         CASE WHEN state_session IN ('initiated', 'running', 'ended')
+                              THEN state_session ELSE 'ended' END
+                  FROM jupyter_talon_untyped WHERE user IS NOT NULL ORDER BY rowid'''
+# ONE STATEMENT PER STATE TRANSITION. count_logins IS INCREMENTED IN SQL WHEN
+# THE SESSION MOVES INTO 'running' SO CONCURRENT WRITERS NEVER LOSE A LOGIN.
+SQL_UPSERT_USER = '''INSERT INTO jupyter_talon (user, first_login, last_login, local_port, talon_port,
+                  login_node, count_logins, pid_session, state_session) VALUES (?,?,?,?,?,?,0,?,?)
+                  ON CONFLICT (user) DO UPDATE SET last_login=excluded.last_login,
+                         local_port=excluded.local_port,
+                         talon_port=excluded.talon_port,
+                         login_node=excluded.login_node,
+                         count_logins=count_logins + (excluded.state_session = 'running' AND state_session != 'running'),
+                         pid_session=excluded.pid_session,
+                         state_session=excluded.state_session'''
+# APPEND-ONLY HISTORY OF STATE TRANSITIONS. 'hour' (EPOCH HOURS) IS THE TIME
+# PARTITION USED BY QUERIES AND BY session_history.compact_events().
+SQL_CREATE_EVENTS = '''CREATE TABLE IF NOT EXISTS session_events
+                  (id INTEGER PRIMARY KEY,
+                   user TEXT NOT NULL,
+                   phase TEXT NOT NULL,
+                   timestamp REAL NOT NULL,
+                   hour INTEGER NOT NULL,
+                   local_port INTEGER NOT NULL DEFAULT 0,
+                   talon_port INTEGER NOT NULL DEFAULT 0,
+                   pid INTEGER NOT NULL DEFAULT 0,
+                   duration REAL)'''
+# EVENTS OLDER THAN THE RETENTION ARE ROLLED INTO HOURLY AGGREGATES
+SQL_CREATE_EVENTS_HOURLY = '''CREATE TABLE IF NOT EXISTS session_events_hourly
+                  (hour INTEGER NOT NULL,
+                   phase TEXT NOT NULL,
+                   events INTEGER NOT NULL DEFAULT 0,
+                   users INTEGER NOT NULL DEFAULT 0,
+                   total_duration REAL NOT NULL DEFAULT 0,
+                   max_duration REAL,
+                   PRIMARY KEY (hour, phase)) WITHOUT ROWID'''
+# durations: EVENTS WITH A duration [NOT THE 'initiated' ONES, NOR THOSE WHOSE 'initiated' WAS COMPACTED].
+# ROWS ROLLED UP BEFORE VERSION 9 COUNT ALL THEIR EVENTS.
+SQL_ADD_EVENTS_DURATIONS = ['ALTER TABLE session_events_hourly ADD COLUMN durations INTEGER NOT NULL DEFAULT 0',
+                            'UPDATE session_events_hourly SET durations=events WHERE max_duration IS NOT NULL']
+SQL_CREATE_EVENTS_INDEXES = ['CREATE INDEX IF NOT EXISTS session_events_hour ON session_events (hour, phase)',
+                             'CREATE INDEX IF NOT EXISTS session_events_user ON session_events (user, phase, timestamp)']
+# duration: SECONDS SINCE THE LAST 'initiated' EVENT OF THE USER
+SQL_INSERT_EVENT = '''INSERT INTO session_events (user, phase, timestamp, hour, local_port, talon_port, pid, duration)
+                  VALUES (?1, ?2, ?3, CAST(?3 / 3600 AS INTEGER), ?4, ?5, ?6,
+                          CASE WHEN ?2 = 'initiated' THEN NULL
+                               ELSE ?3 - (SELECT MAX(timestamp) FROM session_events
+                                          WHERE user = ?1 AND phase = 'initiated') END)'''
+# USAGE AGGREGATES. KEPT UP TO DATE BY TRIGGERS ON jupyter_talon SO EVERY STATE
+# TRANSITION UPDATES THEM IN THE SAME TRANSACTION. HOURS AND DAYS ARE EPOCH
+# SECONDS DIVIDED BY 3600 AND 86400. TRIGGERS USE 'ON CONFLICT DO NOTHING' -
+# 'INSERT OR IGNORE' WOULD BE OVERRIDDEN BY THE CONFLICT POLICY OF add_db.
+SQL_CREATE_USAGE = ['''CREATE TABLE IF NOT EXISTS usage_running
+                  (login_node TEXT NOT NULL PRIMARY KEY,
+                   sessions INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''',
+                    '''CREATE TABLE IF NOT EXISTS usage_hourly
+                  (hour INTEGER NOT NULL PRIMARY KEY,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   logins INTEGER NOT NULL DEFAULT 0,
+                   failures INTEGER NOT NULL DEFAULT 0)''',
+                    '''CREATE TABLE IF NOT EXISTS usage_daily
+                  (day INTEGER NOT NULL PRIMARY KEY,
+                   active_users INTEGER NOT NULL DEFAULT 0)''',
+                    '''CREATE TABLE IF NOT EXISTS usage_daily_users
+                  (day INTEGER NOT NULL,
+                   user TEXT NOT NULL,
+                   PRIMARY KEY (day, user)) WITHOUT ROWID''']
+SQL_CREATE_USAGE_TRIGGERS = ['''CREATE TRIGGER IF NOT EXISTS usage_talon_insert AFTER INSERT ON jupyter_talon
+                  BEGIN
+                      INSERT INTO usage_running (login_node, sessions) SELECT NEW.login_node, 1
+                          WHERE NEW.state_session = 'running'
+                          ON CONFLICT (login_node) DO UPDATE SET sessions=sessions + 1;
+                      INSERT INTO usage_hourly (hour, attempts, logins) SELECT CAST(strftime('%s', 'now') AS INTEGER) / 3600,
+                              NEW.state_session = 'initiated', NEW.state_session = 'running'
+                          WHERE NEW.state_session != 'ended'
+                          ON CONFLICT (hour) DO UPDATE SET attempts=attempts + excluded.attempts,
+                                                           logins=logins + excluded.logins;
+                      INSERT INTO usage_daily_users (day, user) SELECT CAST(strftime('%s', 'now') AS INTEGER) / 86400,
+                              NEW.user WHERE NEW.state_session = 'running'
+                          ON CONFLICT (day, user) DO NOTHING;
+                  END''',
+                             '''CREATE TRIGGER IF NOT EXISTS usage_talon_update AFTER UPDATE OF state_session, login_node ON jupyter_talon
+                  WHEN (OLD.state_session != NEW.state_session) OR (OLD.login_node != NEW.login_node)
+                  BEGIN
+                      UPDATE usage_running SET sessions=sessions - 1
+                          WHERE login_node = OLD.login_node AND OLD.state_session = 'running';
+                      INSERT INTO usage_running (login_node, sessions) SELECT NEW.login_node, 1
+                          WHERE NEW.state_session = 'running'
+                          ON CONFLICT (login_node) DO UPDATE SET sessions=sessions + 1;
+                      INSERT INTO usage_hourly (hour, attempts, logins, failures) SELECT CAST(strftime('%s', 'now') AS INTEGER) / 3600,
+                              NEW.state_session = 'initiated',
+                              NEW.state_session = 'running',
+                              NEW.state_session = 'ended' AND OLD.state_session = 'initiated'
+                          WHERE OLD.state_session != NEW.state_session
+                          ON CONFLICT (hour) DO UPDATE SET attempts=attempts + excluded.attempts,
+                                                           logins=logins + excluded.logins,
+                                                           failures=failures + excluded.failures;
+                      INSERT INTO usage_daily_users (day, user) SELECT CAST(strftime('%s', 'now') AS INTEGER) / 86400,
+                              NEW.user WHERE NEW.state_session = 'running'
+                          ON CONFLICT (day, user) DO NOTHING;
+                  END''',
+                             '''CREATE TRIGGER IF NOT EXISTS usage_daily_user_insert AFTER INSERT ON usage_daily_users
+                  BEGIN
+                      INSERT INTO usage_daily (day, active_users) VALUES (NEW.day, 1)
+                          ON CONFLICT (day) DO UPDATE SET active_users=active_users + 1;
+                  END''']
+# RUNNING SESSIONS ALREADY IN THE DATABASE WHEN THE AGGREGATES ARE CREATED
+SQL_INIT_USAGE_RUNNING = '''INSERT INTO usage_running (login_node, sessions)
+                  SELECT login_node, COUNT(*) FROM jupyter_talon WHERE state_session = 'running' GROUP BY login_node'''
+# LOCAL PORTS HANDED OUT BY port_allocator. A PORT IS FREE WHEN pid = 0.
+SQL_CREATE_PORT_POOL = '''CREATE TABLE IF NOT EXISTS port_pool
+                  (port INTEGER PRIMARY KEY,
+                   pid INTEGER NOT NULL DEFAULT 0,
+                   user TEXT,
+                   leased INTEGER,
+                   released INTEGER NOT NULL DEFAULT 0)'''
+# FREE LIST: FREE PORTS, LEAST RECENTLY RELEASED FIRST
+SQL_CREATE_PORT_POOL_INDEX = 'CREATE INDEX IF NOT EXISTS port_pool_free ON port_pool (released) WHERE pid = 0'
+# WHAT IS ALREADY SET UP ON HPC FOR EACH USER [config_hash: jupyter_config.render_config()]
+SQL_CREATE_USER_PROFILES = '''CREATE TABLE IF NOT EXISTS user_profiles
+                  (user TEXT NOT NULL PRIMARY KEY,
+                   config_hash TEXT NOT NULL DEFAULT '',
+                   config_applied INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID'''
+# READINESS: JUPYTER LAST SEEN ON remote_port OF login_node AT verified [remote_port 0 - UNKNOWN]
+SQL_ADD_READINESS_COLUMNS = ["ALTER TABLE user_profiles ADD COLUMN remote_port INTEGER NOT NULL DEFAULT 0",
+                             "ALTER TABLE user_profiles ADD COLUMN login_node TEXT NOT NULL DEFAULT ''",
+                             "ALTER TABLE user_profiles ADD COLUMN verified INTEGER NOT NULL DEFAULT 0"]
+PROFILE_COLUMNS = ['config_hash', 'config_applied', 'remote_port', 'login_node', 'verified']
+SQL_SELECT_PROFILE = '''SELECT config_hash, config_applied, remote_port, login_node, verified
+                  FROM user_profiles WHERE user=?'''
+SQL_SET_CONFIG_HASH = '''INSERT INTO user_profiles (user, config_hash, config_applied) VALUES (?,?,?)
+                  ON CONFLICT (user) DO UPDATE SET config_hash=excluded.config_hash,
+                         config_applied=excluded.config_applied'''
+SQL_SET_READINESS = '''INSERT INTO user_profiles (user, remote_port, login_node, verified) VALUES (?,?,?,?)
+                  ON CONFLICT (user) DO UPDATE SET remote_port=excluded.remote_port,
+                         login_node=excluded.login_node,
+                         verified=excluded.verified'''
+# PHASES OF LOGINS IN PROGRESS [login_progress]
+SQL_CREATE_LOGIN_PROGRESS = '''CREATE TABLE IF NOT EXISTS login_progress
+                  (token TEXT NOT NULL,
+                   seq INTEGER NOT NULL,
+                   user TEXT NOT NULL,
+                   phase TEXT NOT NULL,
+                   detail TEXT NOT NULL DEFAULT '',
+                   time REAL NOT NULL,
+                   PRIMARY KEY (token, seq)) WITHOUT ROWID'''
+SQL_CREATE_LOGIN_PROGRESS_INDEX = 'CREATE INDEX IF NOT EXISTS login_progress_time ON login_progress (time)'
+# PREDICTED LOGINS PER WINDOW [prewarm]. hit IS NULL UNTIL THE WINDOW IS OVER
+SQL_CREATE_PREWARM_PREDICTIONS = '''CREATE TABLE IF NOT EXISTS prewarm_predictions
+                  (window_start INTEGER NOT NULL,
+                   user TEXT NOT NULL,
+                   window_seconds INTEGER NOT NULL,
+                   weeks INTEGER NOT NULL,
+                   cold INTEGER NOT NULL DEFAULT 0,
+                   hit INTEGER,
+                   PRIMARY KEY (window_start, user)) WITHOUT ROWID'''
+SQL_SELECT_USER = '''SELECT first_login, last_login, local_port, talon_port, login_node,
+                  count_logins, pid_session, state_session FROM jupyter_talon WHERE user=?'''
+SQL_SELECT_PORTS = 'SELECT local_port FROM jupyter_talon'
+
+# OPEN CONNECTIONS OF THIS THREAD
+_local = threading.local()
+# SESSION ROWS READ BY from_db [INVALIDATED BY add_db IN ALL PROCESSES]
+session_cache = SessionCache(max_size=10000, ttl=60)
+# SESSION STORE USED INSTEAD OF THE DATABASE FILE [SEE use_store()]
+_store = None
+# DATABASE WRITER PROCESS [SEE start_writer()]
+_writer = None
+# CONNECTIONS INHERITED FROM A PARENT PROCESS. SQLITE CONNECTIONS MUST NOT BE
+# USED OR CLOSED ACROSS fork() - KEEP A REFERENCE SO THEY ARE NEVER FINALIZED.
+_inherited_connections = []
+
+
+def get_connection(db_name):
+    '''Return the long-lived connection of this process and thread.
+    The connection is created on first use and kept open afterwards.
+    Creates the database and table if they do not exist.
+
+    Args:
+        db_name: Database name.
+    Return:
+        conn: sqlite3 connection in autocommit mode.
+    '''
+
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        # NEW THREAD OR FORKED PROCESS - DO NOT REUSE PARENT CONNECTIONS
+        _inherited_connections.extend(getattr(_local, 'connections', {}).values())
+        _local.pid = pid
+        _local.connections = {}
+
+    conn = _local.connections.get(db_name)
+    if conn is None:
+        # AUTOCOMMIT MODE - TRANSACTIONS ARE STARTED EXPLICITLY
+        conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT, isolation_level=None,
+                               cached_statements=CACHED_STATEMENTS)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        migrate_db(conn)
+        _local.connections[db_name] = conn
+    return conn
+
+
+def close_connections():
+    '''Close all connections opened by this process and thread.
+    '''
+
+    if getattr(_local, 'pid', None) == os.getpid():
+        for conn in _local.connections.values():
+            conn.close()
+        _local.connections = {}
+    return
+
+
+@contextmanager
+def transaction(conn):
+    '''Run statements in one write transaction.
+    Takes the write lock up front (BEGIN IMMEDIATE) so the busy timeout applies
+    instead of failing when a read transaction tries to upgrade.
+
+    Args:
+        conn: Connection from get_connection().
+    '''
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def migrate_v1(conn):
+    '''Schema version 1: jupyter_talon keyed on user with typed columns.
+    Rows of the original untyped table are converted and copied over.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    untyped = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='jupyter_talon'").fetchone()
+    if untyped:
+        conn.execute('ALTER TABLE jupyter_talon RENAME TO jupyter_talon_untyped')
+    conn.execute(SQL_CREATE_TABLE)
+    for sql_index in SQL_CREATE_INDEXES:
+        conn.execute(sql_index)
+    if untyped:
+        conn.execute(SQL_MIGRATE_UNTYPED)
+        conn.execute('DROP TABLE jupyter_talon_untyped')
+    return
+
+
+def migrate_v2(conn):
+    '''Schema version 2: session_events history and hourly aggregates.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    conn.execute(SQL_CREATE_EVENTS)
+    conn.execute(SQL_CREATE_EVENTS_HOURLY)
+    for sql_index in SQL_CREATE_EVENTS_INDEXES:
+        conn.execute(sql_index)
+    return
+
+
+def migrate_v3(conn):
+    '''Schema version 3: usage aggregates maintained by triggers.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    for sql_table in SQL_CREATE_USAGE:
+        conn.execute(sql_table)
+    for sql_trigger in SQL_CREATE_USAGE_TRIGGERS:
+        conn.execute(sql_trigger)
+    conn.execute(SQL_INIT_USAGE_RUNNING)
+    return
+
+
+def migrate_v4(conn):
+    '''Schema version 4: port_pool of local port leases [filled by port_allocator.setup_pool].
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    conn.execute(SQL_CREATE_PORT_POOL)
+    conn.execute(SQL_CREATE_PORT_POOL_INDEX)
+    return
+
+
+def migrate_v5(conn):
+    '''Schema version 5: user_profiles of what is set up on HPC for each user.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    conn.execute(SQL_CREATE_USER_PROFILES)
+    return
+
+
+def migrate_v6(conn):
+    '''Schema version 6: readiness columns of user_profiles [fast path login].
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    for sql_column in SQL_ADD_READINESS_COLUMNS:
+        conn.execute(sql_column)
+    return
+
+
+def migrate_v7(conn):
+    '''Schema version 7: login_progress of logins in progress.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    conn.execute(SQL_CREATE_LOGIN_PROGRESS)
+    conn.execute(SQL_CREATE_LOGIN_PROGRESS_INDEX)
+    return
+
+
+def migrate_v8(conn):
+    '''Schema version 8: prewarm_predictions of logins.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    conn.execute(SQL_CREATE_PREWARM_PREDICTIONS)
+    return
+
+
+def migrate_v9(conn):
+    '''Schema version 9: count of events with a duration in session_events_hourly.
+
+    Args:
+        conn: Connection inside a write transaction.
+    '''
+
+    for sql_column in SQL_ADD_EVENTS_DURATIONS:
+        conn.execute(sql_column)
+    return
+
+
+# MIGRATIONS IN ORDER. MIGRATIONS[i] UPGRADES THE SCHEMA FROM VERSION i TO i+1
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6, migrate_v7, migrate_v8,
+              migrate_v9]
+
+
+def migrate_db(conn):
+    '''Upgrade database schema to SCHEMA_VERSION.
+    Safe to run from many processes at once: the version is checked again
+    after the write lock is taken.
+
+    Args:
+        conn: sqlite3 connection in autocommit mode.
+    '''
+
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+    with transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            migration(conn)
+            logger(user='root', message='DB MIGRATED TO %s' % migration.__name__, level='WARNING')
+        conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+    return
+
+
+def to_epoch(date):
+    '''Convert date to epoch seconds.
+
+    Args:
+        date: Epoch seconds or local time string '%Y-%m-%d %H:%M:%S'.
+    Return:
+        Epoch seconds. Int type.
+    '''
+
+    if isinstance(date, str):
+        return int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S')))
+    return int(date)
 
 
 def create_db(db_name):
@@ -26,35 +464,122 @@ def create_db(db_name):
     '''
 
     try:
-        # CHECK IF DB EXISTS OR NOT
-        if not os.path.isfile(db_name):
-            # DB DOES NOT EXIST - CREATE DB
-            conn = sqlite3.connect(db_name)
-            # DB CONNECTION
-            c = conn.cursor()
-            # CREATE TABLE IN DB
-            c.execute('''CREATE TABLE jupyter_talon
-                  (user, first_login, last_login, local_port, talon_port, login_node, count_logins, pid_session , state_session)''')
-            # SAVE (COMMIT) THE CHANGES
-            conn.commit()
-            # CLOSE CONNECITON
-            conn.close()
-
+        # OPENING THE CONNECTION CREATES THE DB AND TABLE
+        get_connection(db_name)
         return True
     except Exception as e:
         logger(user='root', message='DB FAILED! %s' % str(e), level='ERROR')
         return False
 
 
+def transition_params(user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+                      timestamp=None):
+    '''Check and convert one state transition to SQL parameters.
+
+    Args:
+        timestamp: Epoch seconds of the transition. Defaults to now.
+    Return:
+        params: Tuple of typed column values for SQL_UPSERT_USER.
+        event: Tuple of values for SQL_INSERT_EVENT.
+    '''
+
+    if state_session not in SESSION_STATES:
+        raise ValueError('invalid state_session %s' % state_session)
+    timestamp = time.time() if timestamp is None else float(timestamp)
+    params = (str(user),
+              int(timestamp),
+              to_epoch(last_login),
+              int(local_port),
+              int(talon_port),
+              str(login_node) if login_node else '',
+              int(pid_session),
+              state_session)
+    event = (params[0], state_session, timestamp, params[3], params[4], params[6])
+    return params, event
+
+
+def use_store(store):
+    '''Make add_db, add_db_batch, from_db and get_ports use a session store
+    from session_store instead of the database file, e.g. a MemorySessionStore
+    for load tests. use_store(None) goes back to the database file.
+
+    Args:
+        store: SessionStore instance or None.
+    '''
+
+    global _store
+    _store = store
+    session_cache.clear()
+    return
+
+
+def start_writer(db_name, **kwargs):
+    '''Start the database writer process. After this call add_db in this
+    process and in every process forked from it sends transitions to the
+    writer instead of writing the database file.
+
+    Args:
+        db_name: Database name.
+        kwargs: DatabaseWriter options.
+    Return:
+        writer: DatabaseWriter instance.
+    '''
+
+    global _writer
+    writer = DatabaseWriter(db_name, **kwargs)
+    writer.start()
+    _writer = writer
+    atexit.register(stop_writer)
+    return writer
+
+
+def stop_writer():
+    '''Commit pending transitions and stop the database writer process.
+    '''
+
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+    return
+
+
+def cache_metrics():
+    '''Hit and miss counters of the from_db cache in this process.
+    '''
+
+    return session_cache.metrics()
+
+
+def writer_metrics():
+    '''Flush and backpressure metrics of the database writer.
+
+    Return:
+        Dictionary of metrics or None if there is no writer.
+    '''
+
+    return None if _writer is None else _writer.metrics()
+
+
+def use_writer(db_name):
+    '''Check if writes to db_name go through the writer process.
+    '''
+
+    return (_writer is not None) and (_writer.db_name == db_name) and \
+        (_writer.pid != os.getpid()) and _writer.is_alive()
+
+
 def add_db(db_name, user, last_login, local_port, talon_port, login_node, pid_session, state_session):
     '''Add instance in database or create database if it does not exist.
     Columns: 'user', 'first_login', 'last_login', 'local_port', 'talon_port',
         'login_node', 'count_logins', 'pid_session', 'state_session'.
+    When the writer process is running the transition is sent to it and
+    add_db returns without waiting for the commit.
 
     Args:
         db_name: Database name.
         user: User id.
-        last_login: Last login date recorded
+        last_login: Last login date recorded [epoch seconds or '%Y-%m-%d %H:%M:%S'].
         local_port: Port on local VM gateway used to forward.
         talon_port: Port on HPC needed to forward.
         login_node: Hostname on HPC.
@@ -64,81 +589,116 @@ def add_db(db_name, user, last_login, local_port, talon_port, login_node, pid_se
             'running'   [login is successfull]
             'ended'     [session ended]
     '''
-    # DB CONNECTION
-    conn = None
-    # DB CURSOR
-    c = None
+    if _store is not None:
+        try:
+            _store.upsert(user, last_login, local_port, talon_port, login_node, pid_session, state_session)
+        except Exception as e:
+            logger(user=user, message='\tadd_db FAILED! %s' % str(e), level='ERROR')
+        return
+    if not use_writer(db_name):
+        add_db_direct(db_name, user, last_login, local_port, talon_port, login_node, pid_session, state_session)
+        return
     try:
-
-        # CHECK IF DB EXISTS OR NOT
-        if not os.path.isfile(db_name):
-            # DB DOES NOT EXIST - CREATE DB
-            conn = sqlite3.connect(db_name)
-            # DB CONNECTION
-            c = conn.cursor()
-            # CREATE TABLE IN DB
-            c.execute('''CREATE TABLE jupyter_talon
-                  (user, first_login, last_login, local_port, talon_port, login_node, count_logins, pid_session , state_session)''')
-        else:
-            # DB EXISTS - JUST ESTABLISH CONNECTION
-            # CONNECT TO DB
-            conn = sqlite3.connect(db_name)
-            # DB CONNECTION
-            c = conn.cursor()
-
-        # CHECK IF USER ALREADY EXISTS
-        users = list(
-            c.execute('SELECT user FROM jupyter_talon ORDER BY user').fetchall())
-        if (user,) in users:
-            # user ALREADY IN DB
-            # GRAB NUMBER OF LOGINS
-            count_logins = (c.execute(
-                'SELECT count_logins FROM jupyter_talon WHERE user=?', (user,)).fetchall())[0][0]
-            # ONLY COUNT AS LOGIN WHEN RUNNING
-            if state_session == 'running':
-                # INCREMENT LOGINS
-                count_logins += 1
-            # INCREMENT count_login
-            c.execute('UPDATE jupyter_talon SET last_login=?,\
-                                          local_port=?,\
-                                          talon_port=?,\
-                                          login_node=?,\
-                                          count_logins=?,\
-                                          pid_session=?,\
-                                          state_session=? WHERE user=?', (
-                last_login,
-                local_port,
-                talon_port,
-                login_node,
-                count_logins,
-                pid_session,
-                state_session,
-                user))
-            logger(user=user, message="USER %s STATE '%s' LOCAL_PORT %s HPC_PORT %s HOSTNAME %s" %
-                   (user, state_session, local_port, talon_port, login_node), level='INFO')
-        else:
-            # user NOT IN DB
-            # ADD user IN DB
-            first_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute('INSERT INTO jupyter_talon VALUES (?,?,?,?,?,?,?,?,?)', (user,
-                                                                               first_login,
-                                                                               last_login,
-                                                                               local_port,
-                                                                               talon_port,
-                                                                               login_node,
-                                                                               0,
-                                                                               pid_session,
-                                                                               state_session))
-        # SAVE (COMMIT) THE CHANGES
-        conn.commit()
-        # CLOSE CONNECITON
-        conn.close()
+        transition = {'user': user, 'last_login': last_login, 'local_port': local_port, 'talon_port': talon_port,
+                      'login_node': login_node, 'pid_session': pid_session, 'state_session': state_session}
+        # CHECK TRANSITION BEFORE SENDING IT
+        transition_params(**transition)
+        # TIME OF THE TRANSITION, NOT OF THE COMMIT
+        transition['timestamp'] = time.time()
+        _writer.submit(transition)
+        session_cache.invalidate(user)
+        logger(user=user, message="USER %s STATE '%s' LOCAL_PORT %s HPC_PORT %s HOSTNAME %s" %
+               (user, state_session, local_port, talon_port, login_node), level='INFO', phase=state_session,
+               local_port=local_port, remote_port=talon_port)
     except Exception as e:
         logger(user=user, message='\tadd_db FAILED! %s' %
                str(e), level='ERROR')
     return
 
 
+def add_db_direct(db_name, user, last_login, local_port, talon_port, login_node, pid_session, state_session,
+                  invalidate=True, timestamp=None):
+    '''Add instance in database or create database if it does not exist.
+    Columns: 'user', 'first_login', 'last_login', 'local_port', 'talon_port',
+        'login_node', 'count_logins', 'pid_session', 'state_session'.
+    Writes the database from this process: one upsert of the user row and
+    one row appended to session_events.
+
+    Args:
+        db_name: Database name.
+        user: User id.
+        last_login: Last login date recorded [epoch seconds or '%Y-%m-%d %H:%M:%S'].
+        local_port: Port on local VM gateway used to forward.
+        talon_port: Port on HPC needed to forward.
+        login_node: Hostname on HPC.
+        pid_session: Pid of running process that does ssh tunneling.
+        state_session: State of the process:
+            'initiated' [login is started]
+            'running'   [login is successfull]
+            'ended'     [session ended]
+        invalidate: Drop user from the from_db cache. The writer process
+            skips it - the sender already did it.
+        timestamp: Epoch seconds of the transition. Defaults to now.
+    Return:
+        True if the transition was saved.
+    '''
+    try:
+        params, event = transition_params(user, last_login, local_port, talon_port, login_node, pid_session,
+                                          state_session, timestamp)
+        conn = get_connection(db_name)
+        with transaction(conn):
+            conn.execute(SQL_UPSERT_USER, params)
+            conn.execute(SQL_INSERT_EVENT, event)
+        if invalidate:
+            session_cache.invalidate(user)
+        logger(user=user, message="USER %s STATE '%s' LOCAL_PORT %s HPC_PORT %s HOSTNAME %s" %
+               (user, state_session, local_port, talon_port, login_node), level='INFO', phase=state_session,
+               local_port=local_port, remote_port=talon_port)
+    except Exception as e:
+        logger(user=user, message='\tadd_db FAILED! %s' %
+               str(e), level='ERROR')
+        return False
+    return True
+
+
+def add_db_batch(db_name, transitions, invalidate=True):
+    '''Apply many state transitions in one transaction.
+
+    Args:
+        db_name: Database name.
+        transitions: List of dictionaries with the add_db arguments
+            'user', 'last_login', 'local_port', 'talon_port', 'login_node',
+            'pid_session', 'state_session' and optional 'timestamp'.
+            Applied in order.
+        invalidate: Drop users from the from_db cache.
+    Return:
+        True if all transitions were saved, False otherwise.
+    '''
+    if not transitions:
+        return True
+    if _store is not None:
+        try:
+            _store.upsert_many(transitions)
+            return True
+        except Exception as e:
+            logger(user='root', message='add_db_batch FAILED! %s' % str(e), level='ERROR')
+            return False
+    try:
+        params, events = zip(*[transition_params(**transition) for transition in transitions])
+        conn = get_connection(db_name)
+        with transaction(conn):
+            conn.executemany(SQL_UPSERT_USER, params)
+            conn.executemany(SQL_INSERT_EVENT, events)
+        if invalidate:
+            for user in set(p[0] for p in params):
+                session_cache.invalidate(user)
+        logger(user='root', message='add_db_batch SAVED %d TRANSITIONS' % len(params), level='INFO')
+        return True
+    except Exception as e:
+        logger(user='root', message='add_db_batch FAILED! %s' % str(e), level='ERROR')
+        return False
+
+
 def from_db(db_name, user):
     """Extract row from dabatase of a specific user.
 
@@ -146,42 +706,38 @@ def from_db(db_name, user):
         db_name: Database name used to read.
         user: User id of returned instance.
     Return:
-        row: Row in database from user.
+        row: Row in database from user. Dates are epoch seconds.
     """
 
+    if _store is not None:
+        return _store.get(user)
+    # CHECK CACHE FIRST
+    row = session_cache.get(user)
+    if row is not MISS:
+        logger(user=user, message='USER %s RETRIEVED FROM CACHE!' %
+               user, level='INFO')
+        return row
+
     row = None
+    # READ GENERATION BEFORE THE DATABASE - A WRITE AFTER THIS POINT INVALIDATES THE ROW
+    generation = session_cache.generation(user)
+    if use_writer(db_name) and not _writer.flush(timeout=BUSY_TIMEOUT):
+        logger(user=user, message='from_db WRITER FLUSH TIMED OUT!', level='ERROR')
     columns = ['first_login', 'last_login', 'local_port', 'talon_port',
                'login_node', 'count_logins', 'pid_session', 'state_session']
     try:
-        # CHECK IF DB EXISTS OR NOT
-        if os.path.isfile(db_name):
-            # CONNECT TO DB
-            conn = sqlite3.connect(db_name)
-            # DB CONNECTION
-            c = conn.cursor()
-            # CHECK IF user EXISTS
-            users = list(
-                c.execute('SELECT user FROM jupyter_talon ORDER BY user').fetchall())
-            if (user,) in users:
-                # EXTRACT ROW
-                row = list(c.execute('SELECT first_login,\
-                                    last_login,\
-                                    local_port,\
-                                    talon_port,\
-                                    login_node,\
-                                    count_logins,\
-                                    pid_session,\
-                                    state_session FROM jupyter_talon WHERE user=?', (user,)).fetchall())
-                # DICTIONARY FORMAT
-                row = {k: v for k, v in zip(columns, row[0])}
-                logger(user=user, message='USER %s RETRIEVED FROM DB!' %
-                       user, level='INFO')
-            else:
-                logger(user=user, message='user %s ADDED TO DB!' %
-                       user, level='WARNING')
+        conn = get_connection(db_name)
+        # EXTRACT ROW
+        values = conn.execute(SQL_SELECT_USER, (user,)).fetchone()
+        if values is not None:
+            # DICTIONARY FORMAT
+            row = {k: v for k, v in zip(columns, values)}
+            logger(user=user, message='USER %s RETRIEVED FROM DB!' %
+                   user, level='INFO')
         else:
-            logger(user=user, message='DB %s does not exist!' %
-                   db_name, level='WARNING')
+            logger(user=user, message='user %s ADDED TO DB!' %
+                   user, level='WARNING')
+        session_cache.put(user, row, generation)
     except Exception as e:
         logger(user=user, message='from_db FAILED! %s' % str(e), level='ERROR')
     return row
@@ -195,21 +751,78 @@ def get_ports(db_name):
     Return:
         ports: local_port from all users.
     """
-    # CHECK IF DB EXISTS OR NOT
-    if os.path.isfile(db_name):
-        try:
-            # CONNECT TO DB
-            conn = sqlite3.connect(db_name)
-            # DB CONNECTION
-            c = conn.cursor()
-            # CHECK IF EUID EXISTS
-            ports = list(c.execute('SELECT local_port FROM jupyter_talon').fetchall())
-            return [port[0] for port in ports]
+    if _store is not None:
+        return _store.list_ports()
+    if use_writer(db_name):
+        _writer.flush(timeout=BUSY_TIMEOUT)
+    try:
+        conn = get_connection(db_name)
+        ports = conn.execute(SQL_SELECT_PORTS).fetchall()
+        return [port[0] for port in ports]
 
-        except Exception as e:
-            print("DB READ FAILED!", e)
-            return None
+    except Exception as e:
+        print("DB READ FAILED!", e)
+        return None
 
-    else:
-        print("DB %s DOES NOT EXIST!" % db_name)
+
+def get_profile(db_name, user):
+    """Read what is already set up on HPC for a user.
+
+    Args:
+        db_name: Database name used to read.
+        user: User id.
+    Return:
+        profile: Dictionary of PROFILE_COLUMNS or None.
+    """
+
+    try:
+        values = get_connection(db_name).execute(SQL_SELECT_PROFILE, (str(user),)).fetchone()
+    except Exception as e:
+        logger(user=user, message='get_profile FAILED! %s' % str(e), level='ERROR')
+        return None
+    if values is None:
         return None
+    return {k: v for k, v in zip(PROFILE_COLUMNS, values)}
+
+
+def set_config_hash(db_name, user, config_hash):
+    """Record the jupyter config version applied on HPC for a user. Written
+    from the session process [one small row, not a session state transition].
+
+    Args:
+        db_name: Database name.
+        user: User id.
+        config_hash: Hash from jupyter_config.render_config().
+    Return:
+        True if saved.
+    """
+
+    try:
+        get_connection(db_name).execute(SQL_SET_CONFIG_HASH, (str(user), str(config_hash), int(time.time())))
+    except Exception as e:
+        logger(user=user, message='set_config_hash FAILED! %s' % str(e), level='ERROR')
+        return False
+    return True
+
+
+def set_readiness(db_name, user, remote_port, login_node):
+    """Record that jupyter of a user answered on remote_port of login_node now.
+    remote_port 0 forgets it [next login takes the full configure path].
+
+    Args:
+        db_name: Database name.
+        user: User id.
+        remote_port: Port of jupyter on HPC.
+        login_node: Hostname on HPC.
+    Return:
+        True if saved.
+    """
+
+    try:
+        get_connection(db_name).execute(SQL_SET_READINESS, (str(user), int(remote_port),
+                                                            str(login_node) if login_node else '',
+                                                            int(time.time()) if remote_port else 0))
+    except Exception as e:
+        logger(user=user, message='set_readiness FAILED! %s' % str(e), level='ERROR')
+        return False
+    return True
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""One authenticated SSH connection per session.
+SSHMaster logs in once with the user password ('ssh -M -S <control socket>')
+and keeps the connection open for the session. configure() and forward()
+open their shells and the port forward as channels of this connection
+('ssh -S <control socket> ...'), so the login node does key exchange and PAM
+once per login instead of twice.
+
+The master is a child of the session process: kill_pid() of the session ends
+it, and session_reaper kills masters left without their session process.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import time
+import shlex
+import subprocess
+import pexpect
+from helper_functions import logger
+
+# CONTROL SOCKETS [UNIX SOCKET PATHS MUST BE SHORT - KEEP IT RELATIVE]
+CONTROL_DIR = 'ssh_control'
+# PRINTED BY A CHANNEL SHELL WHEN IT IS READY. THE QUOTES KEEP THE TYPED
+# COMMAND [ECHOED BY THE TERMINAL] FROM MATCHING.
+READY_MARKER = 'SSH_CHANNEL_READY'
+READY_COMMAND = "echo SSH_CHANNEL_''READY"
+
+
+class SSHMaster(object):
+    """
+    Args:
+        user: User id.
+        credential: Password for login to HPC.
+        hostname: Hostname of HPC.
+        timeout: Seconds to wait for the login.
+        control_dir: Directory of control sockets.
+    """
+
+    def __init__(self, user, credential, hostname, timeout=15, control_dir=CONTROL_DIR):
+        self.user = user
+        self.credential = credential
+        self.hostname = hostname
+        self.timeout = timeout
+        # ONE SOCKET PER SESSION PROCESS - A NEW LOGIN NEVER REUSES A DYING MASTER
+        self.control_path = os.path.join(control_dir, '%s-%s' % (user, os.getpid()))
+        self.child = None
+        return
+
+    def start(self):
+        """Log in and keep the connection open.
+
+        Return:
+            'ready'  [channels can be opened with command()]
+            'denied' [wrong credentials]
+            'failed' [no master, use password logins]
+        """
+
+        os.makedirs(os.path.dirname(self.control_path), mode=0o700, exist_ok=True)
+        start = time.time()
+        try:
+            self.child = pexpect.spawn('ssh -M -S %s -N -o ControlPersist=no -o StrictHostKeyChecking=no %s@%s' %
+                                       (self.control_path, self.user, self.hostname),
+                                       encoding='utf-8', timeout=self.timeout, logfile=None)
+            self.child.expect(['password: '])
+            self.child.sendline(self.credential)
+            while time.time() - start < self.timeout:
+                # ASKED AGAIN OR CONNECTION CLOSED - LOGIN FAILED
+                index = self.child.expect(['password: ', 'Permission denied', pexpect.EOF, pexpect.TIMEOUT],
+                                          timeout=0.2)
+                if index in [0, 1]:
+                    self.stop()
+                    logger(user=self.user, message='SSH MASTER LOGIN DENIED!', level='ERROR', phase='login',
+                           latency=time.time() - start)
+                    return 'denied'
+                if index == 2:
+                    break
+                if self.check():
+                    logger(user=self.user, message='SSH MASTER READY: %s' % self.control_path, level='INFO',
+                           phase='login', latency=time.time() - start)
+                    return 'ready'
+        except Exception as e:
+            logger(user=self.user, message='SSH MASTER FAILED! %s' % str(e), level='ERROR')
+        self.stop()
+        logger(user=self.user, message='SSH MASTER NOT READY - USING PASSWORD LOGINS', level='WARNING',
+               phase='login', latency=time.time() - start)
+        return 'failed'
+
+    def check(self):
+        """True if the master accepts channels.
+        """
+
+        if (self.child is None) or (not os.path.exists(self.control_path)):
+            return False
+        _, status = pexpect.run('ssh -S %s -O check %s@%s' % (self.control_path, self.user, self.hostname),
+                                withexitstatus=True, timeout=5)
+        return status == 0
+
+    def command(self, options=''):
+        """ssh command line that opens a channel of the master.
+
+        Args:
+            options: Extra ssh options, e.g. '-L 0.0.0.0:9000:127.0.0.1:8888'.
+        """
+
+        return 'ssh -S %s %s %s@%s' % (self.control_path, options, self.user, self.hostname)
+
+    def tcp_request(self, port, data, timeout=5):
+        """Send 'data' to 127.0.0.1:port of the login node and read the answer
+        until the other side closes. Uses a direct TCP channel of the master
+        ('ssh -W') - no remote shell or process is started.
+
+        Args:
+            port: Port on the login node.
+            data: Bytes to send.
+            timeout: Seconds to wait for the answer.
+        Return:
+            Bytes received or None if the port did not answer.
+        """
+
+        try:
+            process = subprocess.run(shlex.split(self.command('-W 127.0.0.1:%d' % int(port))), input=data,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout)
+        except Exception as e:
+            logger(user=self.user, message='tcp_request PORT %s FAILED! %s' % (port, type(e).__name__),
+                   level='WARNING')
+            return None
+        return process.stdout or None
+
+    def stop(self):
+        """Close the connection and every channel.
+        """
+
+        if self.child is not None:
+            self.child.close(force=True)
+            self.child = None
+        if os.path.exists(self.control_path):
+            try:
+                os.remove(self.control_path)
+            except OSError:
+                pass
+        return
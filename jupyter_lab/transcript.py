@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Transcript of the remote shell output of one session.
+The session process keeps the last lines read by pexpect in memory and
+writes them to 'transcripts/<user>.log' only when the session fails or when
+an admin asks for it (SIGUSR1 to the session process, see the
+'/admin/transcript/<user>' route).
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import signal
+from collections import deque
+from datetime import datetime
+from helper_functions import logger
+
+TRANSCRIPTS_DIR = 'transcripts'
+
+
+def transcript_path(user, directory=TRANSCRIPTS_DIR):
+    return os.path.join(directory, '%s.log' % user)
+
+
+class Transcript(object):
+    """Ring buffer of remote output lines.
+
+    Args:
+        user: User id.
+        max_lines: Lines kept in memory. Older lines are dropped.
+        directory: Where persist() writes '<user>.log'.
+    """
+
+    def __init__(self, user, max_lines=500, directory=TRANSCRIPTS_DIR):
+        self.user = user
+        self.directory = directory
+        self.lines = deque(maxlen=max_lines)
+        self.total_lines = 0
+        return
+
+    def append(self, line):
+        self.lines.append('%s %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), line))
+        self.total_lines += 1
+        return
+
+    def persist(self, reason):
+        """Write the buffered lines to 'transcripts/<user>.log', replacing the
+        previous transcript of the user.
+
+        Args:
+            reason: Why the transcript was saved [written in the header].
+        Return:
+            path: File written or None if it failed.
+        """
+
+        path = transcript_path(self.user, self.directory)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lines = list(self.lines)
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write('# %s PID %s %s [LAST %d OF %d LINES]\n' %
+                        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), os.getpid(), reason, len(lines),
+                         self.total_lines))
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger(user=self.user, message='TRANSCRIPT FAILED! %s' % str(e), level='ERROR')
+            return None
+        logger(user=self.user, message='TRANSCRIPT SAVED: %s [%s]' % (path, reason), level='WARNING')
+        return path
+
+    def persist_on_signal(self, signum=signal.SIGUSR1):
+        """Persist the transcript when this process gets 'signum'. Call from
+        the main thread of the session process.
+        """
+
+        signal.signal(signum, lambda signum, frame: self.persist('admin request'))
+        return
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tunnel daemon: the port forwards of all users in one process.
+Instead of one 'ssh -L' child and one session process per user kept alive for
+the whole session, the daemon keeps one SSH connection per user [asyncssh,
+optional dependency] in a single asyncio event loop. Every browser connection
+to a local port becomes a direct TCP channel to jupyter on the login node;
+data is relayed in large reads and counted per tunnel.
+
+Session processes hand a tunnel over after configure() [open_tunnel()]. From
+then on the daemon holds the local port lease and the session row
+(pid_session is the daemon pid), so the session process can exit. The
+tunnel is closed after the session length, when its SSH connection drops,
+or on close_tunnel() [new login of the same user].
+
+Logins can run in the daemon as well [session_orchestrator, login_session()]:
+then no session process is forked at all.
+
+Control: JSON line requests on a Unix socket, one JSON line answer each.
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import atexit
+import asyncio
+import functools
+from multiprocessing import Process, Event
+from datetime import datetime
+from helper_functions import logger
+from session_orchestrator import SessionOrchestrator
+
+try:
+    import asyncssh
+except ImportError:
+    # NO DAEMON - SESSIONS KEEP USING 'ssh -L'
+    asyncssh = None
+
+# CONTROL SOCKETS [ONE PER GATEWAY WORKER]
+SOCKET_DIR = 'tunnel_daemon'
+
+# DAEMON OF THIS GATEWAY WORKER [SEE start_tunnel_daemon()]
+_daemon = None
+
+
+class Tunnel(object):
+    """State of one user tunnel [a few KB: counters, one listening socket and one SSH connection].
+    """
+
+    def __init__(self, user, hostname, local_port, remote_port, pid):
+        self.user = user
+        self.hostname = hostname
+        self.local_port = local_port
+        self.remote_port = remote_port
+        # SESSION PROCESS THAT LEASED THE PORT
+        self.pid = pid
+        self.connection = None
+        self.server = None
+        self.expire = None
+        self.opened = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.active = 0
+        return
+
+    def stats(self):
+        return {'hostname': self.hostname, 'local_port': self.local_port, 'remote_port': self.remote_port,
+                'opened': int(self.opened), 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'connections': self.connections, 'active_connections': self.active}
+
+
+class TunnelDaemon(object):
+    """
+    Args:
+        db_name: Database name.
+        socket_dir: Directory of the control socket.
+        buffer_size: Most bytes read at once from each side of a connection.
+        window: SSH channel window in bytes.
+        connect_timeout: Seconds to wait for a user SSH login.
+    """
+
+    def __init__(self, db_name, socket_dir=SOCKET_DIR, buffer_size=256 * 1024, window=4 * 1024 * 1024,
+                 connect_timeout=15):
+        self.db_name = db_name
+        self.socket_dir = socket_dir
+        self.buffer_size = buffer_size
+        self.window = window
+        self.connect_timeout = connect_timeout
+        self.socket_path = None
+        self.process = None
+        self.pid = None
+        self._ready = Event()
+        # DAEMON PROCESS STATE
+        self.tunnels = {}
+        self.closed = {'tunnels': 0, 'bytes_in': 0, 'bytes_out': 0, 'connections': 0}
+        return
+
+    def start(self, timeout=10):
+        """Start daemon process and wait for its control socket.
+
+        Return:
+            True if the daemon is ready.
+        """
+
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        self.process = Process(target=self._run, name='tunnel_daemon', daemon=True)
+        self.process.start()
+        self.pid = self.process.pid
+        self.socket_path = os.path.join(self.socket_dir, '%s.sock' % self.pid)
+        ready = self._ready.wait(timeout)
+        logger(user='root', message='TUNNEL DAEMON STARTED PID %s READY %s' % (self.pid, ready), level='WARNING')
+        return ready
+
+    def is_alive(self):
+        """Check daemon process from any process forked from the gateway.
+        """
+
+        if (self.pid is None) or (not self._ready.is_set()):
+            return False
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def stop(self, timeout=10):
+        """Close all tunnels and stop daemon process.
+        """
+
+        if self.is_alive() and self.pid != os.getpid():
+            self.request({'cmd': 'shutdown'}, timeout=timeout)
+            self.process.join(timeout)
+            logger(user='root', message='TUNNEL DAEMON STOPPED', level='WARNING')
+        return
+
+    def request(self, message, timeout=30):
+        """Send one request to the daemon.
+
+        Args:
+            message: Dictionary with 'cmd' and its arguments.
+            timeout: Seconds to wait for the answer.
+        Return:
+            answer: Dictionary, {'ok': False, 'error': ...} if the daemon did not answer.
+        """
+
+        return daemon_request(self.socket_path, message, timeout=timeout)
+
+    # DAEMON PROCESS
+
+    def _run(self):
+        # ADMIN SIGNALS ARE MEANT FOR SESSION PROCESSES [pid_session OF DAEMON TUNNELS IS THIS PROCESS]
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        self.pid = os.getpid()
+        self.socket_path = os.path.join(self.socket_dir, '%s.sock' % self.pid)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stopped = loop.create_future()
+        # LOGINS RUNNING WITHOUT A WAITING CLIENT [KEPT UNTIL DONE]
+        self._logins = set()
+        self.orchestrator = SessionOrchestrator(self)
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+        return
+
+    async def _serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self._control, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self._ready.set()
+        try:
+            await self._stopped
+        finally:
+            server.close()
+            for user in list(self.tunnels):
+                await self._close(user, 'daemon stopped')
+            os.remove(self.socket_path)
+        return
+
+    async def _control(self, reader, writer):
+        try:
+            message = json.loads((await reader.readline()).decode('utf-8'))
+            cmd = message.pop('cmd', None)
+            if cmd == 'open':
+                answer = await self._open(**message)
+            elif cmd == 'close':
+                answer = {'ok': await self._close(message['user'], 'closed by gateway')}
+            elif cmd == 'login':
+                if message.pop('wait', True):
+                    answer = {'ok': True, 'message': await self.orchestrator.login(**message)}
+                else:
+                    # PROGRESS AND RESULT GO TO login_progress
+                    task = asyncio.ensure_future(self.orchestrator.login(**message))
+                    self._logins.add(task)
+                    task.add_done_callback(self._login_done)
+                    answer = {'ok': True, 'message': None}
+            elif cmd == 'stats':
+                answer = {'ok': True, 'tunnels': {user: tunnel.stats() for user, tunnel in self.tunnels.items()},
+                          'closed': dict(self.closed), 'logins': dict(self.orchestrator.metrics)}
+            elif cmd == 'shutdown':
+                self._stopped.set_result(True)
+                answer = {'ok': True}
+            else:
+                answer = {'ok': False, 'error': 'unknown command %s' % cmd}
+        except Exception as e:
+            answer = {'ok': False, 'error': '%s: %s' % (type(e).__name__, str(e))}
+        writer.write(json.dumps(answer).encode('utf-8') + b'\n')
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        return
+
+    def _login_done(self, task):
+        # LOGIN NOT WAITED FOR - DROP THE REFERENCE AND LOG WHAT login() DID NOT CATCH
+        self._logins.discard(task)
+        if (not task.cancelled()) and (task.exception() is not None):
+            logger(user='root', message='LOGIN TASK FAILED! %s: %s' % (type(task.exception()).__name__,
+                                                                       str(task.exception())), level='ERROR')
+        return
+
+    async def _db(self, function, *args, **kwargs):
+        # BLOCKING DATABASE CALL IN THE THREAD POOL - TUNNELS KEEP RELAYING
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    async def _connect(self, user, credential, hostname):
+        return await asyncio.wait_for(asyncssh.connect(hostname, username=user, password=credential,
+                                                       known_hosts=None, client_keys=None),
+                                      self.connect_timeout)
+
+    async def _open(self, user, credential, hostname, local_port, remote_port, session_length, pid,
+                    connection=None):
+        """Log in as 'user' and forward 0.0.0.0:local_port to 127.0.0.1:remote_port
+        of the login node. Takes over the port lease of 'pid'.
+
+        Args:
+            connection: SSH connection already logged in [orchestrator logins].
+        """
+
+        # IMPORTED HERE - THE DAEMON PROCESS USES ITS OWN CONNECTIONS
+        from sqlite_database import add_db
+        from port_allocator import transfer_port
+
+        start = time.time()
+        if user in self.tunnels:
+            await self._close(user, 'new login')
+        tunnel = Tunnel(user, hostname, int(local_port), int(remote_port), int(pid))
+        try:
+            tunnel.connection = connection if connection is not None else \
+                await self._connect(user, credential, hostname)
+            tunnel.server = await asyncio.start_server(lambda reader, writer: self._accept(tunnel, reader, writer),
+                                                       '0.0.0.0', tunnel.local_port, reuse_address=True)
+        except Exception as e:
+            if tunnel.connection is not None:
+                tunnel.connection.close()
+            logger(user=user, message='TUNNEL NOT OPENED! %s: %s' % (type(e).__name__, str(e)), level='ERROR',
+                   phase='forward', latency=time.time() - start, local_port=local_port, remote_port=remote_port)
+            return {'ok': False, 'error': type(e).__name__}
+        self.tunnels[user] = tunnel
+        # THE DAEMON HOLDS THE LEASE AND THE SESSION FROM NOW ON
+        await self._db(transfer_port, self.db_name, tunnel.local_port, tunnel.pid, os.getpid())
+        await self._db(add_db,
+                       db_name=self.db_name,
+                       user=user,
+                       last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       local_port=tunnel.local_port,
+                       talon_port=tunnel.remote_port,
+                       login_node=hostname,
+                       pid_session=os.getpid(),
+                       state_session='running')
+        tunnel.expire = asyncio.get_event_loop().call_later(
+            int(session_length), lambda: asyncio.ensure_future(self._close(user, 'session length reached', tunnel)))
+        asyncio.ensure_future(self._watch(tunnel))
+        logger(user=user, message='TUNNEL OPENED. LOCAL PORT: %s REMOTE PORT: %s' % (local_port, remote_port),
+               level='CRITICAL', phase='forward', latency=time.time() - start, local_port=local_port,
+               remote_port=remote_port)
+        return {'ok': True, 'pid': os.getpid()}
+
+    async def _watch(self, tunnel):
+        # SSH CONNECTION DROPPED [NETWORK, LOGIN NODE REBOOT]
+        await tunnel.connection.wait_closed()
+        await self._close(tunnel.user, 'ssh connection closed', tunnel)
+        return
+
+    async def _accept(self, tunnel, reader, writer):
+        tunnel.connections += 1
+        tunnel.active += 1
+        remote_writer = None
+        try:
+            # DIRECT TCP CHANNEL TO JUPYTER ON THE LOGIN NODE [NO REMOTE PROCESS]
+            remote_reader, remote_writer = await tunnel.connection.open_connection(
+                '127.0.0.1', tunnel.remote_port, window=self.window)
+            await asyncio.gather(self._relay(reader, remote_writer, tunnel, 'bytes_in'),
+                                 self._relay(remote_reader, writer, tunnel, 'bytes_out'))
+        except Exception as e:
+            logger(user=tunnel.user, message='TUNNEL CONNECTION FAILED! %s' % type(e).__name__, level='WARNING',
+                   local_port=tunnel.local_port, remote_port=tunnel.remote_port)
+        finally:
+            tunnel.active -= 1
+            writer.close()
+            if remote_writer is not None:
+                remote_writer.close()
+        return
+
+    async def _relay(self, reader, writer, tunnel, counter):
+        try:
+            while True:
+                data = await reader.read(self.buffer_size)
+                if not data:
+                    break
+                setattr(tunnel, counter, getattr(tunnel, counter) + len(data))
+                writer.write(data)
+                await writer.drain()
+        except Exception:
+            pass
+        finally:
+            # HALF CLOSE - THE OTHER DIRECTION CAN STILL FINISH
+            try:
+                writer.write_eof()
+            except Exception:
+                writer.close()
+        return
+
+    async def _close(self, user, reason, tunnel=None):
+        """Close the tunnel of 'user' [only if it is still 'tunnel'], give the
+        port back and end the session.
+        """
+
+        from sqlite_database import add_db
+        from port_allocator import release_port
+
+        current = self.tunnels.get(user)
+        if (current is None) or ((tunnel is not None) and (current is not tunnel)):
+            return False
+        del self.tunnels[user]
+        if current.expire is not None:
+            current.expire.cancel()
+        current.server.close()
+        current.connection.close()
+        await self._db(release_port, self.db_name, current.local_port, os.getpid())
+        await self._db(add_db,
+                       db_name=self.db_name,
+                       user=user,
+                       last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       local_port=0,
+                       talon_port=0,
+                       login_node=0,
+                       pid_session=0,
+                       state_session='ended')
+        self.closed['tunnels'] += 1
+        self.closed['bytes_in'] += current.bytes_in
+        self.closed['bytes_out'] += current.bytes_out
+        self.closed['connections'] += current.connections
+        logger(user=user, message='TUNNEL CLOSED [%s] %s' % (reason, current.stats()), level='WARNING',
+               phase='forward', local_port=current.local_port, remote_port=current.remote_port)
+        return True
+
+
+def daemon_request(socket_path, message, timeout=30):
+    '''Send one request to the daemon listening on 'socket_path' [see TunnelDaemon.request()].
+    '''
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            answer = b''
+            while not answer.endswith(b'\n'):
+                data = sock.recv(65536)
+                if not data:
+                    break
+                answer += data
+        return json.loads(answer.decode('utf-8'))
+    except Exception as e:
+        logger(user='root', message='TUNNEL DAEMON REQUEST %s FAILED! %s' % (message.get('cmd'), str(e)),
+               level='ERROR')
+        return {'ok': False, 'error': str(e)}
+
+
+def daemon_socket(pid, socket_dir=SOCKET_DIR):
+    '''Control socket of the tunnel daemon with process id 'pid', started by
+    any gateway worker.
+
+    Return:
+        socket_path: Path of the socket or None if 'pid' is not a tunnel daemon.
+    '''
+
+    socket_path = os.path.join(socket_dir, '%s.sock' % int(pid))
+    return socket_path if os.path.exists(socket_path) else None
+
+
+def start_tunnel_daemon(db_name, **kwargs):
+    '''Start the tunnel daemon of this gateway worker. Session processes forked
+    after this call hand their tunnels to it [open_tunnel()].
+
+    Args:
+        db_name: Database name.
+        kwargs: TunnelDaemon options.
+    Return:
+        daemon: TunnelDaemon instance or None if asyncssh is not installed.
+    '''
+
+    global _daemon
+    if asyncssh is None:
+        logger(user='root', message='asyncssh NOT INSTALLED - NO TUNNEL DAEMON', level='WARNING')
+        return None
+    daemon = TunnelDaemon(db_name, **kwargs)
+    if daemon.start():
+        _daemon = daemon
+        atexit.register(stop_tunnel_daemon)
+    return _daemon
+
+
+def stop_tunnel_daemon():
+    global _daemon
+    if _daemon is not None:
+        _daemon.stop()
+        _daemon = None
+    return
+
+
+def tunnel_daemon():
+    '''Running tunnel daemon or None.
+    '''
+
+    return _daemon if (_daemon is not None) and _daemon.is_alive() else None
+
+
+def open_tunnel(user, credential, hostname, local_port, remote_port, session_length, pid):
+    '''Hand the forward of a session to the daemon.
+
+    Return:
+        True if the daemon took the tunnel [and the port lease of 'pid'].
+    '''
+
+    daemon = tunnel_daemon()
+    if daemon is None:
+        return False
+    return daemon.request({'cmd': 'open', 'user': user, 'credential': credential, 'hostname': hostname,
+                           'local_port': int(local_port), 'remote_port': int(remote_port),
+                           'session_length': int(session_length), 'pid': int(pid)}).get('ok', False)
+
+
+def login_session(user, credential, hostname, python_path, jupyter_bin_path, session_length, timeout=120,
+                  wait=True, **kwargs):
+    '''Run the whole login of a user in the daemon [session_orchestrator].
+
+    Args:
+        timeout: Seconds to wait for the answer.
+        wait: Wait for the end of the login. Without waiting, follow it with
+            login_progress [pass 'token'].
+        kwargs: SessionOrchestrator.login() options.
+    Return:
+        message: 'running <local port>', 'ended 0' [invalid credentials] or
+            'ended None' [server error], or None if there is no daemon or
+            the login was not waited for.
+    '''
+
+    daemon = tunnel_daemon()
+    if daemon is None:
+        return None
+    message = dict(kwargs, cmd='login', user=user, credential=credential, hostname=hostname,
+                   python_path=python_path, jupyter_bin_path=jupyter_bin_path, session_length=int(session_length),
+                   wait=wait)
+    answer = daemon.request(message, timeout=timeout)
+    if not wait:
+        return None if answer.get('ok') else 'ended None'
+    return answer.get('message', 'ended None')
+
+
+def close_tunnel(user, pid=None):
+    '''Close the daemon tunnel of a user [ends the session].
+
+    Args:
+        pid: Tunnel daemon holding the tunnel [pid_session], it can belong to
+            another gateway worker. None - the daemon of this worker.
+    '''
+
+    if pid is not None:
+        socket_path = daemon_socket(pid)
+        if socket_path is None:
+            return False
+        return daemon_request(socket_path, {'cmd': 'close', 'user': user}).get('ok', False)
+    daemon = tunnel_daemon()
+    return False if daemon is None else daemon.request({'cmd': 'close', 'user': user}).get('ok', False)
+
+
+def tunnel_metrics():
+    '''Tunnels and byte counters of the daemon.
+
+    Return:
+        Dictionary of metrics or None if there is no daemon.
+    '''
+
+    daemon = tunnel_daemon()
+    if daemon is None:
+        return None
+    stats = daemon.request({'cmd': 'stats'}, timeout=5)
+    if not stats.get('ok'):
+        return None
+    tunnels = stats['tunnels']
+    return {'pid': daemon.pid,
+            'tunnels': len(tunnels),
+            'active_connections': sum(t['active_connections'] for t in tunnels.values()),
+            'bytes_in': sum(t['bytes_in'] for t in tunnels.values()) + stats['closed']['bytes_in'],
+            'bytes_out': sum(t['bytes_out'] for t in tunnels.values()) + stats['closed']['bytes_out'],
+            'closed_tunnels': stats['closed']['tunnels'],
+            'logins': stats['logins'],
+            'by_user': tunnels}
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Usage aggregates for capacity planning.
+Reads the usage_* tables kept up to date by triggers on every state
+transition (see sqlite_database.SQL_CREATE_USAGE_TRIGGERS). Every query reads
+only the rows of the requested window, never the sessions table.
+
+Run: `$ python usage_stats.py --days 7 --hours 24`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import sys
+import json
+import time
+import argparse
+from sqlite_database import get_connection
+
+SQL_RUNNING = 'SELECT login_node, sessions FROM usage_running WHERE sessions > 0 ORDER BY login_node'
+SQL_DAILY = 'SELECT day, active_users FROM usage_daily WHERE day >= ? ORDER BY day'
+SQL_HOURLY = 'SELECT hour, attempts, logins, failures FROM usage_hourly WHERE hour >= ? ORDER BY hour'
+SQL_DELETE_DAILY_USERS = 'DELETE FROM usage_daily_users WHERE day < ?'
+
+
+def usage_summary(db_name, days=7, hours=24):
+    '''Usage aggregates.
+
+    Args:
+        db_name: Database name.
+        days: Days of daily active users to return.
+        hours: Hours of logins and failures to return.
+    Return:
+        Dictionary with:
+            'running': Running sessions per login node.
+            'running_total': Running sessions.
+            'daily_active_users': List of {'day', 'active_users'}.
+            'hourly': List of {'hour', 'attempts', 'logins', 'failures', 'failure_rate'}.
+            'failure_rate': Failed login attempts / attempts in the 'hours' window.
+        Days and hours are epoch seconds.
+    '''
+
+    conn = get_connection(db_name)
+    now = int(time.time())
+    running = {login_node: sessions for login_node, sessions in conn.execute(SQL_RUNNING)}
+    daily = [{'day': day * 86400, 'active_users': active_users}
+             for day, active_users in conn.execute(SQL_DAILY, (now // 86400 - days + 1,))]
+    hourly = [{'hour': hour * 3600, 'attempts': attempts, 'logins': logins, 'failures': failures,
+               'failure_rate': failures / attempts if attempts else 0}
+              for hour, attempts, logins, failures in conn.execute(SQL_HOURLY, (now // 3600 - hours + 1,))]
+    attempts = sum(row['attempts'] for row in hourly)
+    return {'running': running,
+            'running_total': sum(running.values()),
+            'daily_active_users': daily,
+            'hourly': hourly,
+            'failure_rate': sum(row['failures'] for row in hourly) / attempts if attempts else 0}
+
+
+def prune_daily_users(db_name, keep_days=30):
+    '''Delete the per user rows behind daily active users older than
+    'keep_days'. The daily counts are kept.
+
+    Return:
+        Number of rows deleted.
+    '''
+
+    conn = get_connection(db_name)
+    return conn.execute(SQL_DELETE_DAILY_USERS, (int(time.time()) // 86400 - keep_days,)).rowcount
+
+
+def print_summary(summary):
+    '''Print usage summary as text tables.
+    '''
+
+    print('RUNNING SESSIONS: %d' % summary['running_total'])
+    for login_node, sessions in summary['running'].items():
+        print('  %-30s %6d' % (login_node or '-', sessions))
+    print('DAILY ACTIVE USERS:')
+    for row in summary['daily_active_users']:
+        print('  %s %6d' % (time.strftime('%Y-%m-%d', time.gmtime(row['day'])), row['active_users']))
+    print('LOGINS PER HOUR:       attempts logins failures')
+    for row in summary['hourly']:
+        print('  %s %8d %6d %8d' % (time.strftime('%Y-%m-%d %H:00', time.localtime(row['hour'])),
+                                    row['attempts'], row['logins'], row['failures']))
+    print('FAILURE RATE: %.1f%%' % (100 * summary['failure_rate']))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gateway usage aggregates.')
+    parser.add_argument('--db', default='database_jupyter_lab.db', help='database file')
+    parser.add_argument('--days', type=int, default=7, help='days of daily active users')
+    parser.add_argument('--hours', type=int, default=24, help='hours of logins per hour')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    summary = usage_summary(args.db, days=args.days, hours=args.hours)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_summary(summary)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Warm pool of jupyter lab processes on the HPC login node.
+Started by the admins on the login node with the HPC python [Python 3.6, no
+gateway imports, no f-strings]. The pool imports jupyter lab once and keeps
+'size' forked processes parked on a pipe, so a login skips the slow imports
+from the shared file system.
+
+remote_bootstrap.py asks for a server on the pool Unix socket [JSON line
+{"cmd": "start", "work_dir", "port", "env"}]. The user is the peer of the
+socket [SO_PEERCRED], never a field of the request: the parked process
+switches to that user [pool run as root], moves to the work directory (it must
+belong to the user) and runs jupyter lab. The pool parks a new process between
+requests. {"cmd": "stats"} answers the pool counters and hit rate;
+{"cmd": "resize", "size"} from root, the pool user or '--admin-uid' changes
+the number of parked processes up to '--max-size' [the gateway grows the pool
+ahead of predicted logins, see prewarm.py].
+
+Run: `$ python warm_pool.py --socket /var/run/jupyter_warm_pool.sock --size 4`
+     `$ python warm_pool.py --socket /var/run/jupyter_warm_pool.sock --stats`
+     `$ python warm_pool.py --socket /var/run/jupyter_warm_pool.sock --resize 12`
+
+(C) 2020 George Mihaila
+email georgemihaila@my.unt.edu
+"""
+
+import os
+import sys
+import pwd
+import json
+import time
+import socket
+import signal
+import struct
+import argparse
+import threading
+import importlib
+import traceback
+import socketserver
+
+# ENTRY POINT OF `jupyter lab`
+DEFAULT_ENTRY = 'jupyterlab.labapp:main'
+# ONLY THESE VARIABLES OF THE REQUEST REACH THE SERVER
+ALLOWED_ENV = ['PATH', 'IPYTHONDIR', 'JUPYTER_CONFIG_DIR', 'JUPYTER_DATA_DIR', 'JUPYTER_RUNTIME_DIR', 'LANG',
+               'LC_ALL']
+
+
+def peer_uid(sock):
+    '''User id of the process on the other side of a Unix socket.
+    '''
+
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                        struct.calcsize('3i')))
+    return uid
+
+
+def bind(spec):
+    '''Turn the parked process into the jupyter server of one user.
+
+    Args:
+        spec: {'uid', 'work_dir', 'port', 'env'} checked by the pool.
+    '''
+
+    user = pwd.getpwuid(spec['uid'])
+    os.setsid()
+    if os.getuid() == 0:
+        os.initgroups(user.pw_name, user.pw_gid)
+        os.setgid(user.pw_gid)
+        os.setuid(user.pw_uid)
+    os.chdir(spec['work_dir'])
+    os.environ.clear()
+    os.environ.update(spec['env'])
+    os.environ.update({'HOME': user.pw_dir, 'USER': user.pw_name, 'LOGNAME': user.pw_name,
+                       'SHELL': user.pw_shell})
+    # SAME LOG AS remote_bootstrap.start_server()
+    log = os.open(os.path.join(spec['work_dir'], '.jupyter_lab.log'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(devnull)
+    os.close(log)
+    sys.argv = ['jupyter-lab', '--no-browser', '--ip=0.0.0.0', '--port=%d' % spec['port']]
+    return
+
+
+class WarmPool(object):
+    """
+    Args:
+        socket_path: Unix socket of the pool.
+        size: Parked processes kept ready.
+        entry: 'module:function' run by a bound process.
+        min_uid: Lowest user id served [no system accounts].
+        max_size: Most parked processes a resize can ask for.
+        admin_uids: Users allowed to resize besides root and the pool user.
+    """
+
+    def __init__(self, socket_path, size=4, entry=DEFAULT_ENTRY, min_uid=1000, max_size=32, admin_uids=None):
+        self.socket_path = socket_path
+        self.size = size
+        self.entry = entry
+        self.min_uid = min_uid
+        self.max_size = max_size
+        self.admin_uids = admin_uids or []
+        self.main = None
+        self.server = None
+        # PARKED PROCESSES: [(pid, write end of its pipe, parked time)]
+        self.parked = []
+        # REQUESTS ARE SERVED IN THREADS - ONE start / resize / refill AT A TIME
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'rejected': 0, 'parked': 0, 'died': 0, 'resizes': 0,
+                      'started': time.time()}
+        return
+
+    def preload(self):
+        # IMPORTED ONCE - EVERY PARKED PROCESS IS A FORK OF THIS ONE
+        module, function = self.entry.split(':')
+        self.main = getattr(importlib.import_module(module), function)
+        return
+
+    def park(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(write_fd)
+            self._worker(read_fd)
+        os.close(read_fd)
+        self.parked.append((pid, write_fd, time.time()))
+        self.stats['parked'] += 1
+        return
+
+    def _worker(self, read_fd):
+        # PARKED PROCESS - NOTHING OF THE POOL IS KEPT
+        code = 1
+        try:
+            self.server.socket.close()
+            for pid, write_fd, parked in self.parked:
+                os.close(write_fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            with os.fdopen(read_fd, 'r') as f:
+                line = f.readline()
+            if not line:
+                # POOL STOPPED
+                os._exit(0)
+            bind(json.loads(line))
+            self.main()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def refill(self):
+        with self.lock:
+            self._refill()
+        return
+
+    def _refill(self):
+        # DROP PARKED PROCESSES THAT DIED, PARK NEW ONES
+        for item in list(self.parked):
+            try:
+                os.kill(item[0], 0)
+            except OSError:
+                self.parked.remove(item)
+                os.close(item[1])
+                self.stats['died'] += 1
+        while len(self.parked) < self.size:
+            self.park()
+        while len(self.parked) > self.size:
+            # NEWEST FIRST - IT READS END OF FILE AND EXITS
+            os.close(self.parked.pop()[1])
+        return
+
+    def resize(self, uid, request):
+        if (uid != 0) and (uid != os.getuid()) and (uid not in self.admin_uids):
+            self.stats['rejected'] += 1
+            return {'ok': False, 'error': 'USER %s CANNOT RESIZE' % uid}
+        try:
+            size = max(0, min(int(request['size']), self.max_size))
+        except (KeyError, ValueError, TypeError):
+            return {'ok': False, 'error': 'INVALID REQUEST'}
+        with self.lock:
+            self.size = size
+            self.stats['resizes'] += 1
+        return {'ok': True, 'size': self.size}
+
+    def check(self, uid, request):
+        '''Spec for bind() or the reason the request is refused.
+        '''
+
+        if (os.getuid() == 0) and (uid < self.min_uid):
+            return None, 'USER %s NOT SERVED' % uid
+        if (os.getuid() != 0) and (uid != os.getuid()):
+            return None, 'POOL OF USER %s ONLY' % os.getuid()
+        work_dir = str(request.get('work_dir', ''))
+        try:
+            if (not os.path.isdir(work_dir)) or (os.stat(work_dir).st_uid != uid):
+                return None, 'WORK DIRECTORY %s NOT OWNED BY %s' % (work_dir, uid)
+            port = int(request['port'])
+        except (OSError, KeyError, ValueError, TypeError):
+            return None, 'INVALID REQUEST'
+        if not 1024 <= port <= 65535:
+            return None, 'INVALID PORT %s' % port
+        env = {key: str(value) for key, value in (request.get('env') or {}).items() if key in ALLOWED_ENV}
+        return {'uid': uid, 'work_dir': work_dir, 'port': port, 'env': env}, None
+
+    def start(self, uid, request):
+        spec, error = self.check(uid, request)
+        if spec is None:
+            self.stats['rejected'] += 1
+            return {'ok': False, 'error': error}
+        with self.lock:
+            return self._start(spec)
+
+    def _start(self, spec):
+        while self.parked:
+            pid, write_fd, parked = self.parked.pop(0)
+            try:
+                os.write(write_fd, (json.dumps(spec) + '\n').encode('utf-8'))
+            except OSError:
+                # DIED WHILE PARKED
+                self.stats['died'] += 1
+                continue
+            finally:
+                os.close(write_fd)
+            self.stats['hits'] += 1
+            return {'ok': True, 'pid': pid, 'parked_seconds': round(time.time() - parked, 3)}
+        self.stats['misses'] += 1
+        return {'ok': False, 'error': 'EMPTY'}
+
+    def metrics(self):
+        requests = self.stats['hits'] + self.stats['misses']
+        return dict(self.stats, size=self.size, max_size=self.max_size, ready=len(self.parked),
+                    hit_rate=self.stats['hits'] / requests if requests else 0)
+
+    def serve(self):
+        pool = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            timeout = 5
+
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    if request.get('cmd') == 'start':
+                        answer = pool.start(peer_uid(self.request), request)
+                    elif request.get('cmd') == 'resize':
+                        answer = pool.resize(peer_uid(self.request), request)
+                    elif request.get('cmd') == 'stats':
+                        answer = {'ok': True, 'stats': pool.metrics()}
+                    else:
+                        answer = {'ok': False, 'error': 'UNKNOWN COMMAND'}
+                except (OSError, ValueError, AttributeError) as e:
+                    answer = {'ok': False, 'error': '%s: %s' % (type(e).__name__, str(e))}
+                try:
+                    self.wfile.write((json.dumps(answer) + '\n').encode('utf-8'))
+                except OSError:
+                    # CLIENT GONE [E.G. SENT NOTHING UNTIL THE TIMEOUT]
+                    pass
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            # A CLIENT THAT SENDS NOTHING ONLY HOLDS ITS OWN THREAD [HANDLER timeout]
+            daemon_threads = True
+
+            def service_actions(self):
+                # BETWEEN REQUESTS
+                pool.refill()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = Server(self.socket_path, Handler)
+        # ANY USER CONNECTS - THE PEER USER ID IS THE IDENTITY
+        os.chmod(self.socket_path, 0o666)
+        # BOUND PROCESSES ARE REAPED BY THE KERNEL
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.refill()
+        try:
+            self.server.serve_forever(poll_interval=0.5)
+        finally:
+            # PARKED PROCESSES READ END OF FILE AND EXIT
+            for pid, write_fd, parked in self.parked:
+                os.close(write_fd)
+            self.parked = []
+            self.server.server_close()
+            os.unlink(self.socket_path)
+        return
+
+
+def pool_request(socket_path, request, timeout=5):
+    '''Send one request to the pool and return its answer.
+    '''
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        return json.loads(sock.makefile('r').readline())
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Warm pool of jupyter lab processes.')
+    parser.add_argument('--socket', default='/var/run/jupyter_warm_pool.sock', help='pool Unix socket')
+    parser.add_argument('--size', type=int, default=4, help='parked processes')
+    parser.add_argument('--entry', default=DEFAULT_ENTRY, help='module:function of jupyter lab')
+    parser.add_argument('--min-uid', type=int, default=1000, help='lowest user id served')
+    parser.add_argument('--max-size', type=int, default=32, help='most parked processes after a resize')
+    parser.add_argument('--admin-uid', type=int, action='append', help='user id allowed to resize')
+    parser.add_argument('--stats', action='store_true', help='print the counters of a running pool')
+    parser.add_argument('--resize', type=int, help='set the parked processes of a running pool')
+    args = parser.parse_args()
+
+    if args.stats:
+        json.dump(pool_request(args.socket, {'cmd': 'stats'}), sys.stdout, indent=2)
+        print()
+    elif args.resize is not None:
+        answer = pool_request(args.socket, {'cmd': 'resize', 'size': args.resize})
+        print(json.dumps(answer))
+        sys.exit(0 if answer.get('ok') else 1)
+    else:
+        warm_pool = WarmPool(args.socket, size=args.size, entry=args.entry, min_uid=args.min_uid,
+                             max_size=args.max_size, admin_uids=args.admin_uid)
+        warm_pool.preload()
+        warm_pool.serve()